@@ -1,14 +1,14 @@
 from typing import List
 from langchain.document_loaders.unstructured import UnstructuredFileLoader
+from document_loaders.ocr import borrow_ocr
 
 
 class RapidOCRLoader(UnstructuredFileLoader):
     def _get_elements(self) -> List:
         def img2text(filepath):
-            from rapidocr_onnxruntime import RapidOCR
             resp = ""
-            ocr = RapidOCR()
-            result, _ = ocr(filepath)
+            with borrow_ocr() as ocr:
+                result, _ = ocr(filepath)
             if result:
                 ocr_result = [line[1] for line in result]
                 resp += "\n".join(ocr_result)
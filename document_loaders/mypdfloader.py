@@ -1,42 +1,172 @@
-from typing import List
+import hashlib
+import math
+import multiprocessing as mp
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, List
 from langchain.document_loaders.unstructured import UnstructuredFileLoader
+import configs
+from document_loaders.ocr import borrow_ocr, set_ocr_pool_size
 import tqdm
 
+PDF_OCR_PROCESSES = getattr(configs, "PDF_OCR_PROCESSES", 0)
+PDF_OCR_MIN_IMAGE_SIZE = getattr(configs, "PDF_OCR_MIN_IMAGE_SIZE", 32)
+
+
+# 图片区域内文字层的字符数达到该值时，认为图片已有对应的文字（如扫描件中 OCR 生成的隐藏文字层），不再识别
+TEXT_COVERED_CHARS = 20
+# 按图片内容哈希缓存的 OCR 结果数量，页眉、logo 等重复出现的图片只识别一次
+OCR_CACHE_SIZE = 1024
+
+_ocr_cache = OrderedDict()
+_ocr_cache_lock = threading.Lock()
+_pool: ProcessPoolExecutor = None
+_pool_lock = threading.Lock()
+# 在文档解析子进程中已经按文件并行，不再为单个 PDF 启动子进程，见 disable_process_pool
+_pool_disabled = False
+
+
+def _ocr_image(doc, page, img) -> str:
+    import fitz  # pyMuPDF里面的fitz包，不要与pip install fitz混淆
+    import numpy as np
+
+    xref, _, width, height = img[:4]
+    if min(width, height) < PDF_OCR_MIN_IMAGE_SIZE:  # 图标、线条等，RapidOCR 也识别不出文字
+        return ""
+    for rect in page.get_image_rects(xref):
+        if len(page.get_text("text", clip=rect).strip()) >= TEXT_COVERED_CHARS:
+            return ""
+
+    # 没有原始数据流（如内联图片）时无法按内容识别重复的图片，不使用缓存。xref 只在单个文件内有效，不能作为键
+    raw = doc.xref_stream_raw(xref)
+    key = hashlib.md5(raw).hexdigest() if raw else None
+    if key is not None:
+        with _ocr_cache_lock:
+            if (text := _ocr_cache.get(key)) is not None:
+                _ocr_cache.move_to_end(key)
+                return text
+
+    pix = fitz.Pixmap(doc, xref)
+    if pix.n - pix.alpha >= 4:  # CMYK 等转为 RGB
+        pix = fitz.Pixmap(fitz.csRGB, pix)
+    img_array = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, -1)
+    with borrow_ocr() as ocr:
+        result, _ = ocr(img_array)
+    text = "\n".join(line[1] for line in result) if result else ""
+
+    if key is not None:
+        with _ocr_cache_lock:
+            _ocr_cache[key] = text
+            while len(_ocr_cache) > OCR_CACHE_SIZE:
+                _ocr_cache.popitem(last=False)
+    return text
+
+
+def pages2text(filepath: str, start: int, end: int, on_page: Callable[[int], None] = None) -> List[str]:
+    '''
+    提取 [start, end) 页的文字，并识别页面中的图片，返回每页的文本
+    '''
+    import fitz
+
+    pages = []
+    with fitz.open(filepath) as doc:
+        for i in range(start, end):
+            page = doc[i]
+            # TODO: 依据文本与图片顺序调整处理方式
+            parts = [page.get_text("text"), "\n"]
+            for img in page.get_images():
+                parts.append(_ocr_image(doc, page, img))
+            pages.append("".join(parts))
+            if on_page is not None:
+                on_page(i)
+    return pages
+
+
+def _init_worker():
+    disable_process_pool()
+    set_ocr_pool_size(1)  # 每个子进程同时只处理一段页面
+
+
+def disable_process_pool():
+    '''
+    在当前进程中逐页提取，不再启动子进程。由已经按文件并行的子进程（如文档解析子进程）调用，避免嵌套的进程池
+    '''
+    global _pool_disabled
+    _pool_disabled = True
+
+
+def _use_process_pool(page_count: int) -> bool:
+    if PDF_OCR_PROCESSES <= 0 or page_count < 2 or _pool_disabled:
+        return False
+    # 守护进程不能创建子进程，此时在当前进程中识别
+    return not mp.current_process().daemon
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # 子进程常驻，OCR 引擎与识别结果的缓存可以在文件之间复用
+            _pool = ProcessPoolExecutor(max_workers=PDF_OCR_PROCESSES,
+                                        mp_context=mp.get_context("spawn"),
+                                        initializer=_init_worker)
+        return _pool
+
+
+def _reset_pool(broken: ProcessPoolExecutor):
+    global _pool
+    with _pool_lock:
+        if _pool is broken:
+            _pool = None
+    # 进程池已损坏，排队的任务都已失败，无需取消（cancel_futures 需要 Python 3.9）
+    broken.shutdown(wait=False)
+
+
+def pdf2text(filepath: str) -> str:
+    '''
+    设置了 PDF_OCR_PROCESSES 时，页面分段后在多个子进程中并行提取与识别，再按页码顺序拼接
+    '''
+    import fitz
+
+    with fitz.open(filepath) as doc:
+        page_count = doc.page_count
+    b_unit = tqdm.tqdm(total=page_count, desc="RapidOCRPDFLoader context page index: 0")
+
+    def on_page(i: int):
+        # 更新描述
+        b_unit.set_description("RapidOCRPDFLoader context page index: {}".format(i))
+        # 更新进度
+        b_unit.update(1)
+
+    if not _use_process_pool(page_count):
+        pages = pages2text(filepath, 0, page_count, on_page=on_page)
+    else:
+        # 每个子进程分到约4段，各段耗时不均（如扫描页与文字页）时负载仍较均衡
+        step = max(math.ceil(page_count / (PDF_OCR_PROCESSES * 4)), 1)
+        pool = _get_pool()
+        futures = [pool.submit(pages2text, filepath, start, min(start + step, page_count))
+                   for start in range(0, page_count, step)]
+        pages = []
+        try:
+            for future in futures:
+                result = future.result()
+                pages.extend(result)
+                on_page(len(pages) - 1)
+                b_unit.update(len(result) - 1)
+        except BrokenProcessPool:
+            _reset_pool(pool)
+            raise
+        finally:
+            for future in futures:  # 出错时取消尚未开始的分段
+                future.cancel()
+    b_unit.close()
+    return "".join(pages)
+
 
 class RapidOCRPDFLoader(UnstructuredFileLoader):
     def _get_elements(self) -> List:
-        def pdf2text(filepath):
-            import fitz # pyMuPDF里面的fitz包，不要与pip install fitz混淆
-            from rapidocr_onnxruntime import RapidOCR
-            import numpy as np
-            ocr = RapidOCR()
-            doc = fitz.open(filepath)
-            resp = ""
-
-            b_unit = tqdm.tqdm(total=doc.page_count, desc="RapidOCRPDFLoader context page index: 0")
-            for i, page in enumerate(doc):
-
-                # 更新描述
-                b_unit.set_description("RapidOCRPDFLoader context page index: {}".format(i))
-                # 立即显示进度条更新结果
-                b_unit.refresh()
-                # TODO: 依据文本与图片顺序调整处理方式
-                text = page.get_text("")
-                resp += text + "\n"
-
-                img_list = page.get_images()
-                for img in img_list:
-                    pix = fitz.Pixmap(doc, img[0])
-                    img_array = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, -1)
-                    result, _ = ocr(img_array)
-                    if result:
-                        ocr_result = [line[1] for line in result]
-                        resp += "\n".join(ocr_result)
-
-                # 更新进度
-                b_unit.update(1)
-            return resp
-
         text = pdf2text(self.file_path)
         from unstructured.partition.text import partition_text
         return partition_text(text=text, **self.unstructured_kwargs)
@@ -0,0 +1,94 @@
+'''
+进程内共用的 RapidOCR 引擎池。每个 RapidOCR 实例包含检测、方向分类与识别三个 ONNX 模型，加载耗时远超识别一张小图片，
+因此引擎创建后一直保留，加载器用 borrow_ocr() 借用、用完归还。引擎数量为 OCR_ENGINES（解析子进程中为1），
+同时识别的文件超过该数量时等待空闲引擎，每个引擎的 onnxruntime 线程数为 OCR_THREADS。
+'''
+import queue
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+
+import configs
+from configs import logger
+
+OCR_ENGINES = getattr(configs, "OCR_ENGINES", 2)
+OCR_THREADS = getattr(configs, "OCR_THREADS", 0)
+
+
+# 使用 RapidOCR 的加载器，配置了这些加载器时在启动时预热 OCR 引擎
+OCR_LOADERS = ("RapidOCRPDFLoader", "RapidOCRLoader")
+
+
+def create_ocr(num_threads: int = OCR_THREADS):
+    from rapidocr_onnxruntime import RapidOCR
+    if num_threads and num_threads > 0:
+        # 不支持线程数参数的旧版本会忽略这两个参数
+        return RapidOCR(intra_op_num_threads=num_threads, inter_op_num_threads=1)
+    return RapidOCR()
+
+
+class OCREnginePool:
+    def __init__(self, size: int = OCR_ENGINES, num_threads: int = OCR_THREADS):
+        self.size = max(size, 1)
+        self.num_threads = num_threads
+        self._idle = queue.LifoQueue()  # 优先使用最近用过的引擎，其内存更可能仍在缓存中
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            create = self._created < self.size
+            if create:
+                self._created += 1
+        if not create:
+            return self._idle.get()
+        try:
+            return create_ocr(self.num_threads)
+        except Exception:
+            with self._lock:
+                self._created -= 1
+            raise
+
+    @contextmanager
+    def borrow(self):
+        engine = self._acquire()
+        try:
+            yield engine
+        finally:
+            self._idle.put(engine)
+
+    def warmup(self):
+        '''
+        创建全部引擎并各识别一次空白图片，完成 onnxruntime 的初始化
+        '''
+        import numpy as np
+        engines = [self._acquire() for _ in range(self.size)]
+        try:
+            for engine in engines:
+                engine(np.full((32, 32, 3), 255, dtype=np.uint8))
+        finally:
+            for engine in engines:
+                self._idle.put(engine)
+        logger.info(f"已预热 {self.size} 个 OCR 引擎")
+
+
+@lru_cache(maxsize=1)
+def get_ocr_pool() -> OCREnginePool:
+    return OCREnginePool()
+
+
+def set_ocr_pool_size(size: int):
+    '''
+    在创建引擎之前修改引擎数量，用于每次只解析一个文件的子进程
+    '''
+    get_ocr_pool().size = max(size, 1)
+
+
+@contextmanager
+def borrow_ocr():
+    with get_ocr_pool().borrow() as engine:
+        yield engine
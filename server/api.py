@@ -9,7 +9,7 @@ from configs.model_config import NLTK_DATA_PATH
 from configs.server_config import OPEN_CROSS_DOMAIN
 import argparse
 import uvicorn
-from fastapi import Body
+from fastapi import Body, Response
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.responses import RedirectResponse
 from server.chat.chat import chat
@@ -17,7 +17,7 @@ from server.chat.openai_chat import openai_chat
 from server.chat.search_engine_chat import search_engine_chat
 from server.chat.completion import completion
 from server.chat.feedback import chat_feedback
-from server.embeddings_api import embed_texts_endpoint
+from server.embeddings_api import embed_texts_endpoint, embedding_stats
 from server.llm_api import (list_running_models, list_config_models,
                             change_llm_model, stop_llm_model,
                             get_model_config, list_search_engines)
@@ -50,6 +50,13 @@ def create_app(run_mode: str = None):
             allow_headers=["*"],
         )
     mount_app_routes(app, run_mode=run_mode)
+
+    # 在后台预加载知识库与Embeddings模型
+    @app.on_event("startup")
+    async def preload_knowledge_bases():
+        from server.knowledge_base.kb_cache.preload import start_preload
+        start_preload()
+
     return app
 
 
@@ -121,6 +128,17 @@ def mount_app_routes(app: FastAPI, run_mode: str = None):
              summary="获取服务器支持的搜索引擎",
              )(list_search_engines)
 
+    @app.get("/server/health",
+             tags=["Server State"],
+             summary="服务健康检查，预加载完成前返回 503")
+    def health(response: Response) -> BaseResponse:
+        from server.knowledge_base.kb_cache.preload import get_preload_status
+        status = get_preload_status()
+        if status["status"] != "ready":
+            response.status_code = 503
+            return BaseResponse(code=503, msg="正在预加载知识库", data=status)
+        return BaseResponse(data=status)
+
     @app.post("/server/get_prompt_template",
              tags=["Server State"],
              summary="获取服务区配置的 prompt 模板")
@@ -141,15 +159,22 @@ def mount_app_routes(app: FastAPI, run_mode: str = None):
             summary="将文本向量化，支持本地模型和在线模型",
             )(embed_texts_endpoint)
 
+    app.get("/other/embedding_stats",
+            tags=["Other"],
+            response_model=BaseResponse,
+            summary="本地Embeddings模型动态批处理的统计",
+            )(embedding_stats)
+
 
 def mount_knowledge_routes(app: FastAPI):
     from server.chat.knowledge_base_chat import knowledge_base_chat
     from server.chat.file_chat import upload_temp_docs, file_chat
     from server.chat.agent_chat import agent_chat
-    from server.knowledge_base.kb_api import list_kbs, create_kb, delete_kb
+    from server.knowledge_base.kb_api import list_kbs, create_kb, delete_kb, get_cache_stats
     from server.knowledge_base.kb_doc_api import (list_files, upload_docs, delete_docs,
                                                 update_docs, download_doc, recreate_vector_store,
-                                                search_docs, DocumentWithScore, update_info)
+                                                search_docs, search_docs_batch, search_docs_federated,
+                                                DocumentWithScore, FederatedDocumentWithScore, update_info)
 
     app.post("/chat/knowledge_base_chat",
              tags=["Chat"],
@@ -194,6 +219,18 @@ def mount_knowledge_routes(app: FastAPI):
              summary="搜索知识库"
              )(search_docs)
 
+    app.post("/knowledge_base/search_docs_batch",
+             tags=["Knowledge Base Management"],
+             response_model=List[List[DocumentWithScore]],
+             summary="批量搜索知识库"
+             )(search_docs_batch)
+
+    app.post("/knowledge_base/search_docs_federated",
+             tags=["Knowledge Base Management"],
+             response_model=List[FederatedDocumentWithScore],
+             summary="同时搜索多个知识库并合并结果"
+             )(search_docs_federated)
+
     app.post("/knowledge_base/upload_docs",
              tags=["Knowledge Base Management"],
              response_model=BaseResponse,
@@ -231,6 +268,12 @@ def mount_knowledge_routes(app: FastAPI):
              summary="上传文件到临时目录，用于文件对话。"
              )(upload_temp_docs)
 
+    app.get("/knowledge_base/cache_stats",
+            tags=["Knowledge Base Management"],
+            response_model=BaseResponse,
+            summary="获取向量库与Embeddings缓存的统计信息"
+            )(get_cache_stats)
+
 
 def mount_filename_summary_routes(app: FastAPI):
     from server.knowledge_base.kb_summary_api import (summary_file_to_vector_store, recreate_summary_vector_store,
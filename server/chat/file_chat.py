@@ -126,7 +126,7 @@ async def file_chat(query: str = Body(..., description="用户输入", examples=
         )
         embed_func = EmbeddingsFunAdapter()
         embeddings = embed_func.embed_query(query)
-        with memo_faiss_pool.acquire(knowledge_id) as vs:
+        with memo_faiss_pool.acquire(knowledge_id, shared=True) as vs:
             docs = vs.similarity_search_with_score_by_vector(embeddings, k=top_k, score_threshold=score_threshold)
             docs = [x[0] for x in docs]
 
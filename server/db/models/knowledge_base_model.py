@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, func
+from sqlalchemy import Column, Integer, String, DateTime, JSON, func
 
 from server.db.base import Base
 
@@ -13,6 +13,7 @@ class KnowledgeBaseModel(Base):
     kb_info = Column(String(200), comment='知识库简介(用于Agent)')
     vs_type = Column(String(50), comment='向量库类型')
     embed_model = Column(String(50), comment='嵌入模型名称')
+    vs_options = Column(JSON, comment='向量库参数，如FAISS的降维与量化方式')
     file_count = Column(Integer, default=0, comment='文件数量')
     create_time = Column(DateTime, default=func.now(), comment='创建时间')
 
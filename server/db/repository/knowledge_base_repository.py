@@ -3,16 +3,19 @@ from server.db.session import with_session
 
 
 @with_session
-def add_kb_to_db(session, kb_name, kb_info, vs_type, embed_model):
+def add_kb_to_db(session, kb_name, kb_info, vs_type, embed_model, vs_options: dict = None):
     # 创建知识库实例
     kb = session.query(KnowledgeBaseModel).filter_by(kb_name=kb_name).first()
     if not kb:
-        kb = KnowledgeBaseModel(kb_name=kb_name, kb_info=kb_info, vs_type=vs_type, embed_model=embed_model)
+        kb = KnowledgeBaseModel(kb_name=kb_name, kb_info=kb_info, vs_type=vs_type, embed_model=embed_model,
+                                vs_options=vs_options or {})
         session.add(kb)
     else:  # update kb with new vs_type and embed_model
         kb.kb_info = kb_info
         kb.vs_type = vs_type
         kb.embed_model = embed_model
+        if vs_options is not None:
+            kb.vs_options = vs_options
     return True
 
 
@@ -57,6 +60,7 @@ def get_kb_detail(session, kb_name: str) -> dict:
             "kb_info": kb.kb_info,
             "vs_type": kb.vs_type,
             "embed_model": kb.embed_model,
+            "vs_options": kb.vs_options,
             "file_count": kb.file_count,
             "create_time": kb.create_time,
         }
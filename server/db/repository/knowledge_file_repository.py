@@ -66,6 +66,14 @@ def add_docs_to_db(session,
     return True
 
 
+@with_session
+def count_docs_from_db(session, kb_name: str, file_name: str = None) -> int:
+    query = session.query(FileDocModel).filter_by(kb_name=kb_name)
+    if file_name:
+        query = query.filter_by(file_name=file_name)
+    return query.count()
+
+
 @with_session
 def count_files_from_db(session, kb_name: str) -> int:
     return session.query(KnowledgeFileModel).filter_by(kb_name=kb_name).count()
@@ -1,9 +1,15 @@
 from langchain.docstore.document import Document
+import configs
 from configs import EMBEDDING_MODEL, logger
 from server.model_workers.base import ApiEmbeddingsParams
 from server.utils import BaseResponse, get_model_worker_config, list_embed_models, list_online_embed_models
 from fastapi import Body
-from typing import Dict, List
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, List
+
+EMBEDDING_BATCH_SIZE = getattr(configs, "EMBEDDING_BATCH_SIZE", 64)
+EMBEDDING_INGEST_BATCH_TOKENS = getattr(configs, "EMBEDDING_INGEST_BATCH_TOKENS", 8192)
+EMBEDDING_PROCESSES = getattr(configs, "EMBEDDING_PROCESSES", 0)
 
 online_embed_models = list_online_embed_models()
 
@@ -15,10 +21,39 @@ def embed_texts(
 ) -> BaseResponse:
     '''
     对文本进行向量化。返回数据格式：BaseResponse(data=List[List[float]])
-    TODO: 也许需要加入缓存机制，减少 token 消耗
+    用于查询的向量(to_query=True)会被缓存，重复的查询不再调用模型，减少计算与 token 消耗
     '''
+    from server.knowledge_base.kb_cache.embedding_cache import query_embed_cache
+
+    if not (to_query and query_embed_cache.enabled):
+        return _embed_texts(texts=texts, embed_model=embed_model, to_query=to_query)
+
+    embeddings = query_embed_cache.get_many(embed_model, to_query, texts)
+    missed = [i for i, x in enumerate(embeddings) if x is None]
+    if missed:
+        missed_texts = [texts[i] for i in missed]
+        resp = _embed_texts(texts=missed_texts, embed_model=embed_model, to_query=to_query)
+        if resp.code != 200 or resp.data is None:
+            return resp
+        query_embed_cache.set_many(embed_model, to_query, missed_texts, resp.data)
+        for i, embedding in zip(missed, resp.data):
+            embeddings[i] = embedding
+    return BaseResponse(data=embeddings)
+
+
+def _embed_texts(
+        texts: List[str],
+        embed_model: str = EMBEDDING_MODEL,
+        to_query: bool = False,
+) -> BaseResponse:
     try:
         if embed_model in list_embed_models():  # 使用本地Embeddings模型
+            # 与其它并发请求合并为一个批次。使用多进程时由进程池分发，不再合并
+            if EMBEDDING_BATCH_SIZE > 0 and EMBEDDING_PROCESSES <= 0:
+                from server.embeddings_batcher import get_embedding_batcher
+
+                return BaseResponse(data=get_embedding_batcher(embed_model).embed(texts))
+
             from server.utils import load_local_embeddings
 
             embeddings = load_local_embeddings(model=embed_model)
@@ -40,6 +75,61 @@ def embed_texts(
         return BaseResponse(code=500, msg=f"文本向量化过程中出现错误：{e}")
 
 
+def make_token_batches(texts: List[str], max_tokens: int = EMBEDDING_INGEST_BATCH_TOKENS) -> List[List[int]]:
+    '''
+    按估计的 token 数对文本排序后分批，每批 条数 * 最长文本token数 不超过 max_tokens（单条超长的文本单独成批）。
+    返回每批文本在 texts 中的下标
+    '''
+    from server.embeddings_batcher import estimate_tokens
+
+    lengths = [max(estimate_tokens(x), 1) for x in texts]
+    batches = []
+    batch = []
+    for i in sorted(range(len(texts)), key=lengths.__getitem__):
+        # 升序排列，当前文本即为加入后本批最长的文本
+        if batch and (len(batch) + 1) * lengths[i] > max_tokens:
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def embed_texts_in_batches(
+        texts: List[str],
+        embed_model: str = EMBEDDING_MODEL,
+        to_query: bool = False,
+        max_tokens: int = EMBEDDING_INGEST_BATCH_TOKENS,
+        on_progress: Callable[[int, int], None] = None,
+) -> BaseResponse:
+    '''
+    将长度相近的文本分为一批进行向量化，结果按原顺序返回。用于知识库入库等大量文本的场景。
+    on_progress(已完成数量, 总数) 在每批完成后调用
+    '''
+    embeddings = [None] * len(texts)
+    finished = 0
+
+    def embed_batch(batch: List[int]):
+        return batch, embed_texts(texts=[texts[i] for i in batch], embed_model=embed_model, to_query=to_query)
+
+    # 使用多进程Embeddings时同时提交多批，使各子进程都有任务
+    with ThreadPoolExecutor(max(EMBEDDING_PROCESSES, 1)) as pool:
+        futures = [pool.submit(embed_batch, batch) for batch in make_token_batches(texts, max_tokens)]
+        for future in as_completed(futures):
+            batch, resp = future.result()
+            if resp.code != 200 or resp.data is None:
+                for f in futures:
+                    f.cancel()
+                return resp
+            for i, embedding in zip(batch, resp.data):
+                embeddings[i] = embedding
+            finished += len(batch)
+            if on_progress is not None:
+                on_progress(finished, len(texts))
+    return BaseResponse(data=embeddings)
+
+
 def embed_texts_endpoint(
         texts: List[str] = Body(..., description="要嵌入的文本列表", examples=[["hello", "world"]]),
         embed_model: str = Body(EMBEDDING_MODEL,
@@ -52,17 +142,52 @@ def embed_texts_endpoint(
     return embed_texts(texts=texts, embed_model=embed_model, to_query=to_query)
 
 
+def embedding_stats() -> BaseResponse:
+    '''
+    本地Embeddings模型动态批处理的统计：批次大小与排队时间的直方图
+    '''
+    from server.embeddings_batcher import get_batcher_stats
+
+    return BaseResponse(data=get_batcher_stats())
+
+
 def embed_documents(
         docs: List[Document],
         embed_model: str = EMBEDDING_MODEL,
         to_query: bool = False,
+        on_progress: Callable[[int, int], None] = None,
 ) -> Dict:
     """
     将 List[Document] 向量化，转化为 VectorStore.add_embeddings 可以接受的参数
+    文本按长度分批向量化，每批完成后调用 on_progress(已完成数量, 总数)
+    开启 CHUNK_EMBED_CACHE 时，内容未变化的文本块直接复用之前保存的向量，只对新增或修改的文本块进行向量化
     """
+    from server.knowledge_base.kb_cache.embedding_cache import chunk_embed_store
+
     texts = [x.page_content for x in docs]
     metadatas = [x.metadata for x in docs]
-    embeddings = embed_texts(texts=texts, embed_model=embed_model, to_query=to_query).data
+    if to_query or chunk_embed_store is None:
+        embeddings = embed_texts_in_batches(texts=texts, embed_model=embed_model, to_query=to_query,
+                                            on_progress=on_progress).data
+    else:
+        embeddings = chunk_embed_store.get_many(embed_model, texts)
+        missed = [i for i, x in enumerate(embeddings) if x is None]
+        if missed:
+            logger.info(f"{len(texts)} 个文本块中有 {len(missed)} 个需要向量化")
+            missed_texts = [texts[i] for i in missed]
+            cached = len(texts) - len(missed)
+            data = embed_texts_in_batches(
+                texts=missed_texts, embed_model=embed_model, to_query=to_query,
+                on_progress=(lambda n, _: on_progress(cached + n, len(texts))) if on_progress else None,
+            ).data
+            if data is None:
+                embeddings = None
+            else:
+                chunk_embed_store.set_many(embed_model, missed_texts, data)
+                for i, embedding in zip(missed, data):
+                    embeddings[i] = embedding
+        elif on_progress is not None:
+            on_progress(len(texts), len(texts))
     if embeddings is not None:
         return {
             "texts": texts,
@@ -0,0 +1,191 @@
+'''
+本地Embeddings模型的动态批处理：来自各个线程、协程的向量化请求进入同一个队列，
+按最大条数、最大token数和最长等待时间合并为一个批次，只进行一次模型前向计算，再将结果分发给各个请求。
+'''
+import bisect
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Dict, List
+
+import configs
+from configs import logger, log_verbose
+
+EMBEDDING_BATCH_SIZE = getattr(configs, "EMBEDDING_BATCH_SIZE", 64)
+EMBEDDING_BATCH_MAX_TOKENS = getattr(configs, "EMBEDDING_BATCH_MAX_TOKENS", 16384)
+EMBEDDING_BATCH_WAIT = getattr(configs, "EMBEDDING_BATCH_WAIT", 0.005)
+
+
+def estimate_tokens(text: str) -> int:
+    '''
+    粗略估计token数：中文约每字一个token，按字符数计算偏保守，不依赖具体模型的tokenizer
+    '''
+    return len(text)
+
+
+class Histogram:
+    '''
+    固定分桶的直方图，buckets 为各桶的上界（包含）
+    '''
+    def __init__(self, buckets: List[float]):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.total += 1
+            self.sum += value
+
+    def to_dict(self) -> Dict:
+        with self._lock:
+            labels = [f"<={x}" for x in self.buckets] + [f">{self.buckets[-1]}"]
+            return {
+                "buckets": dict(zip(labels, self.counts)),
+                "count": self.total,
+                "avg": self.sum / self.total if self.total else 0,
+            }
+
+
+class _EmbeddingRequest:
+    __slots__ = ("texts", "tokens", "future", "enqueue_time")
+
+    def __init__(self, texts: List[str]):
+        self.texts = texts
+        self.tokens = sum(estimate_tokens(x) for x in texts)
+        self.future = Future()
+        self.enqueue_time = time.time()
+
+
+class EmbeddingBatcher:
+    def __init__(
+        self,
+        embed_model: str,
+        max_batch_size: int = EMBEDDING_BATCH_SIZE,
+        max_tokens: int = EMBEDDING_BATCH_MAX_TOKENS,
+        max_wait: float = EMBEDDING_BATCH_WAIT,
+    ):
+        '''
+        max_batch_size: 每个批次最多的文本条数。超过该值的单个请求单独成批，不会被拆分
+        max_tokens: 每个批次最多的token数（估计值）
+        max_wait: 第一个请求进入队列后，最多等待多少秒以凑成更大的批次
+        '''
+        self.embed_model = embed_model
+        self.max_batch_size = max_batch_size
+        self.max_tokens = max_tokens
+        self.max_wait = max_wait
+        self._pending: deque = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self.batch_size_hist = Histogram([1, 2, 4, 8, 16, 32, 64, 128, 256])
+        self.queue_latency_hist = Histogram([1, 5, 10, 25, 50, 100, 250, 500, 1000])  # 毫秒
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run,
+                                            name=f"embedding_batcher_{self.embed_model}",
+                                            daemon=True)
+            self._thread.start()
+
+    def submit(self, texts: List[str]) -> Future:
+        request = _EmbeddingRequest(texts)
+        with self._cond:
+            self._start()
+            self._pending.append(request)
+            self._cond.notify()
+        return request.future
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        return self.submit(texts).result()
+
+    def _pop_request(self):
+        # 调用者持有 self._cond。取出的请求标记为运行中，之后不能再被取消；已取消的请求直接丢弃
+        request = self._pending.popleft()
+        return request if request.future.set_running_or_notify_cancel() else None
+
+    def _next_batch(self) -> List[_EmbeddingRequest]:
+        with self._cond:
+            first = None
+            while first is None:
+                while not self._pending:
+                    self._cond.wait()
+                first = self._pop_request()
+            batch = [first]
+            size, tokens = len(first.texts), first.tokens
+            deadline = first.enqueue_time + self.max_wait
+            while size < self.max_batch_size and tokens < self.max_tokens:
+                if self._pending:
+                    request = self._pending[0]
+                    if (size + len(request.texts) > self.max_batch_size
+                            or tokens + request.tokens > self.max_tokens):
+                        break
+                    if self._pop_request() is not None:
+                        batch.append(request)
+                        size += len(request.texts)
+                        tokens += request.tokens
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+        return batch
+
+    def _run(self):
+        from server.utils import load_local_embeddings
+
+        while True:
+            batch = self._next_batch()
+            now = time.time()
+            texts = []
+            for request in batch:
+                self.queue_latency_hist.observe((now - request.enqueue_time) * 1000)
+                texts.extend(request.texts)
+            self.batch_size_hist.observe(len(texts))
+            try:
+                embeddings = load_local_embeddings(model=self.embed_model).embed_documents(texts)
+            except Exception as e:
+                logger.error(f"{e.__class__.__name__}: 模型 {self.embed_model} 批量向量化时出错：{e}",
+                             exc_info=e if log_verbose else None)
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            start = 0
+            for request in batch:
+                end = start + len(request.texts)
+                request.future.set_result(embeddings[start:end])
+                start = end
+
+    def stats(self) -> Dict:
+        with self._cond:
+            pending = len(self._pending)
+        return {
+            "pending": pending,
+            "max_batch_size": self.max_batch_size,
+            "max_tokens": self.max_tokens,
+            "max_wait": self.max_wait,
+            "batch_size": self.batch_size_hist.to_dict(),
+            "queue_latency_ms": self.queue_latency_hist.to_dict(),
+        }
+
+
+_batchers: Dict[str, EmbeddingBatcher] = {}
+_batchers_lock = threading.Lock()
+
+
+def get_embedding_batcher(embed_model: str) -> EmbeddingBatcher:
+    with _batchers_lock:
+        if embed_model not in _batchers:
+            _batchers[embed_model] = EmbeddingBatcher(embed_model)
+        return _batchers[embed_model]
+
+
+def get_batcher_stats() -> Dict:
+    with _batchers_lock:
+        batchers = dict(_batchers)
+    return {model: batcher.stats() for model, batcher in batchers.items()}
@@ -0,0 +1,142 @@
+'''
+多进程文档解析：unstructured、文本分割、RapidOCR、chardet 等都是受 GIL 限制的纯 Python 计算，多线程几乎没有加速。
+开启 DOC_PARSE_PROCESSES 后，files2docs_in_thread 将 KnowledgeFile 发送到常驻的子进程中完成解析与分割。
+每个子进程复用分词器、OCR 引擎与加载器模块；同时处理的文件数有上限；解析出错只影响该文件，
+子进程崩溃（如解析库段错误）时重建进程池，受影响的文件逐个重试以确定出错的文件。
+'''
+import multiprocessing as mp
+import threading
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from typing import Dict, Generator, List, Tuple
+
+from langchain.docstore.document import Document
+
+import configs
+from configs import logger, log_verbose
+
+DOC_PARSE_PROCESSES = getattr(configs, "DOC_PARSE_PROCESSES", 0)
+OCR_PRELOAD = getattr(configs, "OCR_PRELOAD", True)
+
+
+_pool: ProcessPoolExecutor = None
+_pool_lock = threading.Lock()
+_daemon_warned = False
+
+
+def _init_worker():
+    # 预先导入加载器模块，之后每个文件无需再导入
+    import langchain.document_loaders
+    import document_loaders
+    from document_loaders.mypdfloader import disable_process_pool
+    from document_loaders.ocr import set_ocr_pool_size, get_ocr_pool
+    from server.knowledge_base.utils import ocr_loader_configured
+    set_ocr_pool_size(1)  # 每个子进程同时只解析一个文件，一个 OCR 引擎即可
+    disable_process_pool()  # 已按文件并行，PDF 不再按页面分段启动子进程
+    if OCR_PRELOAD and ocr_loader_configured():
+        try:
+            get_ocr_pool().warmup()
+        except Exception as e:
+            logger.warning(f"预热 OCR 引擎失败：{e}")
+
+
+@lru_cache(maxsize=8)
+def _get_text_splitter(splitter_name: str, chunk_size: int, chunk_overlap: int):
+    # 子进程中按参数缓存分词器，避免每个文件都重新加载 tokenizer
+    from server.knowledge_base.utils import make_text_splitter
+    return make_text_splitter(splitter_name=splitter_name, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+
+def _file2docs(file, **kwargs) -> Tuple[bool, Tuple[str, str, List[Document]]]:
+    try:
+        if file.ext not in [".csv"]:
+            kwargs["text_splitter"] = _get_text_splitter(file.text_splitter_name,
+                                                         kwargs.get("chunk_size"),
+                                                         kwargs.get("chunk_overlap"))
+        return True, (file.kb_name, file.filename, file.file2text(**kwargs))
+    except Exception as e:
+        msg = f"从文件 {file.kb_name}/{file.filename} 加载文档时出错：{e}"
+        logger.error(f'{e.__class__.__name__}: {msg}',
+                     exc_info=e if log_verbose else None)
+        return False, (file.kb_name, file.filename, msg)
+
+
+def use_process_pool() -> bool:
+    '''
+    是否在子进程中解析文件。守护进程不能创建子进程（如以 daemon=True 启动的自定义服务进程），此时回退到多线程解析
+    '''
+    global _daemon_warned
+    if DOC_PARSE_PROCESSES <= 0:
+        return False
+    if mp.current_process().daemon:
+        if not _daemon_warned:
+            _daemon_warned = True
+            logger.warning("当前进程为守护进程，无法启动文档解析子进程，改为在线程中解析文件")
+        return False
+    return True
+
+
+def get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn：避免 fork 带有线程、模型与锁的 API 进程
+            _pool = ProcessPoolExecutor(max_workers=DOC_PARSE_PROCESSES,
+                                        mp_context=mp.get_context("spawn"),
+                                        initializer=_init_worker)
+            logger.info(f"已启动 {DOC_PARSE_PROCESSES} 个文档解析子进程")
+        return _pool
+
+
+def _reset_pool(broken: ProcessPoolExecutor):
+    global _pool
+    with _pool_lock:
+        if _pool is broken:
+            _pool = None
+    # 进程池已损坏，排队的任务都已失败，无需取消（cancel_futures 需要 Python 3.9）
+    broken.shutdown(wait=False)
+
+
+def files2docs_in_process(
+        params: List[Dict],
+        max_in_flight: int = None,
+) -> Generator:
+    '''
+    在子进程中解析文件，按完成顺序返回 status, (kb_name, file_name, docs | error)，与 files2docs_in_thread 一致。
+    params 为 _file2docs 的参数，其中 file 为 KnowledgeFile。同时提交的文件数不超过 max_in_flight（默认为进程数的2倍）
+    '''
+    max_in_flight = max_in_flight or DOC_PARSE_PROCESSES * 2
+    pending = list(reversed(params))
+    suspects = []  # 子进程崩溃时正在处理的文件
+    while pending or suspects:
+        # 怀疑导致崩溃的文件每次只提交一个，再次崩溃即可确定是该文件
+        queue, limit = (pending, max_in_flight) if pending else (suspects, 1)
+        pool = get_pool()
+        running = {}
+        while queue or running:
+            while queue and len(running) < limit:
+                kwargs = queue.pop()
+                running[pool.submit(_file2docs, **kwargs)] = kwargs
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            broken = False
+            for future in done:
+                kwargs = running.pop(future)
+                try:
+                    yield future.result()
+                except BrokenProcessPool:
+                    broken = True
+                    file = kwargs["file"]
+                    if limit == 1:
+                        msg = f"解析文件 {file.kb_name}/{file.filename} 时子进程异常退出"
+                        logger.error(msg)
+                        yield False, (file.kb_name, file.filename, msg)
+                    else:
+                        suspects.append(kwargs)
+            if broken:
+                logger.warning("文档解析子进程异常退出，重建进程池")
+                for future, kwargs in running.items():
+                    suspects.append(kwargs)
+                running = {}
+                _reset_pool(pool)
+                break
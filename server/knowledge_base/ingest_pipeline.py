@@ -0,0 +1,335 @@
+'''
+流水线入库：加载(解析+分割) → 向量化 → 写入向量库，各阶段在各自的线程中并行，之间通过有界队列连接。
+文件解析时 Embedding 模型不再空闲，向量化时也可以继续解析后面的文件；下游较慢时队列写满，上游自动等待（背压）。
+
+- load：INGEST_LOAD_WORKERS 个线程解析并分割文件；开启 DOC_PARSE_PROCESSES 时在解析子进程中完成
+- embed：INGEST_EMBED_WORKERS 个线程，将多个小文件的文本块合并为一批（最多 INGEST_EMBED_BATCH_SIZE 个）向量化。
+  只对支持直接写入向量的向量库(FAISS)生效，其它向量库在写入时自行向量化
+- index：单个线程依次将文件写入向量库，写入顺序与锁的行为与逐个调用 add_doc 相同
+
+超过 LAZY_LOAD_FILE_SIZE 的大文件不进入上述队列，由 run_large_files 通过 kb.add_doc_lazily 逐个流式入库。
+add_doc_lazily 会分批保存向量库，需在 kb.batch_update 之外调用，直接写入当前版本。
+
+各阶段的处理数量、忙碌时间、吞吐量与队列长度随进度事件返回，可据此判断瓶颈所在。
+'''
+import itertools
+import queue
+import threading
+import time
+from typing import Callable, Dict, Generator, List, Optional
+
+import configs
+from configs import CHUNK_SIZE, OVERLAP_SIZE, ZH_TITLE_ENHANCE, logger, log_verbose
+from server.knowledge_base.doc_process_pool import use_process_pool
+from server.knowledge_base.kb_service.base import KBService
+from server.knowledge_base.utils import KnowledgeFile
+
+DOC_PARSE_PROCESSES = getattr(configs, "DOC_PARSE_PROCESSES", 0)
+INGEST_LOAD_WORKERS = getattr(configs, "INGEST_LOAD_WORKERS", 4)
+INGEST_EMBED_WORKERS = getattr(configs, "INGEST_EMBED_WORKERS", 1)
+INGEST_EMBED_BATCH_SIZE = getattr(configs, "INGEST_EMBED_BATCH_SIZE", 256)
+INGEST_QUEUE_SIZE = getattr(configs, "INGEST_QUEUE_SIZE", 8)
+
+
+_DONE = object()
+
+
+class StageMetrics:
+    def __init__(self, name: str, workers: int):
+        self.name = name
+        self.workers = workers
+        self.files = 0
+        self.chunks = 0
+        self.busy = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, files: int, chunks: int, seconds: float):
+        with self._lock:
+            self.files += files
+            self.chunks += chunks
+            self.busy += seconds
+
+    def to_dict(self, elapsed: float, q: queue.Queue = None) -> Dict:
+        '''
+        rate：每秒处理的文本块数（按忙碌时间计算，即该阶段的处理能力）；
+        utilization：忙碌时间占比，接近1的阶段是瓶颈；queued：该阶段输入队列中等待的文件数
+        '''
+        return {
+            "files": self.files,
+            "chunks": self.chunks,
+            "busy": round(self.busy, 2),
+            "rate": round(self.chunks / self.busy * self.workers, 1) if self.busy else 0,
+            "utilization": round(min(self.busy / (elapsed * self.workers), 1.0), 2) if elapsed else 0,
+            "queued": q.qsize() if q is not None else 0,
+        }
+
+
+class IngestPipeline:
+    def __init__(
+        self,
+        kb: KBService,
+        kb_files: List[KnowledgeFile],
+        chunk_size: int = CHUNK_SIZE,
+        chunk_overlap: int = OVERLAP_SIZE,
+        zh_title_enhance: bool = ZH_TITLE_ENHANCE,
+        update: bool = False,
+        load_workers: int = INGEST_LOAD_WORKERS,
+        embed_workers: int = INGEST_EMBED_WORKERS,
+        embed_batch_size: int = INGEST_EMBED_BATCH_SIZE,
+        queue_size: int = INGEST_QUEUE_SIZE,
+    ):
+        '''
+        update：为 True 时使用 kb.update_doc（先删除再添加），否则使用 kb.add_doc。
+        写入时均不保存向量库(not_refresh_vs_cache=True)，由调用者在全部完成后保存
+        '''
+        self.kb = kb
+        self.kb_files = []
+        self.large_files = []
+        for kb_file in kb_files:
+            try:
+                large = kb_file.is_large()
+            except Exception:  # 文件不存在等，交给加载阶段报错
+                large = False
+            (self.large_files if large else self.kb_files).append(kb_file)
+        self.split_kwargs = dict(chunk_size=chunk_size, chunk_overlap=chunk_overlap, zh_title_enhance=zh_title_enhance)
+        self.update = update
+        self.in_process = use_process_pool()
+        self.load_workers = 1 if self.in_process else max(load_workers, 1)
+        self.embed_workers = max(embed_workers, 1) if kb.can_add_by_embeddings() else 1
+        self.embed_batch_size = embed_batch_size
+        self.embed_queue = queue.Queue(maxsize=queue_size)
+        self.index_queue = queue.Queue(maxsize=queue_size)
+        self.events = queue.Queue()
+        self.metrics = {
+            "load": StageMetrics("load", DOC_PARSE_PROCESSES if self.in_process else self.load_workers),
+            "embed": StageMetrics("embed", self.embed_workers),
+            "index": StageMetrics("index", 1),
+        }
+        self._stop = threading.Event()
+        self._embed_running = self.embed_workers
+        self._embed_lock = threading.Lock()
+        self._start = None
+
+    def _put(self, q: queue.Queue, item) -> bool:
+        # 队列已满时等待下游，调用者停止读取进度后不再阻塞
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q: queue.Queue):
+        # 调用者停止读取进度后返回 _DONE，各阶段随之退出
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=0.5)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def _fail(self, kb_file: KnowledgeFile, error: str):
+        self.events.put({"type": "file", "file": kb_file.filename, "status": False, "error": error})
+
+    def _load(self, files: Callable[[], Optional[KnowledgeFile]]):
+        while not self._stop.is_set() and (kb_file := files()) is not None:
+            start = time.perf_counter()
+            try:
+                docs = kb_file.file2text(**self.split_kwargs)
+            except Exception as e:
+                msg = f"从文件 {kb_file.kb_name}/{kb_file.filename} 加载文档时出错：{e}"
+                logger.error(f'{e.__class__.__name__}: {msg}',
+                             exc_info=e if log_verbose else None)
+                self._fail(kb_file, msg)
+                continue
+            self.metrics["load"].record(1, len(docs), time.perf_counter() - start)
+            if not self._put(self.embed_queue, (kb_file, docs)):
+                return
+
+    def _load_in_process(self):
+        from server.knowledge_base.doc_process_pool import files2docs_in_process
+        params = [dict(file=kb_file, **self.split_kwargs) for kb_file in self.kb_files]
+        start = time.perf_counter()
+        # 生成器在队列写满时暂停，子进程中同时解析的文件数也随之受限
+        for status, (kb_name, file_name, result) in files2docs_in_process(params):
+            self.metrics["load"].record(1, len(result) if status else 0, time.perf_counter() - start)
+            kb_file = KnowledgeFile(filename=file_name, knowledge_base_name=kb_name)
+            if not status:
+                self._fail(kb_file, result)
+            elif not self._put(self.embed_queue, (kb_file, result)):
+                return
+            start = time.perf_counter()
+
+    def _run_load(self):
+        try:
+            if self.in_process:
+                self._load_in_process()
+            else:
+                it = iter(self.kb_files)
+                lock = threading.Lock()
+
+                def next_file():
+                    with lock:
+                        return next(it, None)
+
+                threads = [threading.Thread(target=self._load, args=(next_file,), daemon=True,
+                                            name=f"ingest_load_{i}")
+                           for i in range(self.load_workers)]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+        finally:
+            for _ in range(self.embed_workers):
+                self._put(self.embed_queue, _DONE)
+
+    def _next_batch(self) -> Optional[List]:
+        # 取一个文件，再尽量合并队列中已有的文件，直到文本块数达到 embed_batch_size
+        item = self._get(self.embed_queue)
+        if item is _DONE:
+            return None
+        batch, size = [item], len(item[1])
+        while size < self.embed_batch_size:
+            try:
+                item = self.embed_queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _DONE:
+                self.embed_queue.put_nowait(_DONE)  # 留给自己的下一次调用
+                break
+            batch.append(item)
+            size += len(item[1])
+        return batch
+
+    def _run_embed(self):
+        try:
+            while (batch := self._next_batch()) is not None:
+                if not self.kb.can_add_by_embeddings():  # 由向量库在写入时向量化
+                    for item in batch:
+                        if not self._put(self.index_queue, (*item, None)):
+                            return
+                    continue
+                docs = list(itertools.chain.from_iterable(docs for _, docs in batch))
+                names = ", ".join(kb_file.filename for kb_file, _ in batch)
+
+                def on_progress(finished: int, total: int):
+                    self.events.put({"type": "embed", "file": names, "embedded": finished, "embed_total": total})
+
+                start = time.perf_counter()
+                try:
+                    data = self.kb._docs_to_embeddings(docs, on_progress=on_progress)
+                    if data is None:
+                        raise RuntimeError("Embeddings 模型未返回结果")
+                except Exception as e:
+                    msg = f"向量化文件 {names} 时出错：{e}"
+                    logger.error(f'{e.__class__.__name__}: {msg}',
+                                 exc_info=e if log_verbose else None)
+                    for kb_file, _ in batch:
+                        self._fail(kb_file, msg)
+                    continue
+                self.metrics["embed"].record(len(batch), len(docs), time.perf_counter() - start)
+                # 按文件拆分向量化结果
+                offset = 0
+                for kb_file, file_docs in batch:
+                    end = offset + len(file_docs)
+                    embedded = {k: v[offset:end] for k, v in data.items()}
+                    offset = end
+                    if not self._put(self.index_queue, (kb_file, file_docs, embedded)):
+                        return
+        finally:
+            with self._embed_lock:
+                self._embed_running -= 1
+                last = self._embed_running == 0
+            if last:
+                self._put(self.index_queue, _DONE)
+
+    def _run_index(self):
+        try:
+            while (item := self._get(self.index_queue)) is not _DONE:
+                kb_file, docs, embedded = item
+                start = time.perf_counter()
+                try:
+                    kb_file.splited_docs = docs
+                    kwargs = {"not_refresh_vs_cache": True}
+                    if embedded is not None:
+                        kwargs["embedded"] = embedded
+                    if self.update:
+                        self.kb.update_doc(kb_file, **kwargs)
+                    else:
+                        self.kb.add_doc(kb_file, **kwargs)
+                except Exception as e:
+                    msg = f"将文件 {kb_file.filename} 写入知识库 {self.kb.kb_name} 时出错：{e}"
+                    logger.error(f'{e.__class__.__name__}: {msg}',
+                                 exc_info=e if log_verbose else None)
+                    self._fail(kb_file, msg)
+                    continue
+                self.metrics["index"].record(1, len(docs), time.perf_counter() - start)
+                self.events.put({"type": "file", "file": kb_file.filename, "status": True, "docs_count": len(docs)})
+        finally:
+            self.events.put(_DONE)
+
+    def _index_lazily(self, kb_file: KnowledgeFile) -> Generator[Dict, None, None]:
+        # 加载、向量化与写入都在 add_doc_lazily 中按批完成，耗时计入 index 阶段
+        start = time.perf_counter()
+        progress = {"loaded": 0, "chunks": 0}
+        try:
+            # 调用者停止读取时生成器在保存后的位置关闭，已写入的部分记录了进度，下次从此处继续
+            for progress in self.kb.add_doc_lazily(kb_file, **self.split_kwargs):
+                yield {"type": "lazy", "file": kb_file.filename, **progress}
+        except Exception as e:
+            msg = f"将文件 {kb_file.filename} 写入知识库 {self.kb.kb_name} 时出错：{e}"
+            logger.error(f'{e.__class__.__name__}: {msg}',
+                         exc_info=e if log_verbose else None)
+            yield {"type": "file", "file": kb_file.filename, "status": False, "error": msg}
+            return
+        self.metrics["index"].record(1, progress["chunks"], time.perf_counter() - start)
+        yield {"type": "file", "file": kb_file.filename, "status": True, "docs_count": progress["chunks"]}
+
+    def stats(self) -> Dict:
+        elapsed = time.perf_counter() - self._start if self._start else 0
+        return {
+            "elapsed": round(elapsed, 2),
+            "load": self.metrics["load"].to_dict(elapsed),
+            "embed": self.metrics["embed"].to_dict(elapsed, self.embed_queue),
+            "index": self.metrics["index"].to_dict(elapsed, self.index_queue),
+        }
+
+    def run(self) -> Generator[Dict, None, None]:
+        '''
+        启动各阶段并返回进度事件，每个事件都带有 stats 字段（各阶段指标）：
+        {"type": "file", "file": 文件名, "status": True, "docs_count": 文本块数} 文件已写入知识库
+        {"type": "file", "file": 文件名, "status": False, "error": 错误信息} 文件处理失败，已跳过
+        {"type": "embed", "file": 文件名, "embedded": 已向量化, "embed_total": 总数} 向量化进度
+        除大文件外的所有文件处理完成后结束，大文件由 run_large_files 写入。调用者提前停止读取时，各阶段在处理完当前文件后退出
+        '''
+        self._start = time.perf_counter()
+        threads = [threading.Thread(target=self._run_load, daemon=True, name="ingest_load")]
+        threads += [threading.Thread(target=self._run_embed, daemon=True, name=f"ingest_embed_{i}")
+                    for i in range(self.embed_workers)]
+        index_thread = threading.Thread(target=self._run_index, daemon=True, name="ingest_index")
+        threads.append(index_thread)
+        for t in threads:
+            t.start()
+        try:
+            while (event := self.events.get()) is not _DONE:
+                event["stats"] = self.stats()
+                yield event
+        finally:
+            self._stop.set()
+            # 等待正在写入的文件完成，避免调用者在写入过程中保存或发布向量库
+            index_thread.join()
+
+    def run_large_files(self) -> Generator[Dict, None, None]:
+        '''
+        逐个流式写入大文件，返回的事件格式与 run 相同，另有
+        {"type": "lazy", "file": 文件名, "loaded": 已读取的文档数, "chunks": 已写入的文本块数} 大文件流式入库进度。
+        add_doc_lazily 每写入若干批就保存向量库并记录进度，需在 kb.batch_update 之外调用：
+        否则保存到磁盘的是尚未发布的副本，出错时也无法回滚到已保存的状态
+        '''
+        if self._start is None:
+            self._start = time.perf_counter()
+        for kb_file in self.large_files:
+            for event in self._index_lazily(kb_file):
+                event["stats"] = self.stats()
+                yield event
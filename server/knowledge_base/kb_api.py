@@ -5,6 +5,7 @@ from server.knowledge_base.kb_service.base import KBServiceFactory
 from server.db.repository.knowledge_base_repository import list_kbs_from_db
 from configs import EMBEDDING_MODEL, logger, log_verbose
 from fastapi import Body
+from typing import Dict
 
 
 def list_kbs():
@@ -15,6 +16,10 @@ def list_kbs():
 def create_kb(knowledge_base_name: str = Body(..., examples=["samples"]),
             vector_store_type: str = Body("faiss"),
             embed_model: str = Body(EMBEDDING_MODEL),
+            vs_options: Dict = Body(None, description="向量库参数，为空时使用配置中的默认值。"
+                                                      "FAISS支持 dim_reduction(pca/truncate), reduced_dim, quantization(fp16/int8), "
+                                                      "index_factory, num_shards",
+                                    examples=[{"dim_reduction": "pca", "reduced_dim": 256, "quantization": "fp16"}]),
             ) -> BaseResponse:
     # Create selected knowledge base
     if not validate_kb_name(knowledge_base_name):
@@ -27,6 +32,8 @@ def create_kb(knowledge_base_name: str = Body(..., examples=["samples"]),
         return BaseResponse(code=404, msg=f"已存在同名知识库 {knowledge_base_name}")
 
     kb = KBServiceFactory.get_service(knowledge_base_name, vector_store_type, embed_model)
+    if vs_options is not None:
+        kb.vs_options = vs_options
     try:
         kb.create_kb()
     except Exception as e:
@@ -63,3 +70,20 @@ def delete_kb(
         return BaseResponse(code=500, msg=msg)
 
     return BaseResponse(code=500, msg=f"删除知识库失败 {knowledge_base_name}")
+
+
+def get_cache_stats() -> BaseResponse:
+    '''
+    获取向量库、Embeddings与查询向量缓存的统计信息：命中/未命中/移除次数、估算内存、锁等待等
+    '''
+    from server.knowledge_base.kb_cache.base import embeddings_pool
+    from server.knowledge_base.kb_cache.faiss_cache import kb_faiss_pool, memo_faiss_pool
+    from server.knowledge_base.kb_cache.embedding_cache import query_embed_cache, chunk_embed_store
+
+    return BaseResponse(data={
+        "kb_faiss_pool": kb_faiss_pool.stats(),
+        "memo_faiss_pool": memo_faiss_pool.stats(),
+        "embeddings_pool": embeddings_pool.stats(),
+        "query_embed_cache": query_embed_cache.stats(),
+        "chunk_embed_store": chunk_embed_store.stats() if chunk_embed_store else None,
+    })
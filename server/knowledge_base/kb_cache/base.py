@@ -1,12 +1,78 @@
 from langchain.embeddings.base import Embeddings
 from langchain.vectorstores.faiss import FAISS
+import multiprocessing as mp
 import threading
-from configs import (EMBEDDING_MODEL, CHUNK_SIZE,
-                    logger, log_verbose)
+import time
+import configs
+from configs import EMBEDDING_MODEL, CHUNK_SIZE, logger, log_verbose
 from server.utils import embedding_device, get_model_path, list_online_embed_models
 from contextlib import contextmanager
 from collections import OrderedDict
-from typing import List, Any, Union, Tuple
+from typing import List, Any, Union, Tuple, Dict, Optional
+
+EMBEDDING_BACKEND = getattr(configs, "EMBEDDING_BACKEND", {})
+EMBEDDING_PROCESSES = getattr(configs, "EMBEDDING_PROCESSES", 0)
+
+
+class RWLock:
+    '''
+    读写锁：读锁可被多个线程同时持有，写锁独占。
+    写锁可重入，持有写锁的线程也可以获取读锁；不支持从读锁升级为写锁。
+    有写者等待时，新的读者会排队，避免写者饿死。
+    '''
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers: Dict[int, int] = {}
+        self._writer: Optional[int] = None
+        self._writer_count = 0
+        self._writers_waiting = 0
+
+    def acquire_read(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me or me in self._readers:
+                self._readers[me] = self._readers.get(me, 0) + 1
+                return
+            while self._writer is not None or self._writers_waiting:
+                self._cond.wait()
+            self._readers[me] = 1
+
+    def release_read(self):
+        me = threading.get_ident()
+        with self._cond:
+            count = self._readers[me] - 1
+            if count:
+                self._readers[me] = count
+            else:
+                del self._readers[me]
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._writer_count += 1
+                return
+            if me in self._readers:
+                raise RuntimeError("不支持从读锁升级为写锁")
+            self._writers_waiting += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+            finally:
+                self._writers_waiting -= 1
+            self._writer = me
+            self._writer_count = 1
+
+    def is_writer(self) -> bool:
+        return self._writer == threading.get_ident()
+
+    def release_write(self):
+        with self._cond:
+            self._writer_count -= 1
+            if self._writer_count == 0:
+                self._writer = None
+                self._cond.notify_all()
 
 
 class ThreadSafeObject:
@@ -14,8 +80,18 @@ class ThreadSafeObject:
         self._obj = obj
         self._key = key
         self._pool = pool
-        self._lock = threading.RLock()
+        self._lock = RWLock()
         self._loaded = threading.Event()
+        self._stats_lock = threading.Lock()
+        self._holders = 0
+        # 从缓存中移除时仍被持有，由最后一个持有者释放时 close
+        self._close_pending = False
+        self._memory_size = None
+        # 等待锁的次数与时长(秒)，用于观察锁竞争
+        self._lock_stats = {
+            "shared": {"count": 0, "wait": 0.0, "max_wait": 0.0},
+            "exclusive": {"count": 0, "wait": 0.0, "max_wait": 0.0},
+        }
 
     def __repr__(self) -> str:
         cls = type(self).__name__
@@ -25,20 +101,115 @@ class ThreadSafeObject:
     def key(self):
         return self._key
 
+    @property
+    def lock_stats(self) -> Dict:
+        with self._stats_lock:
+            return {k: v.copy() for k, v in self._lock_stats.items()}
+
+    @property
+    def in_use(self) -> bool:
+        '''
+        正在加载或被某个线程持有、等待（读或写）时不能从缓存中移除
+        '''
+        return self._holders > 0 or not self._loaded.is_set()
+
+    def memory_size(self) -> int:
+        '''
+        估算对象占用的内存（字节）。默认统计 torch 模型（如 Embeddings.client）的参数与缓冲区，无法估算时返回 0。
+        '''
+        if self._obj is None:
+            return 0
+        if self._memory_size is None:
+            if callable(getattr(self._obj, "memory_size", None)):
+                self._memory_size = self._obj.memory_size()
+                return self._memory_size
+            size = 0
+            module = getattr(self._obj, "client", self._obj)
+            try:
+                for t in list(module.parameters()) + list(module.buffers()):
+                    size += t.numel() * t.element_size()
+            except Exception:
+                pass
+            self._memory_size = size
+        return self._memory_size
+
     @contextmanager
-    def acquire(self, owner: str = "", msg: str = "") -> FAISS:
+    def acquire(self, owner: str = "", msg: str = "", shared: bool = False) -> FAISS:
+        '''
+        shared=True 时获取读锁（如检索），可与其它读者并发；否则获取独占的写锁（如增删文档、保存）。
+        '''
         owner = owner or f"thread {threading.get_native_id()}"
+        mode = "shared" if shared else "exclusive"
+        # 等待锁期间也计为持有，避免在获得锁之前被移除并关闭
+        with self._stats_lock:
+            self._holders += 1
+        start = time.perf_counter()
+        try:
+            self._acquire_lock(shared)
+        except BaseException:
+            self._release_holder()
+            raise
+        wait = time.perf_counter() - start
+        with self._stats_lock:
+            stats = self._lock_stats[mode]
+            stats["count"] += 1
+            stats["wait"] += wait
+            stats["max_wait"] = max(stats["max_wait"], wait)
         try:
-            self._lock.acquire()
             if self._pool is not None:
-                self._pool._cache.move_to_end(self.key)
+                with self._pool.atomic:  # 可能已被移出缓存
+                    if self._pool._cache.get(self.key) is self:
+                        self._pool._cache.move_to_end(self.key)
             if log_verbose:
-                logger.info(f"{owner} 开始操作：{self.key}。{msg}")
+                logger.info(f"{owner} 开始操作：{self.key}。{msg}，等待锁 {wait:.3f}s")
             yield self._obj
         finally:
             if log_verbose:
                 logger.info(f"{owner} 结束操作：{self.key}。{msg}")
-            self._lock.release()
+            self._release_lock(shared)
+            self._release_holder()
+            if not shared and self._pool is not None:  # 写入或加载可能改变了占用的内存
+                self._pool._check_count()
+
+    def _release_holder(self):
+        with self._stats_lock:
+            self._holders -= 1
+            close = self._close_pending and self._holders == 0
+            if close:
+                self._close_pending = False
+        if close:
+            self.close()
+
+    def close_when_idle(self):
+        '''
+        从缓存中移除时调用：没有线程持有时立即 close，否则推迟到最后一个持有者释放时
+        '''
+        with self._stats_lock:
+            self._close_pending = self._holders > 0
+        if not self._close_pending:
+            self.close()
+
+    def _acquire_lock(self, shared: bool = False):
+        if shared:
+            self._lock.acquire_read()
+        else:
+            self._lock.acquire_write()
+
+    def _release_lock(self, shared: bool = False):
+        if shared:
+            self._lock.release_read()
+        else:
+            self._lock.release_write()
+
+    def close(self):
+        '''
+        从缓存中移除后释放对象持有的资源（连接、子进程等）。默认调用对象的 close 方法（如果有）
+        '''
+        if callable(close := getattr(self._obj, "close", None)):
+            try:
+                close()
+            except Exception as e:
+                logger.warning(f"释放 {self.key} 的资源时出错：{e}")
 
     def start_loading(self):
         self._loaded.clear()
@@ -59,18 +230,67 @@ class ThreadSafeObject:
 
 
 class CachePool:
-    def __init__(self, cache_num: int = -1):
+    def __init__(self, cache_num: int = -1, max_memory: int = -1):
+        '''
+        cache_num: 最多缓存的对象数量，<=0 不限制
+        max_memory: 缓存对象估算内存的上限（字节），<=0 不限制
+        超出限制时按 LRU 顺序移除对象，正在使用的对象不会被移除
+        '''
         self._cache_num = cache_num
+        self._max_memory = max_memory
         self._cache = OrderedDict()
         self.atomic = threading.RLock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0}
 
     def keys(self) -> List[str]:
         return list(self._cache.keys())
 
+    def _count_access(self, hit: bool):
+        with self.atomic:
+            self._stats["hits" if hit else "misses"] += 1
+
+    def memory_size(self) -> int:
+        return sum(v.memory_size() for v in list(self._cache.values())
+                   if isinstance(v, ThreadSafeObject))
+
+    def _over_limit(self) -> bool:
+        if isinstance(self._cache_num, int) and 0 < self._cache_num < len(self._cache):
+            return True
+        if self._max_memory and self._max_memory > 0 and self.memory_size() > self._max_memory:
+            return True
+        return False
+
     def _check_count(self):
-        if isinstance(self._cache_num, int) and self._cache_num > 0:
-            while len(self._cache) > self._cache_num:
-                self._cache.popitem(last=False)
+        evicted = []
+        with self.atomic:
+            while self._over_limit():
+                for key, item in self._cache.items():
+                    if not (isinstance(item, ThreadSafeObject) and item.in_use):
+                        break
+                else:  # 所有对象都在使用中，等它们释放后再检查
+                    break
+                evicted.append(self._cache.pop(key))
+                self._stats["evictions"] += 1
+                logger.info(f"已从缓存中移除：{key}")
+        for item in evicted:
+            if isinstance(item, ThreadSafeObject):
+                item.close_when_idle()
+
+    def stats(self) -> Dict:
+        '''
+        缓存统计：命中/未命中/移除次数、对象数量、估算内存与各对象的锁等待
+        '''
+        with self.atomic:
+            return {
+                **self._stats,
+                "count": len(self._cache),
+                "cache_num": self._cache_num,
+                "memory_size": self.memory_size(),
+                "max_memory": self._max_memory,
+                "items": {str(k): {"memory_size": v.memory_size(), "in_use": v.in_use}
+                          for k, v in self._cache.items() if isinstance(v, ThreadSafeObject)},
+                "lock_stats": self.lock_stats(),
+            }
 
     def get(self, key: str) -> ThreadSafeObject:
         if cache := self._cache.get(key):
@@ -84,20 +304,30 @@ class CachePool:
 
     def pop(self, key: str = None) -> ThreadSafeObject:
         if key is None:
-            return self._cache.popitem(last=False)
+            ret = self._cache.popitem(last=False)
+            item = ret[1]
         else:
-            return self._cache.pop(key, None)
+            ret = item = self._cache.pop(key, None)
+        if isinstance(item, ThreadSafeObject):
+            item.close_when_idle()
+        return ret
 
-    def acquire(self, key: Union[str, Tuple], owner: str = "", msg: str = ""):
+    def acquire(self, key: Union[str, Tuple], owner: str = "", msg: str = "", shared: bool = False):
         cache = self.get(key)
         if cache is None:
             raise RuntimeError(f"请求的资源 {key} 不存在")
         elif isinstance(cache, ThreadSafeObject):
-            self._cache.move_to_end(key)
-            return cache.acquire(owner=owner, msg=msg)
+            return cache.acquire(owner=owner, msg=msg, shared=shared)  # acquire 中移到 LRU 末尾
         else:
             return cache
 
+    def lock_stats(self) -> Dict[str, Dict]:
+        '''
+        各缓存对象的锁等待统计：{key: {"shared": {...}, "exclusive": {...}}}
+        '''
+        return {str(k): v.lock_stats for k, v in list(self._cache.items())
+                if isinstance(v, ThreadSafeObject)}
+
     def load_kb_embeddings(
         self,
         kb_name: str,
@@ -116,6 +346,20 @@ class CachePool:
             return embeddings_pool.load_embeddings(model=embed_model, device=embed_device)
 
 
+def bge_query_instruction(model: str) -> str:
+    if 'bge-' not in model or model == "bge-large-zh-noinstruct":
+        return ""
+    if 'zh' in model:
+        # for chinese model
+        return "为这个句子生成表示以用于检索相关文章："
+    elif 'en' in model:
+        # for english model
+        return "Represent this sentence for searching relevant passages:"
+    else:
+        # maybe ReRanker or else, just use empty string instead
+        return ""
+
+
 class EmbeddingsPool(CachePool):
     def load_embeddings(self, model: str = None, device: str = None) -> Embeddings:
         self.atomic.acquire()
@@ -123,39 +367,59 @@ class EmbeddingsPool(CachePool):
         device = embedding_device()
         key = (model, device)
         if not self.get(key):
+            self._count_access(hit=False)
             item = ThreadSafeObject(key, pool=self)
             self.set(key, item)
             with item.acquire(msg="初始化"):
                 self.atomic.release()
-                if model == "text-embedding-ada-002":  # openai text-embedding-ada-002
-                    from langchain.embeddings.openai import OpenAIEmbeddings
-                    embeddings = OpenAIEmbeddings(model_name=model,
-                                                  openai_api_key=get_model_path(model),
-                                                  chunk_size=CHUNK_SIZE)
-                elif 'bge-' in model:
-                    from langchain.embeddings import HuggingFaceBgeEmbeddings
-                    if 'zh' in model:
-                        # for chinese model
-                        query_instruction = "为这个句子生成表示以用于检索相关文章："
-                    elif 'en' in model:
-                        # for english model
-                        query_instruction = "Represent this sentence for searching relevant passages:"
-                    else:
-                        # maybe ReRanker or else, just use empty string instead
-                        query_instruction = ""
-                    embeddings = HuggingFaceBgeEmbeddings(model_name=get_model_path(model),
-                                                          model_kwargs={'device': device},
-                                                          query_instruction=query_instruction)             
-                    if model == "bge-large-zh-noinstruct":  # bge large -noinstruct embedding
-                        embeddings.query_instruction = ""
+                use_processes = EMBEDDING_PROCESSES > 0 and device == "cpu" and model != "text-embedding-ada-002"
+                if use_processes and mp.current_process().daemon:
+                    # 守护进程不能再创建子进程（startup.py 以非守护进程运行API服务，不受影响）
+                    logger.warning(f"当前进程为守护进程，无法启动Embeddings子进程，在当前进程中加载模型 {model}")
+                    use_processes = False
+                if use_processes:
+                    # 在多个子进程中各加载一份模型，按批分发文本
+                    from server.knowledge_base.kb_cache.embedding_process_pool import ProcessPoolEmbeddings
+                    embeddings = ProcessPoolEmbeddings(model=model, device=device, num_workers=EMBEDDING_PROCESSES)
                 else:
-                    from langchain.embeddings.huggingface import HuggingFaceEmbeddings
-                    embeddings = HuggingFaceEmbeddings(model_name=get_model_path(model), model_kwargs={'device': device})
+                    embeddings = self.create_embeddings(model, device)
                 item.obj = embeddings
                 item.finish_loading()
         else:
+            self._count_access(hit=True)
             self.atomic.release()
         return self.get(key).obj
 
+    @staticmethod
+    def create_embeddings(model: str, device: str) -> Embeddings:
+        '''
+        在当前进程中加载模型，不经过缓存
+        '''
+        if model == "text-embedding-ada-002":  # openai text-embedding-ada-002
+            from langchain.embeddings.openai import OpenAIEmbeddings
+            embeddings = OpenAIEmbeddings(model_name=model,
+                                          openai_api_key=get_model_path(model),
+                                          chunk_size=CHUNK_SIZE)
+        elif EMBEDDING_BACKEND.get(model, "torch") in ["onnx", "onnx-int8"]:
+            from server.knowledge_base.kb_cache.onnx_embeddings import OnnxEmbeddings
+            embeddings = OnnxEmbeddings(model_name=model,
+                                        model_path=get_model_path(model),
+                                        quantize=EMBEDDING_BACKEND[model] == "onnx-int8",
+                                        device=device,
+                                        normalize='bge-' in model,
+                                        query_instruction=bge_query_instruction(model))
+        elif 'bge-' in model:
+            from langchain.embeddings import HuggingFaceBgeEmbeddings
+            query_instruction = bge_query_instruction(model)
+            embeddings = HuggingFaceBgeEmbeddings(model_name=get_model_path(model),
+                                                  model_kwargs={'device': device},
+                                                  query_instruction=query_instruction)
+            if model == "bge-large-zh-noinstruct":  # bge large -noinstruct embedding
+                embeddings.query_instruction = ""
+        else:
+            from langchain.embeddings.huggingface import HuggingFaceEmbeddings
+            embeddings = HuggingFaceEmbeddings(model_name=get_model_path(model), model_kwargs={'device': device})
+        return embeddings
+
 
 embeddings_pool = EmbeddingsPool(cache_num=1)
@@ -0,0 +1,239 @@
+'''
+向量缓存。
+EmbeddingCache：查询向量缓存，以 (模型键, to_query, 规范化后的文本) 为键缓存 embed_texts 的结果，
+避免重复查询反复调用Embeddings模型或在线API。内存中为带过期时间的LRU，可选使用 sqlite 作为磁盘缓存，
+重启后仍然有效，并可在多个进程之间共享。
+ChunkEmbeddingStore：文档向量的持久化存储，以 (模型键, sha256(文本)) 为键，
+重新向量化知识库时，内容未变化的文本块直接复用之前的向量。
+模型键见 model_key：同一模型使用不同的后端、量化或归一化方式时，输出的向量不同，不能共用缓存。
+'''
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+import configs
+from configs import KB_ROOT_PATH, logger
+
+QUERY_EMBED_CACHE_SIZE = getattr(configs, "QUERY_EMBED_CACHE_SIZE", 10000)
+QUERY_EMBED_CACHE_TTL = getattr(configs, "QUERY_EMBED_CACHE_TTL", 24 * 3600)
+QUERY_EMBED_CACHE_DISK = getattr(configs, "QUERY_EMBED_CACHE_DISK", False)
+CHUNK_EMBED_CACHE = getattr(configs, "CHUNK_EMBED_CACHE", False)
+EMBEDDING_BACKEND = getattr(configs, "EMBEDDING_BACKEND", {})
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(text.split())
+
+
+def model_key(embed_model: str) -> str:
+    '''
+    缓存中使用的模型键：模型名称 + 后端 + 是否 int8 量化 + 是否归一化，与 EmbeddingsPool.create_embeddings 的加载方式一致
+    '''
+    backend = EMBEDDING_BACKEND.get(embed_model, "torch")
+    quantize = backend == "onnx-int8"
+    normalize = "bge-" in embed_model  # bge 模型在 torch 与 onnx 后端都输出归一化的向量
+    return f"{embed_model}@{backend.split('-')[0]}/q{int(quantize)}/n{int(normalize)}"
+
+
+class EmbeddingCache:
+    def __init__(
+        self,
+        max_size: int = 10000,
+        ttl: float = -1,
+        disk_path: str = None,
+    ):
+        '''
+        max_size: 内存中最多缓存的向量数量，<=0 表示不使用缓存
+        ttl: 过期时间（秒），<=0 表示不过期
+        disk_path: sqlite 文件路径，为 None 时不使用磁盘缓存
+        '''
+        self.max_size = max_size
+        self.ttl = ttl
+        self.disk_path = disk_path
+        self._cache: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stats = {"hits": 0, "disk_hits": 0, "misses": 0}
+        if disk_path:
+            self._prune_disk()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    @staticmethod
+    def make_key(embed_model: str, to_query: bool, text: str) -> str:
+        return f"{model_key(embed_model)}\x00{int(bool(to_query))}\x00{normalize_text(text)}"
+
+    def _expired(self, create_time: float) -> bool:
+        return self.ttl > 0 and time.time() - create_time > self.ttl
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.disk_path, timeout=30, check_same_thread=False)
+            conn.execute("CREATE TABLE IF NOT EXISTS embeddings "
+                         "(key TEXT PRIMARY KEY, embedding BLOB, create_time REAL)")
+            self._local.conn = conn
+        return conn
+
+    def _prune_disk(self):
+        if self.ttl > 0:
+            try:
+                with self._conn() as conn:
+                    conn.execute("DELETE FROM embeddings WHERE create_time < ?", (time.time() - self.ttl,))
+            except Exception as e:
+                logger.warning(f"清理磁盘向量缓存失败：{e}")
+
+    def _get_from_disk(self, key: str) -> Optional[Tuple[np.ndarray, float]]:
+        try:
+            row = self._conn().execute("SELECT embedding, create_time FROM embeddings WHERE key = ?",
+                                       (key,)).fetchone()
+        except Exception as e:
+            logger.warning(f"读取磁盘向量缓存失败：{e}")
+            return None
+        if row is not None and not self._expired(row[1]):
+            return np.frombuffer(row[0], dtype=np.float32), row[1]
+
+    def get_many(self, embed_model: str, to_query: bool, texts: List[str]) -> List[Optional[List[float]]]:
+        '''
+        返回与 texts 一一对应的向量，未命中的为 None
+        '''
+        result = []
+        for text in texts:
+            key = self.make_key(embed_model, to_query, text)
+            with self._lock:
+                value = self._cache.get(key)
+                if value is not None and self._expired(value[1]):
+                    del self._cache[key]
+                    value = None
+                if value is not None:
+                    self._cache.move_to_end(key)
+                    self._stats["hits"] += 1
+            if value is None and self.disk_path:
+                value = self._get_from_disk(key)
+                if value is not None:
+                    with self._lock:
+                        self._stats["disk_hits"] += 1
+                    self._set(key, *value)
+            if value is None:
+                with self._lock:
+                    self._stats["misses"] += 1
+            result.append(None if value is None else value[0].tolist())
+        return result
+
+    def _set(self, key: str, embedding: np.ndarray, create_time: float):
+        with self._lock:
+            self._cache[key] = (embedding, create_time)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+    def set_many(self, embed_model: str, to_query: bool, texts: List[str], embeddings: List[List[float]]):
+        now = time.time()
+        rows = []
+        for text, embedding in zip(texts, embeddings):
+            key = self.make_key(embed_model, to_query, text)
+            embedding = np.asarray(embedding, dtype=np.float32)
+            self._set(key, embedding, now)
+            rows.append((key, embedding.tobytes(), now))
+        if self.disk_path and rows:
+            try:
+                with self._conn() as conn:
+                    conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)", rows)
+            except Exception as e:
+                logger.warning(f"写入磁盘向量缓存失败：{e}")
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            total = sum(self._stats.values())
+            return {
+                **self._stats,
+                "hit_rate": (self._stats["hits"] + self._stats["disk_hits"]) / total if total else 0,
+                "size": len(self._cache),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "disk_path": self.disk_path,
+            }
+
+
+class ChunkEmbeddingStore:
+    '''
+    以 sqlite 保存的文档向量，键为 (model_key(embed_model), sha256(text))。只增不减，删除文件后对应的向量仍会保留，
+    需要时可直接删除数据库文件。
+    '''
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0}
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute("CREATE TABLE IF NOT EXISTS embeddings "
+                         "(model TEXT, hash TEXT, embedding BLOB, PRIMARY KEY (model, hash))")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def hash_text(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get_many(self, embed_model: str, texts: List[str], batch_size: int = 500) -> List[Optional[List[float]]]:
+        '''
+        返回与 texts 一一对应的向量，未保存的为 None
+        '''
+        hashes = [self.hash_text(x) for x in texts]
+        found = {}
+        try:
+            conn = self._conn()
+            unique = list(set(hashes))
+            for i in range(0, len(unique), batch_size):
+                batch = unique[i: i + batch_size]
+                sql = ("SELECT hash, embedding FROM embeddings WHERE model = ? AND hash IN "
+                       f"({','.join('?' * len(batch))})")
+                for hash, embedding in conn.execute(sql, [model_key(embed_model), *batch]):
+                    found[hash] = embedding
+        except Exception as e:
+            logger.warning(f"读取文档向量缓存失败：{e}")
+        result = [np.frombuffer(found[h], dtype=np.float32).tolist() if h in found else None for h in hashes]
+        with self._stats_lock:
+            hits = sum(1 for x in result if x is not None)
+            self._stats["hits"] += hits
+            self._stats["misses"] += len(result) - hits
+        return result
+
+    def set_many(self, embed_model: str, texts: List[str], embeddings: List[List[float]]):
+        key = model_key(embed_model)
+        rows = [(key, self.hash_text(text), np.asarray(embedding, dtype=np.float32).tobytes())
+                for text, embedding in zip(texts, embeddings)]
+        try:
+            with self._conn() as conn:
+                conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)", rows)
+        except Exception as e:
+            logger.warning(f"写入文档向量缓存失败：{e}")
+
+    def stats(self) -> Dict:
+        with self._stats_lock:
+            return {**self._stats, "path": self.path}
+
+
+query_embed_cache = EmbeddingCache(
+    max_size=QUERY_EMBED_CACHE_SIZE,
+    ttl=QUERY_EMBED_CACHE_TTL,
+    disk_path=os.path.join(KB_ROOT_PATH, "query_embed_cache.db") if QUERY_EMBED_CACHE_DISK else None,
+)
+
+chunk_embed_store = ChunkEmbeddingStore(os.path.join(KB_ROOT_PATH, "chunk_embed_cache.db")) if CHUNK_EMBED_CACHE else None
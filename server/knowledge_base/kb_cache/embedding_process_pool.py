@@ -0,0 +1,200 @@
+'''
+多进程Embeddings：启动多个子进程，每个子进程绑定一组CPU核心并加载一份模型，
+文本按批分发给空闲的子进程，向量直接写入父进程创建的共享内存，避免序列化 float32 数组。
+适合只有CPU、核心较多的机器批量入库。
+'''
+import atexit
+import itertools
+import math
+import multiprocessing as mp
+import os
+import threading
+from multiprocessing import shared_memory
+from typing import Dict, List
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+from configs import logger
+
+
+def _worker_main(model: str, device: str, cores: List[int], task_queue: mp.Queue, result_queue: mp.Queue):
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    try:
+        import torch
+        torch.set_num_threads(max(len(cores), 1))
+    except ImportError:
+        pass
+    from server.knowledge_base.kb_cache.base import EmbeddingsPool
+
+    try:
+        embeddings = EmbeddingsPool.create_embeddings(model, device)
+        dim = len(embeddings.embed_documents(["warmup"])[0])
+        result_queue.put(("ready", os.getpid(), dim))
+    except Exception as e:
+        result_queue.put(("failed", os.getpid(), f"{e.__class__.__name__}: {e}"))
+        return
+
+    while (task := task_queue.get()) is not None:
+        call_id, shm_name, offset, texts = task
+        error = None
+        try:
+            data = np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+            shm = shared_memory.SharedMemory(name=shm_name)
+            try:
+                out = np.ndarray((len(texts), dim), dtype=np.float32, buffer=shm.buf, offset=offset * dim * 4)
+                out[:] = data
+                del out
+            finally:
+                shm.close()
+        except Exception as e:
+            error = f"{e.__class__.__name__}: {e}"
+        result_queue.put(("done", call_id, error))
+
+
+class _Call:
+    def __init__(self, parts: int):
+        self.remaining = parts
+        self.errors = []
+        self.done = threading.Event()
+
+
+class ProcessPoolEmbeddings(Embeddings):
+    def __init__(
+        self,
+        model: str,
+        device: str = "cpu",
+        num_workers: int = None,
+        max_batch_size: int = 64,
+    ):
+        '''
+        num_workers: 子进程数量，默认为CPU核心数。CPU核心平均分配给各子进程
+        max_batch_size: 每个子进程每次处理的最多文本数
+        '''
+        from server.knowledge_base.kb_cache.base import bge_query_instruction
+
+        self.model = model
+        self.device = device
+        # 子进程的 embed_documents 不加指令，检索语句的指令在这里添加（与 HuggingFaceBgeEmbeddings 一致）
+        self.query_instruction = bge_query_instruction(model)
+        self.max_batch_size = max_batch_size
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+        self.num_workers = min(num_workers or len(cpus), len(cpus))
+        ctx = mp.get_context("spawn")  # 避免 fork 带有线程与 torch 状态的进程
+        self._task_queue = ctx.Queue()
+        self._result_queue = ctx.Queue()
+        self._calls: Dict[int, _Call] = {}
+        self._calls_lock = threading.Lock()
+        self._call_ids = itertools.count()
+        self._closing = False
+        self._processes = []
+        per_worker = len(cpus) // self.num_workers
+        for i in range(self.num_workers):
+            cores = cpus[i * per_worker: (i + 1) * per_worker]
+            p = ctx.Process(target=_worker_main,
+                            args=(model, device, cores, self._task_queue, self._result_queue),
+                            name=f"embedding_worker_{model}_{i}",
+                            daemon=True)
+            p.start()
+            self._processes.append(p)
+
+        self.dim = None
+        for _ in range(self.num_workers):
+            status, pid, data = self._result_queue.get()
+            if status == "failed":
+                self._shutdown()
+                raise RuntimeError(f"Embeddings子进程 {pid} 加载模型 {model} 失败：{data}")
+            self.dim = data
+        logger.info(f"已启动 {self.num_workers} 个Embeddings子进程运行模型 {model}，每个进程 {per_worker} 个CPU核心")
+
+        threading.Thread(target=self._collect_results, name=f"embedding_pool_{model}", daemon=True).start()
+        atexit.register(self._shutdown)
+
+    def _collect_results(self):
+        while True:
+            try:
+                message = self._result_queue.get()
+            except (EOFError, OSError):
+                return
+            if message is None:
+                return
+            _, call_id, error = message
+            with self._calls_lock:
+                call = self._calls.get(call_id)
+            if call is None:
+                continue
+            if error:
+                call.errors.append(error)
+            call.remaining -= 1  # 只有本线程修改
+            if call.remaining == 0:
+                call.done.set()
+
+    def _wait(self, call: _Call):
+        while not call.done.wait(1):
+            if dead := [p.pid for p in self._processes if not p.is_alive()]:
+                raise RuntimeError(f"Embeddings子进程 {dead} 已退出")
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        # 尽量让每个子进程都分到文本，同时限制单次处理的数量
+        batch_size = min(self.max_batch_size, math.ceil(len(texts) / self.num_workers))
+        shm = shared_memory.SharedMemory(create=True, size=len(texts) * self.dim * 4)
+        try:
+            offsets = range(0, len(texts), batch_size)
+            call_id = next(self._call_ids)
+            call = _Call(len(offsets))
+            with self._calls_lock:
+                if self._closing:
+                    raise RuntimeError(f"Embeddings进程池 {self.model} 已关闭")
+                self._calls[call_id] = call
+            try:
+                for offset in offsets:
+                    self._task_queue.put((call_id, shm.name, offset, texts[offset: offset + batch_size]))
+                self._wait(call)
+            finally:
+                with self._calls_lock:
+                    self._calls.pop(call_id, None)
+                    shutdown = self._closing and not self._calls
+                if shutdown:  # 关闭时仍在进行的最后一次调用结束，停止子进程
+                    self._shutdown()
+            if call.errors:
+                raise RuntimeError(f"Embeddings子进程向量化时出错：{call.errors[0]}")
+            result = np.ndarray((len(texts), self.dim), dtype=np.float32, buffer=shm.buf).tolist()
+        finally:
+            shm.close()
+            shm.unlink()
+        return result
+
+    def embed_query(self, text: str) -> List[float]:
+        text = text.replace("\n", " ")
+        return self.embed_documents([self.query_instruction + text])[0]
+
+    def close(self):
+        '''
+        从缓存中移除时调用：不再接受新的请求，正在进行的请求完成后停止子进程
+        '''
+        with self._calls_lock:
+            self._closing = True
+            busy = bool(self._calls)
+        if not busy:
+            self._shutdown()
+
+    def _shutdown(self):
+        atexit.unregister(self._shutdown)
+        for p in self._processes:
+            if p.is_alive():
+                try:
+                    self._task_queue.put(None)
+                except Exception:
+                    pass
+        for p in self._processes:
+            p.join(timeout=5)
+            if p.is_alive():
+                p.terminate()
+        self._processes = []
+        try:
+            self._result_queue.put(None)
+        except Exception:
+            pass
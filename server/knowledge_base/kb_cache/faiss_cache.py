@@ -1,14 +1,79 @@
-from configs import CACHED_VS_NUM, CACHED_MEMO_VS_NUM
+import configs
+from configs import CACHED_VS_NUM, CACHED_MEMO_VS_NUM, kbs_config
 from server.knowledge_base.kb_cache.base import *
+from server.knowledge_base.kb_cache.lazy_faiss import (is_lazy, to_memory, has_lazy_docstore, close_lazy,
+                                                       save_lazy_docstore, load_lazy_vector_store)
+from server.knowledge_base.kb_cache.faiss_index import (should_rebuild, rebuild_index, remove_positions,
+                                                        search_parameters, clone_index, index_code_size,
+                                                        label_mode, remove_labels, extract_vectors, rebuild_with)
+from server.knowledge_base.kb_cache.faiss_wal import (append_records, read_records, truncate_records, wal_size,
+                                                      read_base_seq, write_base_seq, remove_wal)
 from server.knowledge_base.kb_service.base import EmbeddingsFunAdapter
 from server.utils import load_local_embeddings
 from server.knowledge_base.utils import get_vs_path
-from langchain.vectorstores.faiss import FAISS
+from langchain.vectorstores.faiss import FAISS, dependable_faiss_import
 from langchain.schema import Document
+from langchain.docstore.in_memory import InMemoryDocstore
+from langchain.vectorstores.utils import DistanceStrategy
+import numpy as np
 import os
-from langchain.schema import Document
+import copy
+import shutil
+import itertools
+import json
+import uuid
+from typing import Dict, Set, Iterable, Generator
+
+CACHED_VS_MEMORY = getattr(configs, "CACHED_VS_MEMORY", -1)
+
+
+# 向量库加载方式：memory - 完整读入内存；mmap - 内存映射 index.faiss，按需从 sqlite 读取 docstore
+FAISS_LOAD_MODE = kbs_config.get("faiss", {}).get("load_mode", "memory")
+# 保存时只向 wal.log 追加修改，日志超过 FAISS_WAL_COMPACT_SIZE 后在后台合并为完整快照
+FAISS_WAL = kbs_config.get("faiss", {}).get("wal", False)
+FAISS_WAL_COMPACT_SIZE = kbs_config.get("faiss", {}).get("wal_compact_size", 64) * 1024 * 1024
+# HNSW 中已删除的向量超过该比例后在后台重建索引
+FAISS_TOMBSTONE_RATIO = kbs_config.get("faiss", {}).get("tombstone_ratio", 0.2)
 
 class ThreadSafeFaiss(ThreadSafeObject):
+    SOURCE_INDEX_FILE = "source_index.json"
+
+    def __init__(self, key: Union[str, Tuple], obj: Any = None, pool: "CachePool" = None):
+        super().__init__(key, obj=obj, pool=pool)
+        # source -> ids 的倒排索引，删除/更新文件时无需遍历整个docstore
+        self._source_index: Dict[str, Set[str]] = {}
+        self._indexed_count = 0
+        # 索引选项（降维/量化/近似检索），见 faiss_index.py
+        self.index_options: Dict = {}
+        # 为 True 时写入后不自动转换索引，由 train_index 用全部向量训练（重建向量库时使用）
+        self.rebuild_deferred = False
+        # 以下缓存随索引或 index_to_docstore_id 被替换而失效（见 label_mode）：
+        # docstore id -> 编号的反向映射；IVF 下一个可用的编号；HNSW 中已删除的编号及检索时排除它们的 IDSelector
+        self._labels: Optional[Dict[str, int]] = None
+        self._labels_for = None
+        self._next_label = 0
+        self._next_label_for = None
+        self._tombstones: Set[int] = set()
+        self._tombstones_for = None
+        self._tombstone_selector = None
+        self._tombstone_lock = threading.Lock()
+        self._rebuilding = False
+        # 预写日志：_wal_path 为磁盘上快照所在的目录（为空时下次保存写入完整快照），
+        # _wal_pending 为尚未写入日志的操作，_wal_seq 为最后一个操作的序号
+        self._wal_path: Optional[str] = None
+        self._wal_pending: List[Tuple[int, str, Any]] = []
+        self._wal_pending_size = 0
+        self._wal_seq = 0
+        self._wal_lock = threading.Lock()
+        self._compacting = False
+        # 快照副本（见 fork）的保存推迟到发布时进行，_deferred_save 为请求保存的目录
+        self._staged = False
+        self._deferred_save: Optional[str] = None
+        # 快照发布：同一时间只允许一个批量写入者，期间其它写入者等待，检索不受影响
+        self._snapshot_lock = threading.Lock()
+        self._no_snapshot = threading.Event()
+        self._no_snapshot.set()
+
     def __repr__(self) -> str:
         cls = type(self).__name__
         return f"<{cls}: key: {self.key}, obj: {self._obj}, docs_count: {self.docs_count()}>"
@@ -16,21 +81,543 @@ class ThreadSafeFaiss(ThreadSafeObject):
     def docs_count(self) -> int:
         return len(self._obj.docstore._dict)
 
+    def memory_size(self) -> int:
+        '''
+        估算的向量库内存。缓存池在锁外调用，这里只返回写入时更新的值（见 _release_lock），不访问 docstore
+        '''
+        return self._memory_size or 0
+
+    def _estimate_memory_size(self) -> int:
+        # 索引编码 + 抽样估算的文档文本。延迟加载的向量库按需读取，不计算。调用者需持有锁
+        if self._obj is None or is_lazy(self._obj):
+            return 0
+        index = self._obj.index
+        count = index.ntotal
+        size = count * 64  # index_to_docstore_id 等映射
+        size += count * index_code_size(index)
+        docs = self._obj.docstore._dict
+        if count := len(docs):
+            sample = list(itertools.islice(docs.values(), 100))
+            size += count * sum(len(d.page_content) * 3 + 200 for d in sample) // len(sample)
+        return size
+
+    def close(self):
+        # 延迟加载的向量库从缓存中移除时关闭 sqlite 连接。等待正在进行的检索结束，不触发读入内存
+        self._lock.acquire_write()
+        try:
+            if self._obj is not None:
+                close_lazy(self._obj)
+        finally:
+            self._lock.release_write()
+
+    def _index_docs(self, ids: List[str], metadatas: List[Dict]):
+        for id, metadata in zip(ids, metadatas):
+            if source := (metadata or {}).get("source"):
+                self._source_index.setdefault(source, set()).add(id)
+        self._indexed_count += len(ids)
+
+    def build_source_index(self, path: str = None):
+        '''
+        建立 source -> ids 索引。
+        如果 path 中保存的索引与向量库文档数量一致则直接加载，否则遍历docstore重建。
+        '''
+        with self.acquire():
+            self._source_index = {}
+            self._indexed_count = 0
+            count = self.docs_count()
+            if path and os.path.isfile(index_file := os.path.join(path, self.SOURCE_INDEX_FILE)):
+                try:
+                    with open(index_file, encoding="utf-8") as fp:
+                        data = json.load(fp)
+                    if data.get("count") == count:
+                        self._source_index = {k: set(v) for k, v in data["sources"].items()}
+                        self._indexed_count = count
+                        return
+                except Exception as e:
+                    logger.warning(f"加载向量库 {self.key} 的source索引失败，将重新建立：{e}")
+            docs = self._obj.docstore._dict
+            self._index_docs(list(docs.keys()), [doc.metadata for doc in docs.values()])
+
+    def _check_source_index(self):
+        # 向量库可能被直接修改（如 vs.add_documents），此时索引失效，需要重建
+        if self._indexed_count != self.docs_count():
+            logger.info(f"向量库 {self.key} 的source索引已失效，重新建立")
+            self.build_source_index()
+            self._wal_path = None  # 日志中没有这些修改，下次保存写入完整快照
+
+    def get_ids_by_source(self, source: str) -> List[str]:
+        with self.acquire():
+            self._check_source_index()
+            return list(self._source_index.get(source, []))
+
+    def add_embeddings(
+        self,
+        text_embeddings: Iterable[Tuple[str, List[float]]],
+        metadatas: List[Dict] = None,
+        ids: List[str] = None,
+    ) -> List[str]:
+        text_embeddings = list(text_embeddings)
+        with self.acquire():
+            self._check_source_index()
+            ids = self._add(text_embeddings, metadatas=metadatas, ids=ids)
+            self._index_docs(ids, metadatas or [{}] * len(ids))
+            if FAISS_WAL and self._wal_path is not None:
+                texts = [text for text, _ in text_embeddings]
+                embeddings = np.array([embedding for _, embedding in text_embeddings], dtype=np.float32)
+                self._wal_record("add", (ids, texts, embeddings, metadatas),
+                                 size=embeddings.nbytes + sum(len(x) * 3 for x in texts))
+            if not self.rebuild_deferred:
+                self._rebuild_index()
+        return ids
+
+    def _wal_record(self, op: str, data: Any, size: int = 0):
+        # 记录尚未写入日志的操作。积累的操作过多时放弃日志，下次保存写入完整快照
+        self._wal_seq += 1
+        self._wal_pending.append((self._wal_seq, op, data))
+        self._wal_pending_size += size
+        if self._wal_pending_size > FAISS_WAL_COMPACT_SIZE:
+            self._wal_path = None
+            self._wal_pending, self._wal_pending_size = [], 0
+
+    def load_wal(self, path: str):
+        '''
+        在从磁盘加载的快照上重放 wal.log 中尚未合并的操作（包括上次崩溃前已保存的操作）。需在 build_source_index 之后调用
+        '''
+        with self.acquire(msg="重放日志"):
+            base_seq = read_base_seq(path)
+            records = read_records(path, after_seq=base_seq)
+            self._wal_seq = max([base_seq] + [seq for seq, _, _ in records])
+            if records and is_lazy(self._obj):
+                to_memory(self._obj)
+            vs = self._obj
+            for seq, op, data in records:
+                # 快照的写入不是原子的，崩溃时可能已包含部分操作，重放需要是幂等的
+                if op == "add":
+                    ids, texts, embeddings, metadatas = data
+                    keep = [i for i, id in enumerate(ids) if id not in vs.docstore._dict]
+                    if keep:
+                        metadatas = [(metadatas or [{}] * len(ids))[i] for i in keep]
+                        self._add([(texts[i], embeddings[i]) for i in keep],
+                                  metadatas=metadatas, ids=[ids[i] for i in keep])
+                        self._index_docs([ids[i] for i in keep], metadatas)
+                elif op == "delete":  # 删除整个文件或其中部分文档（回滚）
+                    source, ids = data
+                    self._discard_from_source_index(source, ids)
+                    if ids := [id for id in ids if id in vs.docstore._dict]:
+                        self._delete(ids)
+                        self._indexed_count -= len(ids)
+            if records:
+                logger.info(f"向量库 {self.key} 重放了 {len(records)} 条日志")
+                self._rebuild_index()
+            self._wal_path = path if FAISS_WAL else None
+
+    def _rebuild_index(self):
+        # 向量数量足够训练后，将 IndexFlatL2 转换为压缩/近似检索索引，之后的写入与检索自动应用相同的变换
+        if should_rebuild(self._obj.index, self.index_options):
+            logger.info(f"按 {self.index_options} 转换向量库 {self.key} 的索引，向量数：{self._obj.index.ntotal}")
+            try:
+                self._obj.index = rebuild_index(self._obj.index, self.index_options)
+            except Exception as e:
+                logger.error(f"转换向量库 {self.key} 的索引失败，继续使用 IndexFlatL2：{e}")
+
+    def train_index(self):
+        '''
+        向量数量已满足要求时，用全部向量训练并转换索引
+        '''
+        with self.acquire(msg="训练索引"):
+            self._rebuild_index()
+
+    def _add(
+        self,
+        text_embeddings: List[Tuple[str, List[float]]],
+        metadatas: List[Dict] = None,
+        ids: List[str] = None,
+    ) -> List[str]:
+        # 与 FAISS.add_embeddings 相同，但 IVF 与 HNSW 的编号在删除后不连续，新向量的编号由索引确定
+        vs = self._obj
+        mode = label_mode(vs.index)
+        if mode in ("position", "rebuild"):
+            return vs.add_embeddings(text_embeddings=text_embeddings, metadatas=metadatas, ids=ids)
+        texts = [text for text, _ in text_embeddings]
+        vectors = np.array([embedding for _, embedding in text_embeddings], dtype=np.float32)
+        if vs._normalize_L2:
+            dependable_faiss_import().normalize_L2(vectors)
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        labels_of = self._label_index()
+        if mode == "id":
+            start = self._get_next_label()
+            vs.index.add_with_ids(vectors, np.arange(start, start + len(ids), dtype=np.int64))
+            self._next_label = start + len(ids)
+        else:  # HNSW 中已删除的向量仍占用编号，新向量接在最后
+            start = vs.index.ntotal
+            vs.index.add(vectors)
+        vs.docstore.add({id: Document(page_content=text, metadata=metadata)
+                         for id, text, metadata in zip(ids, texts, metadatas or [{}] * len(ids))})
+        for label, id in enumerate(ids, start):
+            vs.index_to_docstore_id[label] = id
+            labels_of[id] = label
+        return ids
+
+    def _label_index(self) -> Dict[str, int]:
+        # docstore id -> 编号。首次删除时建立，之后在 _add 与 _delete 中增量维护
+        mapping = self._obj.index_to_docstore_id
+        if self._labels_for is not mapping or len(self._labels) != len(mapping):
+            self._labels = {id: i for i, id in mapping.items()}
+            self._labels_for = mapping
+        return self._labels
+
+    def _get_next_label(self) -> int:
+        index = self._obj.index
+        if self._next_label_for is not index:
+            self._next_label = max(self._obj.index_to_docstore_id, default=-1) + 1
+            self._next_label_for = index
+        return self._next_label
+
+    def _get_tombstones(self) -> Set[int]:
+        # HNSW 中已删除的编号：加载后由索引的向量数与 index_to_docstore_id 计算一次，之后在 _delete 中增量维护
+        vs = self._obj
+        with self._tombstone_lock:  # 检索时也会调用，可能有多个读者同时计算
+            if self._tombstones_for is not vs.index:
+                tombstones = set()
+                if label_mode(vs.index) == "tombstone" and vs.index.ntotal != len(vs.index_to_docstore_id):
+                    tombstones = set(range(vs.index.ntotal)).difference(vs.index_to_docstore_id)
+                self._tombstones, self._tombstone_selector = tombstones, None
+                self._tombstones_for = vs.index
+            return self._tombstones
+
+    def _tombstone_filter(self) -> Optional[Tuple]:
+        # 返回 (IDSelectorNot, IDSelectorBatch)，调用者在检索期间持有该元组，防止 IDSelector 被回收
+        tombstones = self._get_tombstones()
+        if not tombstones:
+            return None
+        with self._tombstone_lock:
+            if self._tombstone_selector is None:
+                faiss = dependable_faiss_import()
+                batch = faiss.IDSelectorBatch(np.fromiter(tombstones, dtype=np.int64, count=len(tombstones)))
+                self._tombstone_selector = (faiss.IDSelectorNot(batch), batch)
+            return self._tombstone_selector
+
+    def _delete(self, ids: List[str]) -> bool:
+        # 与 FAISS.delete 相同，但按索引类型删除（见 label_mode）：
+        # IVF 按编号删除，HNSW 只标记为已删除，二者都无需改动其它文档的编号
+        vs = self._obj
+        mode = label_mode(vs.index)
+        tombstones = self._get_tombstones() if mode == "tombstone" else None
+        labels_of = self._label_index()
+        labels = [labels_of.pop(id) for id in ids]
+        vs.docstore.delete(ids)
+        if mode in ("position", "rebuild"):
+            vs.index = remove_positions(vs.index, labels)
+            removed = set(labels)
+            remaining_ids = [id for i, id in sorted(vs.index_to_docstore_id.items()) if i not in removed]
+            vs.index_to_docstore_id = {i: id for i, id in enumerate(remaining_ids)}
+            return True
+        if mode == "id":
+            remove_labels(vs.index, labels)
+        for label in labels:
+            del vs.index_to_docstore_id[label]
+        if mode == "tombstone":
+            tombstones.update(labels)
+            self._tombstone_selector = None  # 调用者持有写锁，没有正在进行的检索
+            self._check_tombstones()
+        return True
+
+    def _check_tombstones(self):
+        index = self._obj.index
+        dead = index.ntotal - len(self._obj.index_to_docstore_id)
+        if dead and label_mode(index) == "tombstone" and dead > FAISS_TOMBSTONE_RATIO * index.ntotal:
+            self._start_tombstone_rebuild()
+
+    def _start_tombstone_rebuild(self):
+        # 未发布的副本由发布后的当前版本负责重建
+        if self._staged or self._rebuilding:
+            return
+        self._rebuilding = True
+        obj = self._obj
+
+        def rebuild():
+            try:
+                # 读锁内复制剩余的向量，耗时的建图在锁外进行，期间检索与写入都不受影响
+                with self.acquire(msg="复制索引", shared=True):
+                    if self._obj is not obj or is_lazy(obj):
+                        return
+                    index, mapping = obj.index, obj.index_to_docstore_id
+                    ntotal, count = index.ntotal, len(mapping)
+                    labels = sorted(mapping)
+                    ids = [mapping[label] for label in labels]
+                    vectors = extract_vectors(index, labels)
+                new_index = rebuild_with(index, vectors)
+                new_mapping = dict(enumerate(ids))
+                with self.acquire(msg="替换索引"):
+                    # 复制后有写入则放弃，由之后的删除再次触发
+                    if (self._obj is obj and obj.index is index and index.ntotal == ntotal
+                            and obj.index_to_docstore_id is mapping and len(mapping) == count):
+                        obj.index, obj.index_to_docstore_id = new_index, new_mapping
+                        logger.info(f"已重建向量库 {self.key} 的索引，移除了 {ntotal - count} 个已删除的向量")
+            except Exception as e:
+                logger.error(f"重建向量库 {self.key} 的索引失败：{e}", exc_info=e if log_verbose else None)
+            finally:
+                self._rebuilding = False
+
+        threading.Thread(target=rebuild, name="faiss_tombstone_rebuild", daemon=True).start()
+
+    def search_batch(
+        self,
+        embeddings: Union[List[List[float]], np.ndarray],
+        k: int,
+        score_threshold: float = None,
+        nprobe: int = None,
+        ef_search: int = None,
+    ) -> List[List[Tuple[Document, float]]]:
+        '''
+        将多个查询向量组成 (Q, d) 矩阵，只调用一次 index.search，返回每个查询的 [(Document, score)]。
+        阈值过滤在 numpy 中完成，只为保留的结果查找文档。结果与逐个调用 similarity_search_with_score_by_vector 一致。
+        nprobe / ef_search 只对本次检索生效，分别用于 IVF 与 HNSW 索引，为空时使用索引的默认值。
+        '''
+        vectors = np.array(embeddings, dtype=np.float32, ndmin=2)  # 复制一份，normalize_L2 会原地修改
+        if vectors.size == 0:
+            return []
+        with self.acquire(shared=True):
+            vs = self._obj
+            if vs._normalize_L2:
+                dependable_faiss_import().normalize_L2(vectors)
+            # HNSW 中已删除的向量在检索时排除
+            exclude = self._tombstone_filter()
+            params = search_parameters(vs.index, nprobe, ef_search, exclude=exclude and exclude[0])
+            if params is not None:
+                scores, indices = vs.index.search(vectors, k, params=params)
+            else:
+                scores, indices = vs.index.search(vectors, k)
+            mask = indices != -1
+            if score_threshold is not None:
+                cmp = (np.greater_equal
+                       if vs.distance_strategy in (DistanceStrategy.MAX_INNER_PRODUCT, DistanceStrategy.JACCARD)
+                       else np.less_equal)
+                mask &= cmp(scores, score_threshold)
+            result = []
+            for row_scores, row_indices, row_mask in zip(scores, indices, mask):
+                result.append([(vs.docstore.search(vs.index_to_docstore_id[i]), float(score))
+                               for i, score in zip(row_indices[row_mask], row_scores[row_mask])])
+        return result
+
+    def delete_by_source(self, source: str) -> List[str]:
+        '''
+        删除指定文件对应的所有文档，耗时只与该文件的文档数量相关
+        '''
+        with self.acquire():
+            self._check_source_index()
+            ids = list(self._source_index.pop(source, []))
+            if ids:
+                self._delete(ids)
+                self._indexed_count -= len(ids)
+                if FAISS_WAL and self._wal_path is not None:
+                    self._wal_record("delete", (source, ids))
+        return ids
+
+    def delete_by_ids(self, ids: List[str]) -> List[str]:
+        '''
+        删除指定 id 的文档（不在本向量库中的 id 被忽略），返回实际删除的 id
+        '''
+        with self.acquire():
+            self._check_source_index()
+            docs = self._obj.docstore._dict
+            sources: Dict[str, List[str]] = {}
+            for id in ids:
+                if id in docs:
+                    sources.setdefault(docs[id].metadata.get("source"), []).append(id)
+            deleted = [id for source_ids in sources.values() for id in source_ids]
+            if deleted:
+                self._delete(deleted)
+                self._indexed_count -= len(deleted)
+            for source, source_ids in sources.items():
+                self._discard_from_source_index(source, source_ids)
+                if FAISS_WAL and self._wal_path is not None:
+                    self._wal_record("delete", (source, source_ids))
+        return deleted
+
+    def _discard_from_source_index(self, source: str, ids: List[str]):
+        if (source_ids := self._source_index.get(source)) is not None:
+            source_ids.difference_update(ids)
+            if not source_ids:
+                del self._source_index[source]
+
     def save(self, path: str, create_path: bool = True):
+        '''
+        保存向量库。开启 wal 且 path 中已有快照时，只将上次保存后的修改追加到 wal.log
+        '''
         with self.acquire():
             if not os.path.isdir(path) and create_path:
                 os.makedirs(path)
-            ret = self._obj.save_local(path)
-            logger.info(f"已将向量库 {self.key} 保存到磁盘")
-        return ret
+            if self._staged:  # 未发布的副本不写入磁盘，否则丢弃副本后磁盘上的文件与当前版本不一致
+                self._deferred_save = path
+                return
+            if self._write(path):
+                self._start_compaction(path)
+
+    def _write(self, path: str) -> bool:
+        # 调用者需持有写锁。返回日志是否需要合并
+        if FAISS_WAL and self._wal_path == path:
+            with self._wal_lock:
+                append_records(path, self._wal_pending)
+            logger.info(f"已将向量库 {self.key} 的 {len(self._wal_pending)} 个修改写入日志")
+            self._wal_pending, self._wal_pending_size = [], 0
+            return wal_size(path) > FAISS_WAL_COMPACT_SIZE
+        self._check_source_index()
+        self._save_snapshot(path)
+        self._wal_pending, self._wal_pending_size = [], 0
+        self._wal_path = path if FAISS_WAL else None
+        return False
+
+    def _save_snapshot(self, path: str):
+        # 调用者需持有锁（读锁即可）。先写入临时目录再替换，避免崩溃时留下写了一半的文件
+        seq = self._wal_seq
+        tmp_path = os.path.join(path, ".snapshot")
+        try:
+            self._obj.save_local(tmp_path)
+            for name in ["index.faiss", "index.pkl"]:
+                os.replace(os.path.join(tmp_path, name), os.path.join(path, name))
+        finally:  # 保存失败或上次崩溃留下的临时目录一并删除
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        if FAISS_LOAD_MODE == "mmap":
+            save_lazy_docstore(self._obj, path)
+        if self._indexed_count == self.docs_count():
+            with open(os.path.join(path, self.SOURCE_INDEX_FILE), "w", encoding="utf-8") as fp:
+                json.dump({"count": self._indexed_count,
+                           "sources": {k: list(v) for k, v in self._source_index.items()}},
+                          fp)
+        write_base_seq(path, seq)
+        with self._wal_lock:  # 快照之后追加的日志保留
+            truncate_records(path, seq)
+        logger.info(f"已将向量库 {self.key} 保存到磁盘")
+
+    def _start_compaction(self, path: str):
+        if self._compacting:
+            return
+        self._compacting = True
+        obj = self._obj
+
+        def compact():
+            try:
+                # 读锁：合并期间检索不受影响，写入者等待
+                with self.acquire(msg="合并日志", shared=True):
+                    # 启动后可能已发布了新版本，其日志与序号由新版本的保存负责
+                    if self._obj is obj and self._wal_path == path and not is_lazy(self._obj):
+                        self._save_snapshot(path)
+            except Exception as e:
+                logger.error(f"合并向量库 {self.key} 的日志失败：{e}", exc_info=e if log_verbose else None)
+            finally:
+                self._compacting = False
+
+        threading.Thread(target=compact, name=f"faiss_wal_compact", daemon=True).start()
+
+    def _release_lock(self, shared: bool = False):
+        # 增删文档、加载、读入内存等都在写锁内进行，释放前更新估算的内存
+        if not shared:
+            self._memory_size = self._estimate_memory_size()
+        super()._release_lock(shared)
+
+    def _acquire_lock(self, shared: bool = False):
+        if shared or self._lock.is_writer():
+            return super()._acquire_lock(shared)
+        # 有快照正在构建时，直接写入当前版本的修改会在发布时丢失，需等待发布完成
+        while True:
+            super()._acquire_lock(shared)
+            if self._no_snapshot.is_set():
+                break
+            super()._release_lock(shared)
+            self._no_snapshot.wait()
+        # 延迟加载的向量库是只读的，写入前完整读入内存
+        if self._obj is not None and is_lazy(self._obj):
+            logger.info(f"将延迟加载的向量库 {self.key} 读入内存以便写入")
+            to_memory(self._obj)
+
+    def fork(self, obj: FAISS = None) -> "ThreadSafeFaiss":
+        '''
+        复制当前版本的向量库（包括source索引），返回不在缓存池中的副本。
+        如果指定了 obj，则以 obj 作为新版本（用于重建向量库）。
+        '''
+        item = ThreadSafeFaiss(self.key)
+        item.index_options = self.index_options
+        item._staged = True
+        # 副本与当前版本共用同一个 wal.log，序号从当前版本继续，副本的快照才能覆盖日志中已有的记录
+        item._wal_lock = self._wal_lock
+        item._wal_seq = self._wal_seq
+        if obj is None:
+            with self.acquire(msg="复制快照"):
+                self._check_source_index()
+                # 副本的修改记录为日志，发布时连同当前版本尚未保存的修改一起追加，无需重写整个向量库
+                item._wal_path = self._wal_path
+                item._wal_pending, item._wal_pending_size = list(self._wal_pending), self._wal_pending_size
+                obj = copy.copy(self._obj)
+                obj.index = clone_index(self._obj.index)
+                obj.docstore = InMemoryDocstore(dict(self._obj.docstore._dict))
+                obj.index_to_docstore_id = dict(self._obj.index_to_docstore_id)
+                item._source_index = {k: set(v) for k, v in self._source_index.items()}
+                item._indexed_count = self._indexed_count
+            item.obj = obj
+        else:
+            item.obj = obj
+            item.build_source_index()
+        item.finish_loading()
+        return item
+
+    def publish(self, item: "ThreadSafeFaiss"):
+        '''
+        原子地将 item 发布为当前版本：等待正在进行的检索与日志合并完成后，在写锁内替换。
+        '''
+        compact = False
+        if (path := item._deferred_save) is not None:
+            # 在替换前保存副本（通常只是追加日志），副本不在缓存中，保存期间检索继续使用当前版本
+            with item.acquire(msg="保存副本"):
+                compact = item._write(path)
+        # 直接获取写锁：快照期间 acquire 会等待快照结束
+        self._lock.acquire_write()
+        try:
+            self._obj, self._source_index, self._indexed_count = \
+                item._obj, item._source_index, item._indexed_count
+            # 副本已保存时，磁盘上的快照与日志对应新版本；未保存时 _wal_path 为空，下次保存写入完整快照
+            self._wal_path, self._wal_seq = item._wal_path, item._wal_seq
+            self._wal_pending, self._wal_pending_size = item._wal_pending, item._wal_pending_size
+            self._memory_size = self._estimate_memory_size()
+        finally:
+            self._lock.release_write()
+        if compact:
+            self._start_compaction(path)
+        self._check_tombstones()
+        if self._pool is not None:
+            with self._pool.atomic:
+                if self._pool._cache.get(self.key) is not self:  # 构建期间已被移出缓存
+                    self._pool.set(self.key, self)
+        logger.info(f"已发布向量库 {self.key} 的新版本，docs_count: {self.docs_count()}")
+
+    @contextmanager
+    def snapshot(self, obj: FAISS = None) -> Generator["ThreadSafeFaiss", None, None]:
+        '''
+        写时复制：在当前版本的副本（或指定的新向量库 obj）上进行批量修改，正常退出时原子地发布。
+        期间检索继续使用旧版本，其它写入者等待发布完成；出现异常则丢弃副本。
+        '''
+        self._snapshot_lock.acquire()
+        try:
+            with self.acquire(msg="开始快照"):
+                self._no_snapshot.clear()
+                staged = self.fork(obj)
+            yield staged
+            self.publish(staged)
+        finally:
+            self._no_snapshot.set()
+            self._snapshot_lock.release()
 
     def clear(self):
         ret = []
         with self.acquire():
             ids = list(self._obj.docstore._dict.keys())
             if ids:
-                ret = self._obj.delete(ids)
+                ret = self._delete(ids)
                 assert len(self._obj.docstore._dict) == 0
+            self._source_index = {}
+            self._indexed_count = 0
+            self._wal_path = None
+            self._wal_pending, self._wal_pending_size = [], 0
             logger.info(f"已将向量库 {self.key} 清空")
         return ret
 
@@ -68,12 +655,18 @@ class KBFaissPool(_FaissPool):
             create: bool = True,
             embed_model: str = EMBEDDING_MODEL,
             embed_device: str = embedding_device(),
+            index_options: Dict = None,
     ) -> ThreadSafeFaiss:
+        '''
+        index_options: 向量压缩选项，为空时不压缩。已压缩的向量库从磁盘加载时自带压缩方式，不受该参数影响
+        '''
         self.atomic.acquire()
         vector_name = vector_name or embed_model
         cache = self.get((kb_name, vector_name)) # 用元组比拼接字符串好一些
+        self._count_access(hit=cache is not None)
         if cache is None:
             item = ThreadSafeFaiss((kb_name, vector_name), pool=self)
+            item.index_options = index_options or {}
             self.set((kb_name, vector_name), item)
             with item.acquire(msg="初始化"):
                 self.atomic.release()
@@ -82,16 +675,24 @@ class KBFaissPool(_FaissPool):
 
                 if os.path.isfile(os.path.join(vs_path, "index.faiss")):
                     embeddings = self.load_kb_embeddings(kb_name=kb_name, embed_device=embed_device, default_embed_model=embed_model)
-                    vector_store = FAISS.load_local(vs_path, embeddings, normalize_L2=True)
+                    if FAISS_LOAD_MODE == "mmap" and has_lazy_docstore(vs_path):
+                        vector_store = load_lazy_vector_store(vs_path, embeddings, normalize_L2=True)
+                    else:
+                        vector_store = FAISS.load_local(vs_path, embeddings, normalize_L2=True)
+                        if FAISS_LOAD_MODE == "mmap":  # 转换格式，下次即可延迟加载
+                            save_lazy_docstore(vector_store, vs_path)
                 elif create:
                     # create an empty vector store
                     if not os.path.exists(vs_path):
                         os.makedirs(vs_path)
                     vector_store = self.new_vector_store(embed_model=embed_model, embed_device=embed_device)
                     vector_store.save_local(vs_path)
+                    remove_wal(vs_path)
                 else:
                     raise RuntimeError(f"knowledge base {kb_name} not exist.")
                 item.obj = vector_store
+                item.build_source_index(vs_path)
+                item.load_wal(vs_path)
                 item.finish_loading()
         else:
             self.atomic.release()
@@ -107,6 +708,7 @@ class MemoFaissPool(_FaissPool):
     ) -> ThreadSafeFaiss:
         self.atomic.acquire()
         cache = self.get(kb_name)
+        self._count_access(hit=cache is not None)
         if cache is None:
             item = ThreadSafeFaiss(kb_name, pool=self)
             self.set(kb_name, item)
@@ -122,7 +724,7 @@ class MemoFaissPool(_FaissPool):
         return self.get(kb_name)
 
 
-kb_faiss_pool = KBFaissPool(cache_num=CACHED_VS_NUM)
+kb_faiss_pool = KBFaissPool(cache_num=CACHED_VS_NUM, max_memory=CACHED_VS_MEMORY * 1024 * 1024)
 memo_faiss_pool = MemoFaissPool(cache_num=CACHED_MEMO_VS_NUM)
 
 
@@ -0,0 +1,275 @@
+'''
+FAISS 向量库的索引选项：降维（PCA 或 Matryoshka 截断）、标量量化（fp16 / int8）与近似检索索引（IVF / HNSW / PQ）。
+降维、归一化与量化通过 IndexPreTransform 封装在索引内部，写入和检索时 FAISS 自动对向量做相同的变换，
+保存的 index.faiss 中也包含这些变换，加载时无需额外处理。
+需要训练的选项（PCA、int8）在向量数量达到 train_size 之前使用普通的 IndexFlatL2，达到后用已有向量训练并转换；
+近似检索索引在向量数量达到 promote_size 后才从 IndexFlatL2 转换。
+'''
+import math
+import re
+from typing import Dict, List
+
+import numpy as np
+from langchain.vectorstores.faiss import dependable_faiss_import
+
+from configs import kbs_config
+
+
+# num_shards 为知识库的分片数，由 FaissKBService 使用
+INDEX_OPTION_KEYS = ("dim_reduction", "reduced_dim", "quantization", "index_factory", "num_shards")
+DIM_REDUCTIONS = ("pca", "truncate")
+QUANTIZATIONS = ("fp16", "int8")
+
+
+def default_index_options() -> Dict:
+    '''
+    新建知识库时使用的索引选项，来自 kbs_config["faiss"]
+    '''
+    config = kbs_config.get("faiss", {})
+    return {k: config.get(k) for k in INDEX_OPTION_KEYS}
+
+
+def check_index_options(options: Dict) -> Dict:
+    '''
+    检查索引选项，返回只包含 INDEX_OPTION_KEYS 的字典。选项无效时抛出 ValueError
+    '''
+    options = {k: (options or {}).get(k) or None for k in INDEX_OPTION_KEYS}
+    if options["dim_reduction"] not in (None, *DIM_REDUCTIONS):
+        raise ValueError(f"不支持的降维方式：{options['dim_reduction']}，可选：{DIM_REDUCTIONS}")
+    if options["dim_reduction"] and not (isinstance(options["reduced_dim"], int) and options["reduced_dim"] > 0):
+        raise ValueError(f"降维后的维度必须是正整数：{options['reduced_dim']}")
+    if options["quantization"] not in (None, *QUANTIZATIONS):
+        raise ValueError(f"不支持的量化方式：{options['quantization']}，可选：{QUANTIZATIONS}")
+    if options["index_factory"] is not None and not isinstance(options["index_factory"], str):
+        raise ValueError(f"index_factory 必须是 faiss.index_factory 格式的字符串：{options['index_factory']}")
+    if options["num_shards"] is not None and not (isinstance(options["num_shards"], int) and options["num_shards"] > 0):
+        raise ValueError(f"分片数必须是正整数：{options['num_shards']}")
+    return options
+
+
+def needs_training(options: Dict) -> bool:
+    return options.get("dim_reduction") == "pca" or options.get("quantization") == "int8"
+
+
+def train_size(options: Dict) -> int:
+    '''
+    从 IndexFlatL2 转换所需的最少向量数。PCA 的样本数不能少于降维后的维度，近似检索索引需达到 promote_size
+    '''
+    config = kbs_config.get("faiss", {})
+    size = 0
+    if needs_training(options):
+        size = config.get("train_size", 1000)
+        if options.get("dim_reduction") == "pca":
+            size = max(size, options["reduced_dim"])
+    if options.get("index_factory"):
+        size = max(size, config.get("promote_size", 100000))
+    return size
+
+
+def _expand_factory(factory: str, ntotal: int) -> str:
+    # 没有指定聚类数的 IVF 按向量数确定：4*sqrt(n)，且每个聚类至少有 39 个训练样本
+    nlist = max(min(int(4 * math.sqrt(ntotal)), ntotal // 39), 1)
+    return re.sub(r"IVF(?=[,_]|$)", f"IVF{nlist}", factory)
+
+
+def build_index(d: int, options: Dict, ntotal: int = 0):
+    '''
+    按索引选项建立空索引（需要训练的索引尚未训练）。距离均为 L2，与 normalize_L2=True 的 FAISS 向量库一致。
+    ntotal 为将要加入的向量数，用于确定 IVF 的聚类数
+    '''
+    faiss = dependable_faiss_import()
+    transforms = []
+    dim = d
+    if (method := options.get("dim_reduction")) and options["reduced_dim"] < d:
+        dim = options["reduced_dim"]
+        if method == "pca":
+            transforms.append(faiss.PCAMatrix(d, dim))
+        else:
+            transforms.append(faiss.RemapDimensionsTransform(d, dim, False))
+        # 降维后重新归一化，使 L2 距离与余弦相似度保持对应，score_threshold 的含义不变
+        transforms.append(faiss.NormalizationTransform(dim, 2.0))
+
+    quantization = options.get("quantization")
+    if factory := options.get("index_factory"):  # 量化方式由 index_factory 决定
+        index = faiss.index_factory(dim, _expand_factory(factory, ntotal), faiss.METRIC_L2)
+        _set_search_defaults(index)
+    elif quantization == "fp16":
+        index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_L2)
+    elif quantization == "int8":
+        index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_L2)
+    else:
+        index = faiss.IndexFlatL2(dim)
+
+    if transforms:
+        index = faiss.IndexPreTransform(index)
+        for transform in reversed(transforms):
+            index.prepend_transform(transform)
+    return index
+
+
+def _set_search_defaults(index):
+    faiss = dependable_faiss_import()
+    config = kbs_config.get("faiss", {})
+    if (ivf := faiss.try_extract_index_ivf(index)) is not None and config.get("nprobe"):
+        ivf.nprobe = config["nprobe"]
+    if isinstance(index := faiss.downcast_index(index), faiss.IndexHNSW) and config.get("ef_search"):
+        index.hnsw.efSearch = config["ef_search"]
+
+
+def search_parameters(index, nprobe: int = None, ef_search: int = None, exclude=None):
+    '''
+    单次检索的参数（不修改索引本身，可在并发检索中使用）。索引不支持这些参数时返回 None。
+    exclude 为 HNSW 检索时排除的编号（IDSelector），调用者需在检索结束前保持其引用
+    '''
+    faiss = dependable_faiss_import()
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexPreTransform):
+        if (inner := search_parameters(index.index, nprobe, ef_search, exclude)) is None:
+            return None
+        params = faiss.SearchParametersPreTransform()
+        params.index_params = inner
+        params.referenced_objects = [inner]  # 防止 inner 先于 params 被回收
+        return params
+    if nprobe and isinstance(index, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(nprobe=nprobe)
+    if (ef_search or exclude is not None) and isinstance(index, faiss.IndexHNSW):
+        # 未指定 ef_search 时使用索引的默认值，SearchParametersHNSW 自身的默认值较小
+        return faiss.SearchParametersHNSW(efSearch=ef_search or index.hnsw.efSearch, sel=exclude)
+    return None
+
+
+def should_rebuild(index, options: Dict) -> bool:
+    '''
+    index 是 IndexFlat，选项要求压缩或使用近似检索索引，且已有足够的向量用于训练时返回 True
+    '''
+    if not options or not any(options.get(k) for k in ("dim_reduction", "quantization", "index_factory")):
+        return False
+    faiss = dependable_faiss_import()
+    if not isinstance(faiss.downcast_index(index), faiss.IndexFlat):
+        return False
+    return index.ntotal >= max(train_size(options), 1)
+
+
+def rebuild_index(index, options: Dict):
+    '''
+    用 index 中已有的向量训练并建立新索引。向量的顺序不变，index_to_docstore_id 无需修改
+    '''
+    vectors = index.reconstruct_n(0, index.ntotal)
+    new_index = build_index(index.d, options, ntotal=index.ntotal)
+    if not new_index.is_trained:
+        new_index.train(vectors)
+    new_index.add(vectors)
+    return new_index
+
+
+def label_mode(index) -> str:
+    '''
+    索引中向量编号的方式，决定删除的做法：
+    position - IndexFlat、标量量化等按顺序存储，remove_ids 后之后的向量依次前移，index_to_docstore_id 需重新编号；
+    id - IVF 按指定的编号存储，借助哈希表 direct map 按编号删除，其它向量的编号不变；
+    tombstone - HNSW 不支持删除，删除的向量保留在索引中，检索时过滤，积累过多后在后台重建；
+    rebuild - 其它不支持删除的索引，用剩余的向量重建
+    '''
+    faiss = dependable_faiss_import()
+    _, inner = _split_index(index)
+    if isinstance(inner, faiss.IndexFlatCodes):
+        return "position"
+    if faiss.try_extract_index_ivf(inner) is not None:
+        return "id"
+    if isinstance(inner, faiss.IndexHNSW):
+        return "tombstone"
+    return "rebuild"
+
+
+def _split_index(index):
+    # 返回 (IndexPreTransform 或 None, 实际存储向量的索引)
+    faiss = dependable_faiss_import()
+    outer, inner = None, faiss.downcast_index(index)
+    if isinstance(inner, faiss.IndexPreTransform):
+        outer, inner = inner, faiss.downcast_index(inner.index)
+    return outer, inner
+
+
+def _use_hashtable(index):
+    # 哈希表 direct map 使按编号删除只需查找被删除的向量，不必扫描全部倒排列表。
+    # 首次删除时由倒排列表建立，之后由 add_with_ids 维护（不指定编号的 add 不会更新哈希表）
+    faiss = dependable_faiss_import()
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf.direct_map.type != faiss.DirectMap.Hashtable:
+        ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+
+
+def remove_labels(index, labels: List[int]):
+    '''
+    按编号删除 IVF 索引中的向量，其它向量的编号不变。耗时只与删除的数量相关
+    '''
+    faiss = dependable_faiss_import()
+    labels = np.asarray(labels, dtype=np.int64)
+    _use_hashtable(index)
+    # 哈希表 direct map 只支持 IDSelectorArray
+    index.remove_ids(faiss.IDSelectorArray(len(labels), faiss.swig_ptr(labels)))
+
+
+def remove_positions(index, positions: List[int]):
+    '''
+    删除指定位置的向量，之后的向量依次前移，返回删除后的索引。
+    IndexFlat 等按顺序存储的索引直接 remove_ids，其它索引用剩余的向量重建
+    '''
+    faiss = dependable_faiss_import()
+    positions = np.asarray(positions, dtype=np.int64)
+    outer, inner = _split_index(index)
+    if isinstance(inner, faiss.IndexFlatCodes):
+        index.remove_ids(positions)
+        if outer is not None:
+            outer.ntotal = inner.ntotal
+        return index
+    keep = np.delete(np.arange(index.ntotal, dtype=np.int64), positions)
+    return rebuild_with(index, extract_vectors(index, keep))
+
+
+def extract_vectors(index, labels: List[int]) -> np.ndarray:
+    '''
+    取回指定编号的向量。返回的是内层索引中保存的（降维等变换后的）向量，用于 rebuild_with
+    '''
+    faiss = dependable_faiss_import()
+    _, inner = _split_index(index)
+    labels = np.asarray(labels, dtype=np.int64)
+    if not len(labels):
+        return np.zeros((0, inner.d), dtype=np.float32)
+    if faiss.try_extract_index_ivf(inner) is not None:
+        _use_hashtable(inner)  # IVF 需要 direct map 才能按编号取回向量
+    return inner.reconstruct_batch(labels)
+
+
+def rebuild_with(index, vectors: np.ndarray):
+    '''
+    返回与 index 结构相同、只包含 vectors 的新索引，向量的编号为 0..len(vectors)-1。
+    reset 保留训练结果（如降维矩阵），vectors 已经过变换，直接加入内层索引
+    '''
+    new_index = clone_index(index)
+    outer, inner = _split_index(new_index)
+    inner.reset()
+    inner.add(vectors)
+    if outer is not None:
+        outer.ntotal = inner.ntotal
+    return new_index
+
+
+def clone_index(index):
+    # NormalizationTransform 等不支持 clone_index，改用序列化复制
+    faiss = dependable_faiss_import()
+    try:
+        return faiss.clone_index(index)
+    except RuntimeError:
+        return faiss.deserialize_index(faiss.serialize_index(index))
+
+
+def index_code_size(index) -> int:
+    '''
+    每个向量在索引中占用的字节数
+    '''
+    faiss = dependable_faiss_import()
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexPreTransform):
+        index = faiss.downcast_index(index.index)
+    return getattr(index, "code_size", index.d * np.dtype(np.float32).itemsize)
@@ -0,0 +1,110 @@
+'''
+FAISS 向量库的预写日志(WAL)：每次保存只把新增/删除操作追加到 wal.log，而不是重写整个 index.faiss 与 index.pkl。
+日志超过一定大小后在后台合并为完整快照。加载向量库时，在快照的基础上重放序号更大的日志记录。
+
+wal.log 中每条记录为：4字节长度 + 4字节 crc32 + pickle((seq, op, data))。
+程序崩溃导致的不完整记录在读取时被忽略。wal.json 记录快照包含的最后一个序号。
+'''
+import json
+import os
+import pickle
+import struct
+import zlib
+from typing import Any, List, Tuple
+
+from configs import logger
+
+
+WAL_FILE = "wal.log"
+WAL_META_FILE = "wal.json"
+_HEADER = struct.Struct("<II")
+
+Record = Tuple[int, str, Any]  # (seq, op, data)
+
+
+def _write_records(file: str, records: List[Record], mode: str = "ab"):
+    with open(file, mode) as fp:
+        for record in records:
+            payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+            fp.write(_HEADER.pack(len(payload), zlib.crc32(payload)))
+            fp.write(payload)
+        fp.flush()
+        os.fsync(fp.fileno())
+
+
+def append_records(path: str, records: List[Record]):
+    '''
+    追加记录并 fsync，返回后即可保证记录已经落盘
+    '''
+    _write_records(os.path.join(path, WAL_FILE), records)
+
+
+def read_records(path: str, after_seq: int = 0) -> List[Record]:
+    '''
+    读取序号大于 after_seq 的记录。遇到不完整或校验失败的记录时停止（之后的内容是崩溃时未写完的），
+    并截掉这部分内容，以免之后追加的记录无法读取
+    '''
+    records = []
+    wal_file = os.path.join(path, WAL_FILE)
+    if not os.path.isfile(wal_file):
+        return records
+    valid_end = 0
+    with open(wal_file, "rb") as fp:
+        while header := fp.read(_HEADER.size):
+            size, crc = _HEADER.unpack(header) if len(header) == _HEADER.size else (0, None)
+            payload = fp.read(size)
+            if crc is None or len(payload) < size or zlib.crc32(payload) != crc:
+                break
+            valid_end = fp.tell()
+            record = pickle.loads(payload)
+            if record[0] > after_seq:
+                records.append(record)
+    if valid_end < os.path.getsize(wal_file):
+        logger.warning(f"{wal_file} 末尾有不完整的记录，已截断")
+        os.truncate(wal_file, valid_end)
+    return records
+
+
+def wal_size(path: str) -> int:
+    wal_file = os.path.join(path, WAL_FILE)
+    return os.path.getsize(wal_file) if os.path.isfile(wal_file) else 0
+
+
+def truncate_records(path: str, upto_seq: int):
+    '''
+    删除序号不大于 upto_seq 的记录（已包含在快照中），保留之后追加的记录
+    '''
+    records = read_records(path, after_seq=upto_seq)
+    wal_file = os.path.join(path, WAL_FILE)
+    if not records:
+        if os.path.isfile(wal_file):
+            os.remove(wal_file)
+        return
+    # 先写入临时文件再替换，wal.log 始终是完整的
+    tmp_file = wal_file + ".tmp"
+    _write_records(tmp_file, records, mode="wb")
+    os.replace(tmp_file, wal_file)
+
+
+def remove_wal(path: str):
+    '''
+    删除日志与序号文件，在 path 中写入新的空向量库时调用
+    '''
+    for name in [WAL_FILE, WAL_META_FILE]:
+        if os.path.isfile(file := os.path.join(path, name)):
+            os.remove(file)
+
+
+def read_base_seq(path: str) -> int:
+    meta_file = os.path.join(path, WAL_META_FILE)
+    if os.path.isfile(meta_file):
+        with open(meta_file, encoding="utf-8") as fp:
+            return json.load(fp).get("seq", 0)
+    return 0
+
+
+def write_base_seq(path: str, seq: int):
+    meta_file = os.path.join(path, WAL_META_FILE)
+    with open(meta_file + ".tmp", "w", encoding="utf-8") as fp:
+        json.dump({"seq": seq}, fp)
+    os.replace(meta_file + ".tmp", meta_file)
@@ -0,0 +1,200 @@
+'''
+延迟加载的FAISS向量库：index.faiss 以内存映射方式打开，docstore 保存在 sqlite 中按需读取。
+适合同时打开大量知识库但每个知识库访问较少的场景。延迟加载的向量库是只读的，写入前需要调用 to_memory 转换。
+'''
+import json
+import os
+import sqlite3
+import threading
+from collections.abc import ItemsView, Mapping
+from typing import Dict, Iterator, List
+
+from langchain.docstore.document import Document
+from langchain.docstore.in_memory import InMemoryDocstore
+from langchain.embeddings.base import Embeddings
+from langchain.vectorstores.faiss import FAISS, dependable_faiss_import
+
+from configs import logger
+
+
+DOCSTORE_FILE = "docstore.db"
+
+
+class SqliteDocDict(Mapping):
+    '''
+    以 sqlite 为存储的只读 {id: Document} 映射，每个线程使用独立的连接。
+    '''
+    def __init__(self, path: str):
+        self._path = path
+        self._local = threading.local()
+        self._conns: List[sqlite3.Connection] = []
+        self._conns_lock = threading.Lock()
+        self._len = None
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(f"file:{self._path}?mode=ro", uri=True, check_same_thread=False)
+            self._local.conn = conn
+            with self._conns_lock:
+                self._conns.append(conn)
+        return conn
+
+    def close(self):
+        '''
+        关闭所有线程的连接。之后再访问时重新打开
+        '''
+        with self._conns_lock:
+            conns, self._conns = self._conns, []
+            self._local = threading.local()
+        for conn in conns:
+            conn.close()
+
+    def __getitem__(self, id: str) -> Document:
+        row = self._conn().execute("SELECT page_content, metadata FROM docs WHERE id = ?", (id,)).fetchone()
+        if row is None:
+            raise KeyError(id)
+        return Document(page_content=row[0], metadata=json.loads(row[1]))
+
+    def __contains__(self, id: str) -> bool:
+        return self._conn().execute("SELECT 1 FROM docs WHERE id = ?", (id,)).fetchone() is not None
+
+    def __iter__(self) -> Iterator[str]:
+        for (id,) in self._conn().execute("SELECT id FROM docs ORDER BY pos"):
+            yield id
+
+    def __len__(self) -> int:
+        if self._len is None:
+            self._len = self._conn().execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+        return self._len
+
+
+class _PositionItems(ItemsView):
+    def __iter__(self):
+        # 一次查询返回全部 (pos, id)，而不是逐个位置查询
+        yield from self._mapping._docs._conn().execute("SELECT pos, id FROM docs ORDER BY pos")
+
+
+class SqlitePositionDict(Mapping):
+    '''
+    以 sqlite 为存储的只读 {pos: id} 映射，用作延迟加载向量库的 index_to_docstore_id，与 SqliteDocDict 共用连接。
+    加载时无需读取全部 id，检索时只查询命中的位置
+    '''
+    def __init__(self, docs: SqliteDocDict):
+        self._docs = docs
+
+    def __getitem__(self, pos: int) -> str:
+        # 检索结果中的位置是 numpy 整数，sqlite 需要 int
+        row = self._docs._conn().execute("SELECT id FROM docs WHERE pos = ?", (int(pos),)).fetchone()
+        if row is None:
+            raise KeyError(pos)
+        return row[0]
+
+    def __iter__(self) -> Iterator[int]:
+        for (pos,) in self._docs._conn().execute("SELECT pos FROM docs ORDER BY pos"):
+            yield pos
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    def items(self) -> ItemsView:
+        return _PositionItems(self)
+
+    def __reduce__(self):
+        # 序列化(如 save_local)时转为普通的 dict
+        return dict, (dict(self.items()),)
+
+
+class LazyDocstore(InMemoryDocstore):
+    '''
+    只读的延迟加载 docstore，接口与 InMemoryDocstore 一致（包括 _dict）
+    '''
+    def __init__(self, path: str):
+        self._dict = SqliteDocDict(path)
+
+    def add(self, texts: Dict[str, Document]) -> None:
+        raise NotImplementedError("延迟加载的docstore是只读的，请先调用 to_memory 转换")
+
+    def delete(self, ids) -> None:
+        raise NotImplementedError("延迟加载的docstore是只读的，请先调用 to_memory 转换")
+
+    def __reduce__(self):
+        # 序列化(如 save_local)时转为普通的 InMemoryDocstore
+        return InMemoryDocstore, (dict(self._dict.items()),)
+
+
+def is_lazy(vector_store: FAISS) -> bool:
+    return isinstance(vector_store.docstore, LazyDocstore)
+
+
+def has_lazy_docstore(vs_path: str) -> bool:
+    '''
+    docstore.db 存在且不旧于 index.faiss 时才能延迟加载
+    '''
+    db_file = os.path.join(vs_path, DOCSTORE_FILE)
+    index_file = os.path.join(vs_path, "index.faiss")
+    return (os.path.isfile(db_file)
+            and os.path.isfile(index_file)
+            and os.path.getmtime(db_file) >= os.path.getmtime(index_file))
+
+
+def save_lazy_docstore(vector_store: FAISS, vs_path: str):
+    '''
+    将 docstore 与 index_to_docstore_id 导出为 sqlite，供下次延迟加载
+    '''
+    db_file = os.path.join(vs_path, DOCSTORE_FILE)
+    tmp_file = db_file + ".tmp"
+    if os.path.isfile(tmp_file):
+        os.remove(tmp_file)
+    docs = vector_store.docstore._dict
+    conn = sqlite3.connect(tmp_file)
+    try:
+        conn.execute("CREATE TABLE docs (id TEXT PRIMARY KEY, pos INTEGER, page_content TEXT, metadata TEXT)")
+        conn.executemany(
+            "INSERT INTO docs VALUES (?, ?, ?, ?)",
+            ((id, pos, docs[id].page_content, json.dumps(docs[id].metadata, ensure_ascii=False))
+             for pos, id in vector_store.index_to_docstore_id.items()),
+        )
+        conn.execute("CREATE INDEX idx_docs_pos ON docs (pos)")
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp_file, db_file)
+
+
+def load_lazy_vector_store(vs_path: str, embeddings: Embeddings, **kwargs) -> FAISS:
+    '''
+    以内存映射方式打开 index.faiss（不支持 mmap 的索引类型则正常读取），docstore 按需从 sqlite 读取
+    '''
+    faiss = dependable_faiss_import()
+    index_file = os.path.join(vs_path, "index.faiss")
+    try:
+        index = faiss.read_index(index_file, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    except RuntimeError as e:
+        logger.info(f"向量库 {vs_path} 不支持内存映射，将完整读取：{e}")
+        index = faiss.read_index(index_file)
+    docstore = LazyDocstore(os.path.join(vs_path, DOCSTORE_FILE))
+    index_to_docstore_id = SqlitePositionDict(docstore._dict)
+    return FAISS(embeddings, index, docstore, index_to_docstore_id, **kwargs)
+
+
+def close_lazy(vector_store: FAISS):
+    '''
+    关闭延迟加载向量库的 sqlite 连接，在从缓存中移除时调用
+    '''
+    if is_lazy(vector_store):
+        vector_store.docstore._dict.close()
+
+
+def to_memory(vector_store: FAISS) -> FAISS:
+    '''
+    将延迟加载的向量库完整读入内存，使其可写。原地修改并返回 vector_store
+    '''
+    if is_lazy(vector_store):
+        faiss = dependable_faiss_import()
+        docs = vector_store.docstore._dict
+        vector_store.index = faiss.deserialize_index(faiss.serialize_index(vector_store.index))
+        vector_store.index_to_docstore_id = dict(vector_store.index_to_docstore_id.items())
+        vector_store.docstore = InMemoryDocstore(dict(docs.items()))
+        docs.close()
+    return vector_store
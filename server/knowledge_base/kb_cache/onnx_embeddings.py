@@ -0,0 +1,152 @@
+'''
+使用 ONNX Runtime 运行本地Embeddings模型（bge-*, m3e, text2vec 等 BERT 类模型），可选 int8 动态量化，适合没有GPU的部署。
+首次加载时将模型导出为 ONNX 并保存在模型目录的 onnx 子目录中（模型目录不可写时保存在临时目录），之后直接加载。
+池化方式与 sentence_transformers 一致：读取模型目录中的 1_Pooling/config.json，bge 默认使用 CLS，其余默认使用 mean。
+'''
+import json
+import os
+import tempfile
+from typing import List
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+import configs
+from configs import logger
+from configs.basic_config import BASE_TEMP_DIR
+
+EMBEDDING_ONNX_THREADS = getattr(configs, "EMBEDDING_ONNX_THREADS", 0)
+
+
+def _pooling_mode(model_name: str, model_path: str) -> str:
+    config_file = os.path.join(model_path, "1_Pooling", "config.json")
+    if os.path.isfile(config_file):
+        with open(config_file, encoding="utf-8") as fp:
+            config = json.load(fp)
+        if config.get("pooling_mode_cls_token"):
+            return "cls"
+        if config.get("pooling_mode_mean_tokens"):
+            return "mean"
+    return "cls" if "bge-" in model_name else "mean"
+
+
+def export_onnx(model_path: str, onnx_file: str, quantize: bool = False) -> str:
+    '''
+    将 transformers 模型导出为 ONNX，quantize=True 时再进行 int8 动态量化。返回最终的 onnx 文件路径
+    '''
+    quantized_file = onnx_file.replace(".onnx", ".int8.onnx")
+    if not os.path.isfile(onnx_file):
+        import torch
+        from transformers import AutoModel, AutoTokenizer
+
+        logger.info(f"将模型 {model_path} 导出为 ONNX：{onnx_file}")
+        os.makedirs(os.path.dirname(onnx_file), exist_ok=True)
+        tokenizer = AutoTokenizer.from_pretrained(model_path)
+        model = AutoModel.from_pretrained(model_path).eval()
+        inputs = tokenizer(["导出 ONNX"], return_tensors="pt")
+        input_names = list(inputs.keys())
+        dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+        dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+        # 多个进程可能同时导出同一模型：各自写入独立的临时文件，完成后原子替换
+        fd, tmp_file = tempfile.mkstemp(suffix=".onnx.tmp", dir=os.path.dirname(onnx_file))
+        os.close(fd)
+        try:
+            with torch.no_grad():
+                torch.onnx.export(model,
+                                  tuple(inputs[name] for name in input_names),
+                                  tmp_file,
+                                  input_names=input_names,
+                                  output_names=["last_hidden_state"],
+                                  dynamic_axes=dynamic_axes,
+                                  opset_version=14)
+            os.replace(tmp_file, onnx_file)
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+    if quantize:
+        if not os.path.isfile(quantized_file):
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+
+            logger.info(f"对 {onnx_file} 进行 int8 动态量化：{quantized_file}")
+            fd, tmp_file = tempfile.mkstemp(suffix=".onnx.tmp", dir=os.path.dirname(quantized_file))
+            os.close(fd)
+            try:
+                quantize_dynamic(onnx_file, tmp_file, weight_type=QuantType.QInt8)
+                os.replace(tmp_file, quantized_file)
+            finally:
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+        return quantized_file
+    return onnx_file
+
+
+class OnnxEmbeddings(Embeddings):
+    def __init__(
+        self,
+        model_name: str,
+        model_path: str,
+        quantize: bool = False,
+        device: str = "cpu",
+        normalize: bool = False,
+        query_instruction: str = "",
+        batch_size: int = 32,
+        max_length: int = 512,
+    ):
+        '''
+        model_name: 模型名称，用于判断默认的池化方式
+        quantize: 是否使用 int8 动态量化的模型
+        normalize: 是否对输出向量做 L2 归一化（与 HuggingFaceBgeEmbeddings 的默认行为一致）
+        '''
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        if os.path.isdir(model_path) and os.access(model_path, os.W_OK):
+            onnx_dir = os.path.join(model_path, "onnx")
+        else:
+            onnx_dir = os.path.join(BASE_TEMP_DIR, "onnx", model_name)
+        self.onnx_file = export_onnx(model_path, os.path.join(onnx_dir, "model.onnx"), quantize=quantize)
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if EMBEDDING_ONNX_THREADS > 0:
+            options.intra_op_num_threads = EMBEDDING_ONNX_THREADS
+        providers = ["CPUExecutionProvider"]
+        if device == "cuda" and "CUDAExecutionProvider" in ort.get_available_providers():
+            providers.insert(0, "CUDAExecutionProvider")
+        self.session = ort.InferenceSession(self.onnx_file, options, providers=providers)
+        self.input_names = {x.name for x in self.session.get_inputs()}
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path)
+        self.pooling = _pooling_mode(model_name, model_path)
+        self.normalize = normalize
+        self.query_instruction = query_instruction
+        self.batch_size = batch_size
+        self.max_length = max_length
+
+    def memory_size(self) -> int:
+        return os.path.getsize(self.onnx_file)
+
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        result = []
+        for i in range(0, len(texts), self.batch_size):
+            inputs = self.tokenizer(texts[i: i + self.batch_size],
+                                    padding=True,
+                                    truncation=True,
+                                    max_length=self.max_length,
+                                    return_tensors="np")
+            feed = {k: v.astype(np.int64) for k, v in inputs.items() if k in self.input_names}
+            hidden = self.session.run(None, feed)[0]
+            if self.pooling == "cls":
+                embeddings = hidden[:, 0]
+            else:
+                mask = inputs["attention_mask"][..., None].astype(hidden.dtype)
+                embeddings = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            if self.normalize:
+                embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+            result.append(embeddings.astype(np.float32))
+        return np.concatenate(result) if result else np.zeros((0, 0), dtype=np.float32)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed([t.replace("\n", " ") for t in texts]).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed([self.query_instruction + text.replace("\n", " ")])[0].tolist()
@@ -0,0 +1,215 @@
+'''
+API启动时在后台预加载知识库、Embeddings模型与OCR引擎，并执行一次检索进行预热，避免首个请求承担加载耗时。
+同时记录最近使用的知识库，供 PRELOAD_KNOWLEDGE_BASES = "recent" 时使用。
+'''
+import atexit
+import copy
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List
+
+import configs
+from configs import KB_ROOT_PATH, CACHED_VS_NUM, SCORE_THRESHOLD, logger, log_verbose
+
+PRELOAD_KNOWLEDGE_BASES = getattr(configs, "PRELOAD_KNOWLEDGE_BASES", [])
+PRELOAD_EMBED_MODELS = getattr(configs, "PRELOAD_EMBED_MODELS", [])
+OCR_PRELOAD = getattr(configs, "OCR_PRELOAD", True)
+
+
+RECENT_KBS_FILE = os.path.join(KB_ROOT_PATH, "recent_kbs.json")
+RECENT_KBS_NUM = 20
+# 最近使用的知识库在内存中更新，每隔该时间(秒)及退出时写入磁盘，检索请求中不写文件
+RECENT_KBS_FLUSH_INTERVAL = 60
+
+_recent_kbs = None
+_recent_dirty = False
+_recent_lock = threading.Lock()
+_flush_thread = None
+
+_preload_status = {
+    "status": "pending",  # pending, loading, ready
+    "embed_models": {},
+    "knowledge_bases": {},
+    "ocr": {},
+}
+_status_lock = threading.Lock()
+
+
+def _load_recent_kbs() -> OrderedDict:
+    global _recent_kbs
+    if _recent_kbs is None:
+        _recent_kbs = OrderedDict()
+        try:
+            with open(RECENT_KBS_FILE, encoding="utf-8") as fp:
+                for kb_name in reversed(json.load(fp)):  # 文件中最近使用的在前
+                    _recent_kbs[kb_name] = None
+        except Exception:
+            pass
+    return _recent_kbs
+
+
+def flush_recent_kbs():
+    '''
+    将最近使用的知识库写入磁盘，没有变化时不写
+    '''
+    global _recent_dirty
+    with _recent_lock:
+        if not _recent_dirty:
+            return
+        kbs = list(reversed(_recent_kbs))
+        _recent_dirty = False
+    try:
+        with open(RECENT_KBS_FILE, "w", encoding="utf-8") as fp:
+            json.dump(kbs, fp, ensure_ascii=False)
+    except Exception as e:
+        logger.warning(f"保存最近使用的知识库失败：{e}")
+
+
+def _start_flush_thread():
+    global _flush_thread
+    if _flush_thread is not None:
+        return
+
+    def run():
+        while True:
+            time.sleep(RECENT_KBS_FLUSH_INTERVAL)
+            flush_recent_kbs()
+
+    _flush_thread = threading.Thread(target=run, name="recent_kbs_flush", daemon=True)
+    _flush_thread.start()
+    atexit.register(flush_recent_kbs)
+
+
+def record_kb_usage(kb_name: str):
+    '''
+    记录知识库的使用。只更新内存中的顺序，由后台线程定期写入磁盘
+    '''
+    global _recent_dirty
+    with _recent_lock:
+        recent = _load_recent_kbs()
+        if recent and next(reversed(recent)) == kb_name:
+            return
+        recent[kb_name] = None
+        recent.move_to_end(kb_name)
+        while len(recent) > RECENT_KBS_NUM:
+            recent.popitem(last=False)
+        _recent_dirty = True
+        _start_flush_thread()
+
+
+def list_recent_kbs(num: int = None) -> List[str]:
+    with _recent_lock:
+        kbs = list(reversed(_load_recent_kbs()))
+    return kbs[:num] if num else kbs
+
+
+def get_preload_kb_names() -> List[str]:
+    if PRELOAD_KNOWLEDGE_BASES == "recent":
+        return list_recent_kbs(max(CACHED_VS_NUM, 1))
+    return list(PRELOAD_KNOWLEDGE_BASES or [])
+
+
+def should_preload_ocr() -> bool:
+    # 开启 DOC_PARSE_PROCESSES 时 OCR 在解析子进程中进行，由子进程各自预热
+    from server.knowledge_base.doc_process_pool import use_process_pool
+    from server.knowledge_base.utils import ocr_loader_configured
+    return OCR_PRELOAD and not use_process_pool() and ocr_loader_configured()
+
+
+def get_preload_status() -> Dict:
+    with _status_lock:
+        return copy.deepcopy(_preload_status)
+
+
+def _update_status(section: str, name: str = None, **fields) -> None:
+    # 预加载线程与 get_preload_status 并发访问 _preload_status，修改都在锁内进行
+    with _status_lock:
+        if section == "status":
+            _preload_status["status"] = fields["status"]
+        elif name is None:
+            _preload_status[section] = {**_preload_status[section], **fields}
+        else:
+            _preload_status[section][name] = {**_preload_status[section].get(name, {}), **fields}
+
+
+def preload_and_warmup():
+    '''
+    依次加载配置的Embeddings模型、知识库与OCR引擎，并用一次检索进行预热。单个失败不影响其它项。
+    '''
+    from server.knowledge_base.kb_service.base import KBServiceFactory
+    from server.embeddings_api import embed_texts
+
+    _update_status("status", status="loading")
+    try:
+        kb_names = get_preload_kb_names()
+        embed_models = list(PRELOAD_EMBED_MODELS or [])
+        services = {}
+        for kb_name in kb_names:
+            _update_status("knowledge_bases", kb_name, status="pending")
+            if kb := KBServiceFactory.get_service_by_name(kb_name):
+                services[kb_name] = kb
+                if kb.embed_model not in embed_models:
+                    embed_models.append(kb.embed_model)
+
+        for model in embed_models:
+            _update_status("embed_models", model, status="loading")
+            start = time.time()
+            resp = embed_texts(texts=["warmup"], embed_model=model, to_query=True)
+            status = {"elapsed": round(time.time() - start, 3)}
+            if resp.code == 200:
+                status["status"] = "ready"
+            else:
+                status.update(status="failed", error=resp.msg)
+            _update_status("embed_models", model, **status)
+            logger.info(f"预加载Embeddings模型 {model}：{status}")
+
+        for kb_name in kb_names:
+            if (kb := services.get(kb_name)) is None:
+                _update_status("knowledge_bases", kb_name, status="failed", error=f"未找到知识库 {kb_name}")
+                continue
+            _update_status("knowledge_bases", kb_name, status="loading")
+            start = time.time()
+            status = {"status": "ready"}
+            try:
+                # 直接调用 do_search，预热不计入最近使用的知识库
+                kb.do_search("warmup", 1, SCORE_THRESHOLD)
+            except Exception as e:
+                msg = f"预加载知识库 {kb_name} 时出错：{e}"
+                logger.error(f'{e.__class__.__name__}: {msg}',
+                             exc_info=e if log_verbose else None)
+                status.update(status="failed", error=msg)
+            status["elapsed"] = round(time.time() - start, 3)
+            _update_status("knowledge_bases", kb_name, **status)
+            logger.info(f"预加载知识库 {kb_name}：{status}")
+
+        if should_preload_ocr():
+            from document_loaders.ocr import get_ocr_pool
+            _update_status("ocr", status="loading")
+            start = time.time()
+            status = {"status": "ready"}
+            try:
+                get_ocr_pool().warmup()
+            except Exception as e:
+                msg = f"预加载OCR引擎时出错：{e}"
+                logger.error(f'{e.__class__.__name__}: {msg}',
+                             exc_info=e if log_verbose else None)
+                status.update(status="failed", error=msg)
+            status["elapsed"] = round(time.time() - start, 3)
+            _update_status("ocr", **status)
+    except Exception as e:
+        logger.error(f"预加载知识库时出错：{e}", exc_info=e if log_verbose else None)
+    finally:
+        _update_status("status", status="ready")
+
+
+def start_preload():
+    '''
+    在后台线程中预加载，不阻塞API启动
+    '''
+    if not get_preload_kb_names() and not PRELOAD_EMBED_MODELS and not should_preload_ocr():
+        _update_status("status", status="ready")
+        return
+    threading.Thread(target=preload_and_warmup, name="kb_preload", daemon=True).start()
@@ -1,4 +1,7 @@
+import heapq
 import os
+import queue
+import threading
 import urllib
 from fastapi import File, Form, Body, Query, UploadFile
 from configs import (DEFAULT_VS_TYPE, EMBEDDING_MODEL,
@@ -11,16 +14,23 @@ from server.knowledge_base.utils import (validate_kb_name, list_files_from_folde
 from fastapi.responses import StreamingResponse, FileResponse
 from pydantic import Json
 import json
-from server.knowledge_base.kb_service.base import KBServiceFactory
+import numpy as np
+from server.knowledge_base.kb_service.base import KBServiceFactory, KBService, EmbeddingsFunAdapter
+from server.knowledge_base.ingest_pipeline import IngestPipeline
 from server.db.repository.knowledge_file_repository import get_file_detail
 from langchain.docstore.document import Document
-from typing import List
+from typing import Dict, List, Optional, Tuple
 
 
 class DocumentWithScore(Document):
     score: float = None
 
 
+class FederatedDocumentWithScore(DocumentWithScore):
+    knowledge_base_name: str
+    relevance: float = None
+
+
 def search_docs(
         query: str = Body(..., description="用户输入", examples=["你好"]),
         knowledge_base_name: str = Body(..., description="知识库名称", examples=["samples"]),
@@ -30,15 +40,93 @@ def search_docs(
                                                   "SCORE越小，相关度越高，"
                                                   "取到1相当于不筛选，建议设置在0.5左右",
                                       ge=0, le=1),
+        nprobe: int = Body(None, description="FAISS IVF索引检索的聚类数，为空时使用默认值", ge=1),
+        ef_search: int = Body(None, description="FAISS HNSW索引检索的候选数，为空时使用默认值", ge=1),
 ) -> List[DocumentWithScore]:
     kb = KBServiceFactory.get_service_by_name(knowledge_base_name)
     if kb is None:
         return []
-    docs = kb.search_docs(query, top_k, score_threshold)
+    docs = kb.search_docs(query, top_k, score_threshold, nprobe=nprobe, ef_search=ef_search)
     data = [DocumentWithScore(**x[0].dict(), score=x[1]) for x in docs]
     return data
 
 
+def search_docs_batch(
+        queries: List[str] = Body(..., description="用户输入列表", examples=[["你好", "如何启动api服务"]]),
+        knowledge_base_name: str = Body(..., description="知识库名称", examples=["samples"]),
+        top_k: int = Body(VECTOR_SEARCH_TOP_K, description="每个问题的匹配向量数"),
+        score_threshold: float = Body(SCORE_THRESHOLD,
+                                      description="知识库匹配相关度阈值，取值范围在0-1之间，"
+                                                  "SCORE越小，相关度越高，"
+                                                  "取到1相当于不筛选，建议设置在0.5左右",
+                                      ge=0, le=1),
+        nprobe: int = Body(None, description="FAISS IVF索引检索的聚类数，为空时使用默认值", ge=1),
+        ef_search: int = Body(None, description="FAISS HNSW索引检索的候选数，为空时使用默认值", ge=1),
+) -> List[List[DocumentWithScore]]:
+    '''
+    同时检索多个问题：所有问题一次完成向量化，FAISS知识库只进行一次批量检索。返回结果与 queries 一一对应
+    '''
+    kb = KBServiceFactory.get_service_by_name(knowledge_base_name)
+    if kb is None:
+        return [[] for _ in queries]
+    results = kb.search_docs_batch(queries, top_k, score_threshold, nprobe=nprobe, ef_search=ef_search)
+    data = [[DocumentWithScore(**x[0].dict(), score=x[1]) for x in docs] for docs in results]
+    return data
+
+
+def search_docs_federated(
+        query: str = Body(..., description="用户输入", examples=["你好"]),
+        knowledge_base_names: List[str] = Body(..., description="知识库名称列表", examples=[["samples"]]),
+        top_k: int = Body(VECTOR_SEARCH_TOP_K, description="合并后返回的匹配向量数"),
+        score_threshold: float = Body(SCORE_THRESHOLD,
+                                      description="知识库匹配相关度阈值，取值范围在0-1之间，"
+                                                  "SCORE越小，相关度越高，"
+                                                  "取到1相当于不筛选，建议设置在0.5左右",
+                                      ge=0, le=1),
+) -> List[FederatedDocumentWithScore]:
+    '''
+    同时检索多个知识库：使用相同 Embedding 模型的知识库只向量化一次，各知识库并发检索，
+    分数统一转换为 0~1 的相关度（relevance，越大越相关）后合并，返回全局 top_k，并标注来源知识库
+    '''
+    groups: Dict[str, List[KBService]] = {}
+    for name in dict.fromkeys(knowledge_base_names):
+        if (kb := KBServiceFactory.get_service_by_name(name)) is not None:
+            groups.setdefault(kb.embed_model, []).append(kb)
+
+    def embed(embed_model: str) -> Tuple[str, Optional[np.ndarray]]:
+        # 某个模型向量化失败时只跳过使用该模型的知识库，不影响其它知识库
+        try:
+            return embed_model, EmbeddingsFunAdapter(embed_model).embed_queries([query])
+        except Exception as e:
+            names = [kb.kb_name for kb in groups[embed_model]]
+            logger.error(f"使用 {embed_model} 向量化查询时出错，跳过知识库 {names}：{e}",
+                         exc_info=e if log_verbose else None)
+            return embed_model, None
+
+    # 只为存在按向量检索的知识库的分组向量化
+    params = [{"embed_model": m} for m, kbs in groups.items() if any(kb.can_search_by_embeddings() for kb in kbs)]
+    embeddings = dict(run_in_thread_pool(embed, params=params))
+
+    def search(kb: KBService) -> List[FederatedDocumentWithScore]:
+        try:
+            if kb.can_search_by_embeddings():
+                if (query_embeddings := embeddings[kb.embed_model]) is None:
+                    return []
+                docs = kb.search_docs_by_embeddings(query_embeddings, top_k, score_threshold)[0]
+            else:
+                docs = kb.search_docs(query, top_k, score_threshold)
+        except Exception as e:
+            logger.error(f"检索知识库 {kb.kb_name} 时出错：{e}", exc_info=e if log_verbose else None)
+            return []
+        return [FederatedDocumentWithScore(**doc.dict(), score=score, knowledge_base_name=kb.kb_name,
+                                           relevance=kb.normalize_score(score))
+                for doc, score in docs]
+
+    results = run_in_thread_pool(search, params=[{"kb": kb} for kbs in groups.values() for kb in kbs])
+    data = [doc for docs in results for doc in docs]
+    return heapq.nlargest(top_k, data, key=lambda x: x.relevance)
+
+
 def list_files(
         knowledge_base_name: str
 ) -> ListResponse:
@@ -169,11 +257,9 @@ def upload_docs(
             chunk_overlap=chunk_overlap,
             zh_title_enhance=zh_title_enhance,
             docs=docs,
-            not_refresh_vs_cache=True,
+            not_refresh_vs_cache=not_refresh_vs_cache,
         )
         failed_files.update(result.data["failed_files"])
-        if not not_refresh_vs_cache:
-            kb.save_vector_store()
 
     return BaseResponse(code=200, msg="文件上传与向量化完成", data={"failed_files": failed_files})
 
@@ -267,38 +353,39 @@ def update_docs(
                              exc_info=e if log_verbose else None)
                 failed_files[file_name] = msg
 
-    # 从文件生成docs，并进行向量化。
-    # 这里利用了KnowledgeFile的缓存功能，在多线程中加载Document，然后传给KnowledgeFile
-    for status, result in files2docs_in_thread(kb_files,
-                                               chunk_size=chunk_size,
-                                               chunk_overlap=chunk_overlap,
-                                               zh_title_enhance=zh_title_enhance):
-        if status:
-            kb_name, file_name, new_docs = result
-            kb_file = KnowledgeFile(filename=file_name,
-                                    knowledge_base_name=knowledge_base_name)
-            kb_file.splited_docs = new_docs
-            kb.update_doc(kb_file, not_refresh_vs_cache=True)
-        else:
-            kb_name, file_name, error = result
-            failed_files[file_name] = error
-
-    # 将自定义的docs进行向量化
-    for file_name, v in docs.items():
-        try:
-            v = [x if isinstance(x, Document) else Document(**x) for x in v]
-            kb_file = KnowledgeFile(filename=file_name, knowledge_base_name=knowledge_base_name)
-            kb.update_doc(kb_file, docs=v, not_refresh_vs_cache=True)
-        except Exception as e:
-            msg = f"为 {file_name} 添加自定义docs时出错：{e}"
-            logger.error(f'{e.__class__.__name__}: {msg}',
-                         exc_info=e if log_verbose else None)
-            failed_files[file_name] = msg
+    # 从文件生成docs，并进行向量化。解析、向量化与写入在流水线中并行
+    with kb.batch_update(num_files=len(file_names)):
+        pipeline = IngestPipeline(kb, kb_files,
+                                  chunk_size=chunk_size,
+                                  chunk_overlap=chunk_overlap,
+                                  zh_title_enhance=zh_title_enhance,
+                                  update=True)
+        for event in pipeline.run():
+            if event["type"] == "file" and not event["status"]:
+                failed_files[event["file"]] = event["error"]
+
+        # 将自定义的docs进行向量化
+        for file_name, v in docs.items():
+            try:
+                v = [x if isinstance(x, Document) else Document(**x) for x in v]
+                kb_file = KnowledgeFile(filename=file_name, knowledge_base_name=knowledge_base_name)
+                kb.update_doc(kb_file, docs=v, not_refresh_vs_cache=True)
+            except Exception as e:
+                msg = f"为 {file_name} 添加自定义docs时出错：{e}"
+                logger.error(f'{e.__class__.__name__}: {msg}',
+                             exc_info=e if log_verbose else None)
+                failed_files[file_name] = msg
 
-    if not not_refresh_vs_cache:
-        kb.save_vector_store()
+        if not not_refresh_vs_cache:
+            kb.save_vector_store()
+
+    # 大文件分批写入并保存，在新版本发布后直接写入当前版本
+    for event in pipeline.run_large_files():
+        if event["type"] == "file" and not event["status"]:
+            failed_files[event["file"]] = event["error"]
+    stats = pipeline.stats()
 
-    return BaseResponse(code=200, msg=f"更新文档完成", data={"failed_files": failed_files})
+    return BaseResponse(code=200, msg=f"更新文档完成", data={"failed_files": failed_files, "stats": stats})
 
 
 def download_doc(
@@ -358,43 +445,100 @@ def recreate_vector_store(
     set allow_empty_kb to True make it applied on empty knowledge base which it not in the info.db or having no documents.
     """
 
-    def output():
-        kb = KBServiceFactory.get_service(knowledge_base_name, vs_type, embed_model)
-        if not kb.exists() and not allow_empty_kb:
-            yield {"code": 404, "msg": f"未找到知识库 ‘{knowledge_base_name}’"}
-        else:
-            if kb.exists():
-                kb.clear_vs()
-            kb.create_kb()
-            files = list_files_from_folder(knowledge_base_name)
-            kb_files = [(file, knowledge_base_name) for file in files]
-            i = 0
-            for status, result in files2docs_in_thread(kb_files,
-                                                       chunk_size=chunk_size,
-                                                       chunk_overlap=chunk_overlap,
-                                                       zh_title_enhance=zh_title_enhance):
-                if status:
-                    kb_name, file_name, docs = result
-                    kb_file = KnowledgeFile(filename=file_name, knowledge_base_name=kb_name)
-                    kb_file.splited_docs = docs
+    def rebuild(kb: KBService):
+        finished = 0
+
+        def progress_messages(events):
+            nonlocal finished
+            for event in events:
+                file_name = event["file"]
+                if event["type"] == "embed":
+                    yield json.dumps({
+                        "code": 200,
+                        "msg": f"({finished} / {len(files)}): {file_name} 向量化 {event['embedded']} / {event['embed_total']}",
+                        "total": len(files),
+                        "finished": finished,
+                        "doc": file_name,
+                        "embedded": event["embedded"],
+                        "embed_total": event["embed_total"],
+                        "stats": event["stats"],
+                    }, ensure_ascii=False)
+                elif event["type"] == "lazy":
+                    yield json.dumps({
+                        "code": 200,
+                        "msg": f"({finished} / {len(files)}): {file_name} 已写入 {event['chunks']} 个文本块",
+                        "total": len(files),
+                        "finished": finished,
+                        "doc": file_name,
+                        "chunks": event["chunks"],
+                        "stats": event["stats"],
+                    }, ensure_ascii=False)
+                elif event["status"]:
+                    finished += 1
                     yield json.dumps({
                         "code": 200,
-                        "msg": f"({i + 1} / {len(files)}): {file_name}",
+                        "msg": f"({finished} / {len(files)}): {file_name}",
                         "total": len(files),
-                        "finished": i + 1,
+                        "finished": finished,
                         "doc": file_name,
+                        "stats": event["stats"],
                     }, ensure_ascii=False)
-                    kb.add_doc(kb_file, not_refresh_vs_cache=True)
                 else:
-                    kb_name, file_name, error = result
-                    msg = f"添加文件‘{file_name}’到知识库‘{knowledge_base_name}’时出错：{error}。已跳过。"
+                    finished += 1
+                    msg = f"添加文件‘{file_name}’到知识库‘{knowledge_base_name}’时出错：{event['error']}。已跳过。"
                     logger.error(msg)
                     yield json.dumps({
                         "code": 500,
                         "msg": msg,
                     })
-                i += 1
+
+        # 在新的向量库上重建，完成后一次性发布，重建期间仍可检索旧版本
+        with kb.batch_update(rebuild=True):
+            if kb.exists():
+                kb.clear_vs()
+            kb.create_kb()
+            files = list_files_from_folder(knowledge_base_name)
+            kb_files = []
+            for file in files:
+                try:
+                    kb_files.append(KnowledgeFile(filename=file, knowledge_base_name=knowledge_base_name))
+                except Exception as e:
+                    msg = f"添加文件‘{file}’到知识库‘{knowledge_base_name}’时出错：{e}。已跳过。"
+                    logger.error(msg)
+                    yield json.dumps({"code": 500, "msg": msg}, ensure_ascii=False)
+            # 解析、向量化与写入在流水线中并行，stats 为各阶段的处理数量与吞吐量
+            pipeline = IngestPipeline(kb, kb_files,
+                                      chunk_size=chunk_size,
+                                      chunk_overlap=chunk_overlap,
+                                      zh_title_enhance=zh_title_enhance)
+            yield from progress_messages(pipeline.run())
             if not not_refresh_vs_cache:
                 kb.save_vector_store()
+        # 大文件分批写入并保存，在新版本发布后直接写入当前版本
+        yield from progress_messages(pipeline.run_large_files())
+
+    def output():
+        kb = KBServiceFactory.get_service(knowledge_base_name, vs_type, embed_model)
+        if not kb.exists() and not allow_empty_kb:
+            yield {"code": 404, "msg": f"未找到知识库 ‘{knowledge_base_name}’"}
+            return
+        # 重建在单独的线程中进行，客户端读取缓慢或断开时不会一直占用向量库的写入锁
+        messages = queue.Queue()
+
+        def run():
+            try:
+                for msg in rebuild(kb):
+                    messages.put(msg)
+            except Exception as e:
+                msg = f"重建知识库‘{knowledge_base_name}’时出错：{e}"
+                logger.error(f'{e.__class__.__name__}: {msg}',
+                             exc_info=e if log_verbose else None)
+                messages.put(json.dumps({"code": 500, "msg": msg}, ensure_ascii=False))
+            finally:
+                messages.put(None)
+
+        threading.Thread(target=run, name="recreate_vector_store", daemon=True).start()
+        while (msg := messages.get()) is not None:
+            yield msg
 
     return StreamingResponse(output(), media_type="text/event-stream")
@@ -1,5 +1,5 @@
-import operator
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
 
 import os
 from pathlib import Path
@@ -14,31 +14,35 @@ from server.db.repository.knowledge_base_repository import (
 from server.db.repository.knowledge_file_repository import (
     add_file_to_db, delete_file_from_db, delete_files_from_db, file_exists_in_db,
     count_files_from_db, list_files_from_db, get_file_detail, delete_file_from_db,
-    list_docs_from_db,
+    list_docs_from_db, add_docs_to_db, delete_docs_from_db, count_docs_from_db,
 )
 
-from configs import (kbs_config, VECTOR_SEARCH_TOP_K, SCORE_THRESHOLD,
-                     EMBEDDING_MODEL, KB_INFO)
+import configs
+from configs import kbs_config, VECTOR_SEARCH_TOP_K, SCORE_THRESHOLD, EMBEDDING_MODEL, KB_INFO, logger
 from server.knowledge_base.utils import (
     get_kb_path, get_doc_path, KnowledgeFile,
     list_kbs_from_folder, list_files_from_folder,
+    load_ingest_progress, save_ingest_progress, clear_ingest_progress,
 )
 
-from typing import List, Union, Dict, Optional
+from typing import Callable, Generator, List, Union, Dict, Optional
 
 from server.embeddings_api import embed_texts
 from server.embeddings_api import embed_documents
+from server.knowledge_base.kb_cache.preload import record_kb_usage
 from server.knowledge_base.model.kb_document_model import DocumentWithVSId
 
+LAZY_LOAD_SAVE_INTERVAL = getattr(configs, "LAZY_LOAD_SAVE_INTERVAL", 10)
 
-def normalize(embeddings: List[List[float]]) -> np.ndarray:
+
+def normalize(embeddings: Union[List[List[float]], np.ndarray]) -> np.ndarray:
     '''
     sklearn.preprocessing.normalize 的替代（使用 L2），避免安装 scipy, scikit-learn
+    返回连续的 float32 数组，可直接用于 index.search
     '''
-    norm = np.linalg.norm(embeddings, axis=1)
-    norm = np.reshape(norm, (norm.shape[0], 1))
-    norm = np.tile(norm, (1, len(embeddings[0])))
-    return np.divide(embeddings, norm)
+    embeddings = np.array(embeddings, dtype=np.float32)
+    norm = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return np.divide(embeddings, norm, out=embeddings)
 
 
 class SupportedVSType:
@@ -59,6 +63,7 @@ class KBService(ABC):
         self.kb_name = knowledge_base_name
         self.kb_info = KB_INFO.get(knowledge_base_name, f"关于{knowledge_base_name}的知识库")
         self.embed_model = embed_model
+        self.vs_options: Dict = {}  # 向量库参数，记录在数据库中，由各向量库在 do_init 中加载
         self.kb_path = get_kb_path(self.kb_name)
         self.doc_path = get_doc_path(self.kb_name)
         self.do_init()
@@ -79,7 +84,7 @@ class KBService(ABC):
         if not os.path.exists(self.doc_path):
             os.makedirs(self.doc_path)
         self.do_create_kb()
-        status = add_kb_to_db(self.kb_name, self.kb_info, self.vs_type(), self.embed_model)
+        status = add_kb_to_db(self.kb_name, self.kb_info, self.vs_type(), self.embed_model, self.vs_options)
         return status
 
     def clear_vs(self):
@@ -88,6 +93,7 @@ class KBService(ABC):
         """
         self.do_clear_vs()
         status = delete_files_from_db(self.kb_name)
+        clear_ingest_progress(self.kb_name)
         return status
 
     def drop_kb(self):
@@ -98,11 +104,17 @@ class KBService(ABC):
         status = delete_kb_from_db(self.kb_name)
         return status
 
-    def _docs_to_embeddings(self, docs: List[Document]) -> Dict:
+    def _docs_to_embeddings(self, docs: List[Document], on_progress: Callable[[int, int], None] = None) -> Dict:
         '''
         将 List[Document] 转化为 VectorStore.add_embeddings 可以接受的参数
         '''
-        return embed_documents(docs=docs, embed_model=self.embed_model, to_query=False)
+        return embed_documents(docs=docs, embed_model=self.embed_model, to_query=False, on_progress=on_progress)
+
+    def can_add_by_embeddings(self) -> bool:
+        '''
+        是否可以直接写入 _docs_to_embeddings 的结果(add_doc 的 embedded 参数)，用于在写入前单独完成向量化
+        '''
+        return False
 
     def add_doc(self, kb_file: KnowledgeFile, docs: List[Document] = [], **kwargs):
         """
@@ -118,14 +130,7 @@ class KBService(ABC):
             custom_docs = False
 
         if docs:
-            # 将 metadata["source"] 改为相对路径
-            for doc in docs:
-                try:
-                    source = doc.metadata.get("source", "")
-                    rel_path = Path(source).relative_to(self.doc_path)
-                    doc.metadata["source"] = str(rel_path.as_posix().strip("/"))
-                except Exception as e:
-                    print(f"cannot convert absolute path ({source}) to relative path. error is : {e}")
+            self._relative_sources(docs)
             self.delete_doc(kb_file)
             doc_infos = self.do_add_doc(docs, **kwargs)
             status = add_file_to_db(kb_file,
@@ -136,22 +141,98 @@ class KBService(ABC):
             status = False
         return status
 
+    def _relative_sources(self, docs: List[Document]):
+        # 将 metadata["source"] 改为相对路径
+        for doc in docs:
+            try:
+                source = doc.metadata.get("source", "")
+                rel_path = Path(source).relative_to(self.doc_path)
+                doc.metadata["source"] = str(rel_path.as_posix().strip("/"))
+            except Exception as e:
+                print(f"cannot convert absolute path ({source}) to relative path. error is : {e}")
+
+    def add_doc_lazily(self, kb_file: KnowledgeFile, resume: bool = True, **kwargs) -> Generator[Dict, None, None]:
+        """
+        流式添加大文件：加载、分割、向量化与写入按批进行，内存占用与文件大小无关。
+        每写入 LAZY_LOAD_SAVE_INTERVAL 批保存一次向量库并记录进度，中断后再次调用时从记录的位置继续（文件未修改时）。
+        每次保存后返回进度 {"loaded": 已读取的文档数, "chunks": 已写入的文本块数}。
+        kwargs 传递给 KnowledgeFile.file2text_batches，如 chunk_size, chunk_overlap, zh_title_enhance
+        """
+        progress = load_ingest_progress(kb_file) if resume else None
+        if progress is not None and count_docs_from_db(self.kb_name, kb_file.filename) != progress["chunks"]:
+            logger.warning(f"{self.kb_name}/{kb_file.filename} 的入库进度与数据库不一致，重新添加")
+            progress = None
+        if progress is None:
+            self.delete_doc(kb_file)
+            # 上次中断时文件尚未写入数据库，单独删除已写入的文档信息
+            delete_docs_from_db(kb_name=self.kb_name, file_name=kb_file.filename)
+            progress = {"loaded": 0, "chunks": 0}
+        else:
+            logger.info(f"从第 {progress['loaded']} 个文档继续添加 {self.kb_name}/{kb_file.filename}")
+
+        doc_infos = []  # 文档信息与向量库在同一时间点保存，中断时两者一致
+        try:
+            batches = kb_file.file2text_batches(skip=progress["loaded"], **kwargs)
+            for i, (loaded, docs) in enumerate(batches, 1):
+                if docs:
+                    self._relative_sources(docs)
+                    doc_infos += self.do_add_doc(docs, not_refresh_vs_cache=True) or []
+                progress = {"loaded": loaded, "chunks": progress["chunks"] + len(docs)}
+                if i % LAZY_LOAD_SAVE_INTERVAL == 0:
+                    self.save_vector_store()
+                    add_docs_to_db(kb_name=self.kb_name, file_name=kb_file.filename, doc_infos=doc_infos)
+                    doc_infos = []
+                    save_ingest_progress(kb_file, progress)
+                    yield dict(progress)
+
+            self.save_vector_store()
+            add_docs_to_db(kb_name=self.kb_name, file_name=kb_file.filename, doc_infos=doc_infos)
+        except Exception:
+            self._rollback_lazy_docs(kb_file, [info["id"] for info in doc_infos])
+            raise
+        add_file_to_db(kb_file, custom_docs=False, docs_count=progress["chunks"], doc_infos=[])
+        clear_ingest_progress(self.kb_name, kb_file.filename)
+        yield dict(progress)
+
+    def _rollback_lazy_docs(self, kb_file: KnowledgeFile, ids: List[str]):
+        # 出错时删除上次保存进度之后写入的文档，否则调用者之后保存向量库时会将其持久化，续传时重复添加。
+        # 向量库不支持按 id 删除时删除整个文件，下次重新添加
+        if not ids:
+            return
+        try:
+            self.del_doc_by_ids(ids)
+        except NotImplementedError:
+            self.delete_doc(kb_file)
+            delete_docs_from_db(kb_name=self.kb_name, file_name=kb_file.filename)
+        except Exception as e:
+            logger.error(f"回滚 {self.kb_name}/{kb_file.filename} 未保存的文档时出错：{e}")
+
     def delete_doc(self, kb_file: KnowledgeFile, delete_content: bool = False, **kwargs):
         """
         从知识库删除文件
         """
         self.do_delete_doc(kb_file, **kwargs)
         status = delete_file_from_db(kb_file)
+        clear_ingest_progress(self.kb_name, kb_file.filename)
         if delete_content and os.path.exists(kb_file.filepath):
             os.remove(kb_file.filepath)
         return status
 
+    @contextmanager
+    def batch_update(self, rebuild: bool = False, num_files: int = None):
+        """
+        批量修改向量库。支持快照发布的向量库(FAISS)会在副本上完成全部修改，结束时一次性发布，期间检索不受影响。
+        rebuild=True 表示将从空向量库开始重建。num_files 为将要修改的文件数，只修改一个文件时不值得复制整个向量库。
+        其它向量库直接修改，不做特殊处理。
+        """
+        yield self
+
     def update_info(self, kb_info: str):
         """
         更新知识库介绍
         """
         self.kb_info = kb_info
-        status = add_kb_to_db(self.kb_name, self.kb_info, self.vs_type(), self.embed_model)
+        status = add_kb_to_db(self.kb_name, self.kb_info, self.vs_type(), self.embed_model, self.vs_options)
         return status
 
     def update_doc(self, kb_file: KnowledgeFile, docs: List[Document] = [], **kwargs):
@@ -177,13 +258,81 @@ class KBService(ABC):
                     query: str,
                     top_k: int = VECTOR_SEARCH_TOP_K,
                     score_threshold: float = SCORE_THRESHOLD,
+                    **kwargs,
                     ):
-        docs = self.do_search(query, top_k, score_threshold)
+        '''
+        kwargs 为向量库特有的检索参数，如FAISS近似检索索引的 nprobe / ef_search，其它向量库会忽略
+        '''
+        record_kb_usage(self.kb_name)
+        docs = self.do_search(query, top_k, score_threshold, **kwargs)
         return docs
 
+    def search_docs_batch(self,
+                          queries: List[str],
+                          top_k: int = VECTOR_SEARCH_TOP_K,
+                          score_threshold: float = SCORE_THRESHOLD,
+                          **kwargs,
+                          ) -> List[List]:
+        '''
+        同时检索多个问题，返回与 queries 一一对应的检索结果
+        '''
+        record_kb_usage(self.kb_name)
+        return self.do_search_batch(queries, top_k, score_threshold, **kwargs)
+
+    def do_search_batch(self,
+                        queries: List[str],
+                        top_k: int,
+                        score_threshold: float,
+                        **kwargs,
+                        ) -> List[List]:
+        """
+        批量检索，默认逐个调用 do_search，支持批量检索的向量库可以重写
+        """
+        return [self.do_search(query, top_k, score_threshold, **kwargs) for query in queries]
+
+    def search_docs_by_embeddings(self,
+                                  embeddings: np.ndarray,
+                                  top_k: int = VECTOR_SEARCH_TOP_K,
+                                  score_threshold: float = SCORE_THRESHOLD,
+                                  **kwargs,
+                                  ) -> List[List]:
+        '''
+        使用已经向量化的问题检索，embeddings 须由本知识库的 embed_model 生成，用于多个知识库共用一次向量化。
+        返回与 embeddings 一一对应的检索结果
+        '''
+        record_kb_usage(self.kb_name)
+        return self.do_search_by_embeddings(embeddings, top_k, score_threshold, **kwargs)
+
+    def can_search_by_embeddings(self) -> bool:
+        return type(self).do_search_by_embeddings is not KBService.do_search_by_embeddings
+
+    def do_search_by_embeddings(self,
+                                embeddings: np.ndarray,
+                                top_k: int,
+                                score_threshold: float,
+                                **kwargs,
+                                ) -> List[List]:
+        """
+        按向量检索，支持的向量库重写。全文检索等不支持时抛出 NotImplementedError
+        """
+        raise NotImplementedError(f"{self.vs_type()} 不支持按向量检索")
+
+    def normalize_score(self, score: float) -> float:
+        '''
+        将检索分数转换为 0~1 的相关度（越大越相关），用于合并不同知识库的检索结果。
+        默认分数为归一化向量之间 L2 距离的平方(FAISS, Milvus)，转换后即为余弦相似度
+        '''
+        return min(max(1 - score / 2, 0.0), 1.0)
+
     def get_doc_by_ids(self, ids: List[str]) -> List[Document]:
         return []
 
+    def del_doc_by_ids(self, ids: List[str]) -> bool:
+        """
+        从向量库中删除指定 id 的文档，不修改数据库。支持的向量库重写
+        """
+        raise NotImplementedError(f"{self.vs_type()} 不支持按 id 删除文档")
+
     def list_docs(self, file_name: str = None, metadata: Dict = {}) -> List[DocumentWithVSId]:
         '''
         通过file_name或metadata检索Document
@@ -241,6 +390,7 @@ class KBService(ABC):
                   query: str,
                   top_k: int,
                   score_threshold: float,
+                  **kwargs,
                   ) -> List[Document]:
         """
         搜索知识库子类实自己逻辑
@@ -405,6 +555,13 @@ class EmbeddingsFunAdapter(Embeddings):
         normalized_query_embed = normalize(query_embed_2d)
         return normalized_query_embed[0].tolist()  # 将结果转换为一维数组并返回
 
+    def embed_queries(self, texts: List[str]) -> np.ndarray:
+        '''
+        一次调用模型对多个查询进行向量化，返回 (Q, d) 的 float32 数组，不再转换为 list
+        '''
+        embeddings = embed_texts(texts=texts, embed_model=self.embed_model, to_query=True).data
+        return normalize(embeddings)
+
     # TODO: 暂不支持异步
     # async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
     #     return normalize(await self.embeddings.aembed_documents(texts))
@@ -414,13 +571,7 @@ class EmbeddingsFunAdapter(Embeddings):
 
 
 def score_threshold_process(score_threshold, k, docs):
-    if score_threshold is not None:
-        cmp = (
-            operator.le
-        )
-        docs = [
-            (doc, similarity)
-            for doc, similarity in docs
-            if cmp(similarity, score_threshold)
-        ]
+    if score_threshold is not None and docs:
+        scores = np.fromiter((similarity for _, similarity in docs), dtype=np.float64, count=len(docs))
+        return [docs[i] for i in np.flatnonzero(scores <= score_threshold)[:k]]
     return docs[:k]
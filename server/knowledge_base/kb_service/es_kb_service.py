@@ -124,12 +124,16 @@ class ESKBService(KBService):
 
 
 
-    def do_search(self, query:str, top_k: int, score_threshold: float):
+    def do_search(self, query:str, top_k: int, score_threshold: float, **kwargs):
         # 文本相似性检索
         docs = self.db_init.similarity_search_with_score(query=query,
                                          k=top_k)
         return docs
 
+    def normalize_score(self, score: float) -> float:
+        # Elasticsearch 返回的是 0~1 的相似度，越大越相关
+        return min(max(score, 0.0), 1.0)
+
 
     def do_delete_doc(self, kb_file, **kwargs):
         if self.es_client_python.indices.exists(index=self.index_name):
@@ -1,20 +1,33 @@
+import hashlib
+import heapq
+import itertools
 import os
 import shutil
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack
 
-from configs import SCORE_THRESHOLD
+from configs import SCORE_THRESHOLD, kbs_config
 from server.knowledge_base.kb_service.base import KBService, SupportedVSType, EmbeddingsFunAdapter
 from server.knowledge_base.kb_cache.faiss_cache import kb_faiss_pool, ThreadSafeFaiss
+from server.knowledge_base.kb_cache.faiss_index import default_index_options, check_index_options
+from server.db.repository.knowledge_base_repository import get_kb_detail
 from server.knowledge_base.utils import KnowledgeFile, get_kb_path, get_vs_path
 from server.utils import torch_gc
 from langchain.docstore.document import Document
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
+import numpy as np
+
+
+# 分片向量库并行检索使用的线程池。FAISS 检索时释放 GIL，各分片可以真正并行
+_shard_search_pool = ThreadPoolExecutor(thread_name_prefix="faiss_shard_search")
 
 
 class FaissKBService(KBService):
     vs_path: str
     kb_path: str
     vector_name: str = None
- 
+    _staged: Optional[Dict[str, ThreadSafeFaiss]] = None
+
     def vs_type(self) -> str:
         return SupportedVSType.FAISS
 
@@ -24,27 +37,100 @@ class FaissKBService(KBService):
     def get_kb_path(self):
         return get_kb_path(self.kb_name)
 
-    def load_vector_store(self) -> ThreadSafeFaiss:
+    def shard_names(self) -> List[str]:
+        '''
+        各分片的 vector_name。不分片时只有一个，即 vector_name 本身；
+        分片时为 vector_name/shard_i，每个分片在 kb_faiss_pool 中单独加载和缓存
+        '''
+        num_shards = self.vs_options.get("num_shards") or 1
+        if num_shards <= 1:
+            return [self.vector_name]
+        return [os.path.join(self.vector_name, f"shard_{i}") for i in range(num_shards)]
+
+    def shard_of(self, source: str) -> str:
+        # 按文件名的哈希分片，同一文件的所有文档都在同一个分片中
+        names = self.shard_names()
+        if len(names) == 1:
+            return names[0]
+        return names[int(hashlib.md5(source.encode("utf-8")).hexdigest(), 16) % len(names)]
+
+    def _load_shard(self, vector_name: str) -> ThreadSafeFaiss:
+        if self._staged is not None:  # 批量更新期间，所有读写都作用于待发布的副本
+            return self._staged[vector_name]
         return kb_faiss_pool.load_vector_store(kb_name=self.kb_name,
-                                               vector_name=self.vector_name,
-                                               embed_model=self.embed_model)
+                                               vector_name=vector_name,
+                                               embed_model=self.embed_model,
+                                               index_options=self.vs_options)
+
+    def load_vector_store(self, source: str = None) -> ThreadSafeFaiss:
+        '''
+        加载向量库。分片的知识库需要指定 source（文件名），返回该文件所在的分片
+        '''
+        if source is None and len(self.shard_names()) > 1:
+            raise ValueError(f"知识库 {self.kb_name} 已分片，需要指定文件名")
+        return self._load_shard(self.shard_of(source or ""))
 
     def save_vector_store(self):
-        self.load_vector_store().save(self.vs_path)
+        for name in self.shard_names():
+            vector_store = self._load_shard(name)
+            vector_store.train_index()  # 重建期间推迟的索引训练在保存前完成
+            vector_store.save(get_vs_path(self.kb_name, name))
+
+    @contextmanager
+    def batch_update(self, rebuild: bool = False, num_files: int = None):
+        if (self._staged is not None
+                or not kbs_config.get("faiss", {}).get("snapshot_publish")
+                or (not rebuild and num_files is not None and num_files <= 1)):
+            yield self
+            return
+
+        with ExitStack() as stack:
+            staged = {}
+            for name in self.shard_names():
+                new_store = kb_faiss_pool.new_vector_store(embed_model=self.embed_model) if rebuild else None
+                staged[name] = stack.enter_context(self._load_shard(name).snapshot(new_store))
+                # 重建时所有向量写入后再训练近似检索索引，而不是在向量数量刚达到阈值时用部分向量训练
+                staged[name].rebuild_deferred = rebuild
+            self._staged = staged
+            try:
+                yield self
+            finally:
+                self._staged = None
+            for item in staged.values():
+                item.rebuild_deferred = False
+                item.train_index()
 
     def get_doc_by_ids(self, ids: List[str]) -> List[Document]:
-        with self.load_vector_store().acquire() as vs:
-            return [vs.docstore._dict.get(id) for id in ids]
+        docs = [None] * len(ids)
+        for name in self.shard_names():
+            with self._load_shard(name).acquire(shared=True) as vs:
+                for i, id in enumerate(ids):
+                    docs[i] = docs[i] or vs.docstore._dict.get(id)
+        return docs
+
+    def del_doc_by_ids(self, ids: List[str]) -> bool:
+        for name in self.shard_names():
+            self._load_shard(name).delete_by_ids(ids)
+        return True
 
     def do_init(self):
         self.vector_name = self.vector_name or self.embed_model
         self.kb_path = self.get_kb_path()
         self.vs_path = self.get_vs_path()
+        # 知识库创建时记录的索引选项。旧版本创建的知识库没有记录，按不压缩、不分片的方式加载，
+        # 不能使用配置中的默认值，否则修改配置后分片数与磁盘上的向量库不一致
+        vs_options = get_kb_detail(self.kb_name).get("vs_options")
+        self.vs_options = check_index_options(vs_options) if vs_options else {}
 
     def do_create_kb(self):
+        # 新建知识库未指定索引选项时使用配置中的默认值，由 create_kb 记录到数据库
+        if not self.vs_options and not get_kb_detail(self.kb_name):
+            self.vs_options = default_index_options()
+        self.vs_options = check_index_options(self.vs_options)
         if not os.path.exists(self.vs_path):
             os.makedirs(self.vs_path)
-        self.load_vector_store()
+        for name in self.shard_names():
+            self._load_shard(name)
 
     def do_drop_kb(self):
         self.clear_vs()
@@ -57,24 +143,72 @@ class FaissKBService(KBService):
                   query: str,
                   top_k: int,
                   score_threshold: float = SCORE_THRESHOLD,
+                  **kwargs,
                   ) -> List[Document]:
+        # 向量保持为 float32 数组直接检索，避免 list 与 ndarray 之间的反复转换
+        return self.do_search_batch([query], top_k, score_threshold, **kwargs)[0]
+
+    def do_search_batch(self,
+                        queries: List[str],
+                        top_k: int,
+                        score_threshold: float = SCORE_THRESHOLD,
+                        **kwargs,
+                        ) -> List[List[Tuple[Document, float]]]:
+        '''
+        kwargs 支持 nprobe / ef_search，用于 IVF / HNSW 索引
+        '''
+        if not queries:
+            return []
         embed_func = EmbeddingsFunAdapter(self.embed_model)
-        embeddings = embed_func.embed_query(query)
-        with self.load_vector_store().acquire() as vs:
-            docs = vs.similarity_search_with_score_by_vector(embeddings, k=top_k, score_threshold=score_threshold)
-        return docs
+        embeddings = embed_func.embed_queries(queries)
+        return self.do_search_by_embeddings(embeddings, top_k, score_threshold, **kwargs)
+
+    def do_search_by_embeddings(self,
+                                embeddings: np.ndarray,
+                                top_k: int,
+                                score_threshold: float = SCORE_THRESHOLD,
+                                **kwargs,
+                                ) -> List[List[Tuple[Document, float]]]:
+        if len(embeddings) == 0:
+            return []
+
+        def search(name: str) -> List[List[Tuple[Document, float]]]:
+            return self._load_shard(name).search_batch(embeddings, k=top_k, score_threshold=score_threshold,
+                                                       nprobe=kwargs.get("nprobe"), ef_search=kwargs.get("ef_search"))
+
+        names = self.shard_names()
+        if len(names) == 1:
+            return search(names[0])
+        # 各分片并行检索，每个分片的结果已按距离升序排列，用堆归并取全局 top_k
+        shard_results = list(_shard_search_pool.map(search, names))
+        return [list(itertools.islice(heapq.merge(*results, key=lambda x: x[1]), top_k))
+                for results in zip(*shard_results)]
+
+    def can_add_by_embeddings(self) -> bool:
+        return True
 
     def do_add_doc(self,
                    docs: List[Document],
                    **kwargs,
                    ) -> List[Dict]:
-        data = self._docs_to_embeddings(docs) # 将向量化单独出来可以减少向量库的锁定时间
+        # 将向量化单独出来可以减少向量库的锁定时间。流水线入库时已预先向量化(embedded)
+        data = kwargs.get("embedded") or self._docs_to_embeddings(docs, on_progress=kwargs.get("on_progress"))
 
-        with self.load_vector_store().acquire() as vs:
-            ids = vs.add_embeddings(text_embeddings=zip(data["texts"], data["embeddings"]),
-                                    metadatas=data["metadatas"])
-            if not kwargs.get("not_refresh_vs_cache"):
-                vs.save_local(self.vs_path)
+        # 按文件分配到各自的分片，只锁定和保存涉及的分片
+        shards: Dict[str, List[int]] = {}
+        for i, metadata in enumerate(data["metadatas"]):
+            shards.setdefault(self.shard_of(metadata.get("source", "")), []).append(i)
+        ids = [None] * len(docs)
+        for name, positions in shards.items():
+            vector_store = self._load_shard(name)
+            with vector_store.acquire():
+                shard_ids = vector_store.add_embeddings(
+                    text_embeddings=[(data["texts"][i], data["embeddings"][i]) for i in positions],
+                    metadatas=[data["metadatas"][i] for i in positions])
+                if not kwargs.get("not_refresh_vs_cache"):
+                    vector_store.save(get_vs_path(self.kb_name, name))
+            for i, id in zip(positions, shard_ids):
+                ids[i] = id
         doc_infos = [{"id": id, "metadata": doc.metadata} for id, doc in zip(ids, docs)]
         torch_gc()
         return doc_infos
@@ -82,17 +216,22 @@ class FaissKBService(KBService):
     def do_delete_doc(self,
                       kb_file: KnowledgeFile,
                       **kwargs):
-        with self.load_vector_store().acquire() as vs:
-            ids = [k for k, v in vs.docstore._dict.items() if v.metadata.get("source") == kb_file.filename]
-            if len(ids) > 0:
-                vs.delete(ids)
+        name = self.shard_of(kb_file.filename)
+        vector_store = self._load_shard(name)
+        with vector_store.acquire():
+            ids = vector_store.delete_by_source(kb_file.filename)
             if not kwargs.get("not_refresh_vs_cache"):
-                vs.save_local(self.vs_path)
+                vector_store.save(get_vs_path(self.kb_name, name))
         return ids
 
     def do_clear_vs(self):
+        if self._staged is not None:  # 只清空副本，发布前检索仍使用旧版本
+            for item in self._staged.values():
+                item.clear()
+            return
         with kb_faiss_pool.atomic:
-            kb_faiss_pool.pop((self.kb_name, self.vector_name))
+            for name in self.shard_names():
+                kb_faiss_pool.pop((self.kb_name, name))
         try:
             shutil.rmtree(self.vs_path)
         except Exception:
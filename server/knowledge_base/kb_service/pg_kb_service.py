@@ -52,13 +52,25 @@ class PGKBService(KBService):
             connect.commit()
             shutil.rmtree(self.kb_path)
 
-    def do_search(self, query: str, top_k: int, score_threshold: float):
+    def do_search(self, query: str, top_k: int, score_threshold: float, **kwargs):
         self._load_pg_vector()
         embed_func = EmbeddingsFunAdapter(self.embed_model)
         embeddings = embed_func.embed_query(query)
         docs = self.pg_vector.similarity_search_with_score_by_vector(embeddings, top_k)
         return score_threshold_process(score_threshold, top_k, docs)
 
+    def do_search_by_embeddings(self, embeddings, top_k: int, score_threshold: float, **kwargs):
+        self._load_pg_vector()
+        result = []
+        for embedding in embeddings:
+            docs = self.pg_vector.similarity_search_with_score_by_vector(list(map(float, embedding)), top_k)
+            result.append(score_threshold_process(score_threshold, top_k, docs))
+        return result
+
+    def normalize_score(self, score: float) -> float:
+        # PGVector 返回的是 L2 距离，先平方
+        return super().normalize_score(score ** 2)
+
     def do_add_doc(self, docs: List[Document], **kwargs) -> List[Dict]:
         ids = self.pg_vector.add_documents(docs)
         doc_infos = [{"id": id, "metadata": doc.metadata} for id, doc in zip(ids, docs)]
@@ -58,13 +58,21 @@ class ZillizKBService(KBService):
             self.zilliz.col.release()
             self.zilliz.col.drop()
 
-    def do_search(self, query: str, top_k: int, score_threshold: float):
+    def do_search(self, query: str, top_k: int, score_threshold: float, **kwargs):
         self._load_zilliz()
         embed_func = EmbeddingsFunAdapter(self.embed_model)
         embeddings = embed_func.embed_query(query)
         docs = self.zilliz.similarity_search_with_score_by_vector(embeddings, top_k)
         return score_threshold_process(score_threshold, top_k, docs)
 
+    def do_search_by_embeddings(self, embeddings, top_k: int, score_threshold: float, **kwargs):
+        self._load_zilliz()
+        result = []
+        for embedding in embeddings:
+            docs = self.zilliz.similarity_search_with_score_by_vector(list(map(float, embedding)), top_k)
+            result.append(score_threshold_process(score_threshold, top_k, docs))
+        return result
+
     def do_add_doc(self, docs: List[Document], **kwargs) -> List[Dict]:
         for doc in docs:
             for k, v in doc.metadata.items():
@@ -16,6 +16,7 @@ from server.db.repository.knowledge_metadata_repository import add_summary_to_db
 
 from server.db.base import Base, engine
 from server.db.session import session_scope
+from sqlalchemy import inspect, text
 import os
 from dateutil.parser import parse
 from typing import Literal, List
@@ -23,6 +24,24 @@ from typing import Literal, List
 
 def create_tables():
     Base.metadata.create_all(bind=engine)
+    add_missing_columns()
+
+
+def add_missing_columns():
+    '''
+    create_all 不会修改已存在的表，为旧版本数据库中的表补充新增的字段
+    '''
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+                    logger.info(f"为数据表 {table.name} 添加字段 {column.name}")
 
 
 def reset_tables():
@@ -1,4 +1,5 @@
 import os
+import configs
 from configs import (
     KB_ROOT_PATH,
     CHUNK_SIZE,
@@ -10,7 +11,10 @@ from configs import (
     LLM_MODELS,
     TEXT_SPLITTER_NAME,
 )
+import hashlib
 import importlib
+import itertools
+import shutil
 from text_splitter import zh_title_enhance as func_zh_title_enhance
 import langchain.document_loaders
 from langchain.docstore.document import Document
@@ -18,9 +22,12 @@ from langchain.text_splitter import TextSplitter
 from pathlib import Path
 from server.utils import run_in_thread_pool, get_model_worker_config
 import json
-from typing import List, Union,Dict, Tuple, Generator
+from typing import List, Union,Dict, Tuple, Generator, Iterator, Optional
 import chardet
 
+LAZY_LOAD_FILE_SIZE = getattr(configs, "LAZY_LOAD_FILE_SIZE", 100)
+LAZY_LOAD_BATCH_SIZE = getattr(configs, "LAZY_LOAD_BATCH_SIZE", 1000)
+
 
 def validate_kb_name(knowledge_base_id: str) -> bool:
     # 检查是否包含预期外的字符或路径攻击关键字
@@ -111,6 +118,14 @@ LOADER_DICT = {"UnstructuredHTMLLoader": ['.html'],
 SUPPORTED_EXTS = [ext for sublist in LOADER_DICT.values() for ext in sublist]
 
 
+def ocr_loader_configured() -> bool:
+    '''
+    是否有文件格式使用 RapidOCR 加载器
+    '''
+    from document_loaders.ocr import OCR_LOADERS
+    return any(LOADER_DICT.get(name) for name in OCR_LOADERS)
+
+
 # patch json.dumps to disable ensure_ascii
 def _new_json_dumps(obj, **kwargs):
     kwargs["ensure_ascii"] = False
@@ -129,6 +144,70 @@ class JSONLinesLoader(langchain.document_loaders.JSONLoader):
         super().__init__(*args, **kwargs)
         self._json_lines = True
 
+    def lazy_load(self) -> Iterator[Document]:
+        '''
+        逐行解析，不将整个文件读入内存
+        '''
+        seq_num = 0
+        with self.file_path.open(encoding="utf-8") as f:
+            for line in f:
+                if line := line.strip():
+                    docs = []
+                    self._parse(line, docs)
+                    for doc in docs:
+                        seq_num += 1
+                        if "seq_num" in doc.metadata:  # 与 load() 一致，在整个文件中连续编号
+                            doc.metadata["seq_num"] = seq_num
+                    yield from docs
+
+
+def _lazy_load_csv(loader: langchain.document_loaders.CSVLoader) -> Iterator[Document]:
+    # 与 CSVLoader.load 的结果相同，逐行返回
+    import csv
+    with open(loader.file_path, newline="", encoding=loader.encoding) as csvfile:
+        for i, row in enumerate(csv.DictReader(csvfile, **loader.csv_args)):
+            source = row[loader.source_column] if loader.source_column is not None else loader.file_path
+            content = "\n".join(f"{k.strip()}: {v.strip() if v is not None else v}"
+                                for k, v in row.items()
+                                if k not in loader.metadata_columns)
+            metadata = {"source": source, "row": i}
+            for col in loader.metadata_columns:
+                metadata[col] = row[col]
+            yield Document(page_content=content, metadata=metadata)
+
+
+def _lazy_load_text(file_path: str, block_size: int = 1024 * 1024) -> Iterator[Document]:
+    # 按行读取纯文本（如日志），每约 block_size 个字符作为一个文档
+    with open(file_path, "rb") as fp:
+        encoding = chardet.detect(fp.read(64 * 1024))["encoding"] or "utf-8"
+    with open(file_path, encoding=encoding, errors="replace") as fp:
+        lines, size = [], 0
+        for line in fp:
+            lines.append(line)
+            size += len(line)
+            if size >= block_size:
+                yield Document(page_content="".join(lines), metadata={"source": file_path})
+                lines, size = [], 0
+        if lines:
+            yield Document(page_content="".join(lines), metadata={"source": file_path})
+
+
+def lazy_load_docs(loader) -> Iterator[Document]:
+    '''
+    流式加载文档。优先使用加载器的 lazy_load，langchain 未实现时 CSV 与纯文本使用逐行读取，
+    其它加载器仍一次性加载
+    '''
+    try:
+        return iter(loader.lazy_load())
+    except NotImplementedError:
+        pass
+    if type(loader) is langchain.document_loaders.CSVLoader:
+        return _lazy_load_csv(loader)
+    if type(loader) is langchain.document_loaders.UnstructuredFileLoader and loader.file_path.endswith(".txt"):
+        return _lazy_load_text(loader.file_path)
+    logger.warning(f"{type(loader).__name__} 不支持流式加载，{loader.file_path} 将完整读入内存")
+    return iter(loader.load())
+
 
 langchain.document_loaders.JSONLinesLoader = JSONLinesLoader
 
@@ -164,7 +243,8 @@ def get_loader(loader_name: str, file_path: str, loader_kwargs: Dict = None):
         if not loader_kwargs.get("encoding"):
             # 如果未指定 encoding，自动识别文件编码类型，避免langchain loader 加载文件报编码错误
             with open(file_path, 'rb') as struct_file:
-                encode_detect = chardet.detect(struct_file.read())
+                # 只检测文件开头，避免将大文件整个读入内存
+                encode_detect = chardet.detect(struct_file.read(1024 * 1024))
             if encode_detect is None:
                 encode_detect = {"encoding": "utf-8"}
             loader_kwargs["encoding"] = encode_detect["encoding"]
@@ -281,6 +361,18 @@ class KnowledgeFile:
         self.document_loader_name = get_LoaderClass(self.ext)
         self.text_splitter_name = TEXT_SPLITTER_NAME
 
+    def is_large(self) -> bool:
+        '''
+        是否按大文件流式入库(file2text_batches)
+        '''
+        return LAZY_LOAD_FILE_SIZE > 0 and self.get_size() >= LAZY_LOAD_FILE_SIZE * 1024 * 1024
+
+    def __getstate__(self):
+        # 发送到解析子进程时不携带已加载的文档
+        state = self.__dict__.copy()
+        state["docs"] = state["splited_docs"] = None
+        return state
+
     def file2docs(self, refresh: bool = False):
         if self.docs is None or refresh:
             logger.info(f"{self.document_loader_name} used for {self.filepath}")
@@ -302,24 +394,59 @@ class KnowledgeFile:
         docs = docs or self.file2docs(refresh=refresh)
         if not docs:
             return []
-        if self.ext not in [".csv"]:
-            if text_splitter is None:
-                text_splitter = make_text_splitter(splitter_name=self.text_splitter_name, chunk_size=chunk_size,
-                                                   chunk_overlap=chunk_overlap)
-            if self.text_splitter_name == "MarkdownHeaderTextSplitter":
-                docs = text_splitter.split_text(docs[0].page_content)
-            else:
-                docs = text_splitter.split_documents(docs)
-
+        if self.ext not in [".csv"] and text_splitter is None:
+            text_splitter = make_text_splitter(splitter_name=self.text_splitter_name, chunk_size=chunk_size,
+                                               chunk_overlap=chunk_overlap)
+        docs = self._split_docs(docs, text_splitter, zh_title_enhance)
         if not docs:
             return []
 
         print(f"文档切分示例：{docs[0]}")
-        if zh_title_enhance:
-            docs = func_zh_title_enhance(docs)
         self.splited_docs = docs
         return self.splited_docs
 
+    def _split_docs(self, docs: List[Document], text_splitter: TextSplitter, zh_title_enhance: bool):
+        if self.ext not in [".csv"]:
+            if self.text_splitter_name == "MarkdownHeaderTextSplitter":
+                # 分割每个文档，并保留原文档的 metadata（如 source）
+                docs = [Document(page_content=x.page_content, metadata={**doc.metadata, **x.metadata})
+                        for doc in docs for x in text_splitter.split_text(doc.page_content)]
+            else:
+                docs = text_splitter.split_documents(docs)
+        if docs and zh_title_enhance:
+            docs = func_zh_title_enhance(docs)
+        return docs
+
+    def file2text_batches(
+            self,
+            skip: int = 0,
+            batch_size: int = LAZY_LOAD_BATCH_SIZE,
+            zh_title_enhance: bool = ZH_TITLE_ENHANCE,
+            chunk_size: int = CHUNK_SIZE,
+            chunk_overlap: int = OVERLAP_SIZE,
+            text_splitter: TextSplitter = None,
+    ) -> Generator[Tuple[int, List[Document]], None, None]:
+        '''
+        流式加载并分割文件，每累计约 batch_size 个文本块返回一次 (已读取的文档数, 文本块)，内存占用与文件大小无关。
+        同一个加载器文档的文本块总在同一批中，skip 为跳过的加载器文档数，用于从上次中断的位置继续
+        '''
+        if self.ext not in [".csv"] and text_splitter is None:
+            text_splitter = make_text_splitter(splitter_name=self.text_splitter_name, chunk_size=chunk_size,
+                                               chunk_overlap=chunk_overlap)
+        logger.info(f"{self.document_loader_name} used for {self.filepath} (lazy)")
+        loader = get_loader(loader_name=self.document_loader_name,
+                            file_path=self.filepath,
+                            loader_kwargs=self.loader_kwargs)
+        loaded, batch = skip, []
+        for doc in itertools.islice(lazy_load_docs(loader), skip, None):
+            loaded += 1
+            batch += self._split_docs([doc], text_splitter, zh_title_enhance)
+            if len(batch) >= batch_size:
+                yield loaded, batch
+                batch = []
+        if batch or loaded == skip:
+            yield loaded, batch
+
     def file2text(
             self,
             zh_title_enhance: bool = ZH_TITLE_ENHANCE,
@@ -348,6 +475,48 @@ class KnowledgeFile:
         return os.path.getsize(self.filepath)
 
 
+def _ingest_progress_file(kb_name: str, filename: str) -> str:
+    name = hashlib.md5(filename.encode("utf-8")).hexdigest()
+    return os.path.join(get_kb_path(kb_name), "ingest_progress", f"{name}.json")
+
+
+def load_ingest_progress(kb_file: KnowledgeFile) -> Optional[Dict]:
+    '''
+    读取大文件流式入库的进度 {"loaded": 已读取的文档数, "chunks": 已写入的文本块数}。
+    没有记录或文件在中断后被修改时返回 None
+    '''
+    progress_file = _ingest_progress_file(kb_file.kb_name, kb_file.filename)
+    try:
+        with open(progress_file, encoding="utf-8") as fp:
+            progress = json.load(fp)
+        if progress["mtime"] == kb_file.get_mtime() and progress["size"] == kb_file.get_size():
+            return {"loaded": progress["loaded"], "chunks": progress["chunks"]}
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning(f"读取 {kb_file.kb_name}/{kb_file.filename} 的入库进度失败：{e}")
+    return None
+
+
+def save_ingest_progress(kb_file: KnowledgeFile, progress: Dict):
+    progress_file = _ingest_progress_file(kb_file.kb_name, kb_file.filename)
+    os.makedirs(os.path.dirname(progress_file), exist_ok=True)
+    with open(progress_file + ".tmp", "w", encoding="utf-8") as fp:
+        json.dump({"filename": kb_file.filename, "mtime": kb_file.get_mtime(), "size": kb_file.get_size(),
+                   **progress}, fp)
+    os.replace(progress_file + ".tmp", progress_file)
+
+
+def clear_ingest_progress(kb_name: str, filename: str = None):
+    '''
+    删除文件的入库进度，未指定 filename 时删除整个知识库的
+    '''
+    if filename is None:
+        shutil.rmtree(os.path.join(get_kb_path(kb_name), "ingest_progress"), ignore_errors=True)
+    elif os.path.isfile(progress_file := _ingest_progress_file(kb_name, filename)):
+        os.remove(progress_file)
+
+
 def files2docs_in_thread(
         files: List[Union[KnowledgeFile, Tuple[str, str], Dict]],
         chunk_size: int = CHUNK_SIZE,
@@ -355,7 +524,7 @@ def files2docs_in_thread(
         zh_title_enhance: bool = ZH_TITLE_ENHANCE,
 ) -> Generator:
     '''
-    利用多线程批量将磁盘文件转化成langchain Document.
+    利用多线程批量将磁盘文件转化成langchain Document. 设置了 DOC_PARSE_PROCESSES 时在子进程中解析
     如果传入参数是Tuple，形式为(filename, kb_name)
     生成器返回值为 status, (kb_name, file_name, docs | error)
     '''
@@ -390,7 +559,12 @@ def files2docs_in_thread(
         except Exception as e:
             yield False, (kb_name, filename, str(e))
 
-    for result in run_in_thread_pool(func=file2docs, params=kwargs_list):
+    from server.knowledge_base.doc_process_pool import use_process_pool, files2docs_in_process
+    if use_process_pool():
+        results = files2docs_in_process(kwargs_list)
+    else:
+        results = run_in_thread_pool(func=file2docs, params=kwargs_list)
+    for result in results:
         yield result
 
 
@@ -9,11 +9,14 @@ import sys
 from pydantic import BaseModel, root_validator
 import fastchat
 import asyncio
+import functools
 from server.utils import get_model_worker_config
+from server.model_workers.embedding_driver import (ApiEmbeddingError, get_rate_limiter, embed_concurrently,
+                                                   run_coroutine_sync)
 from typing import Dict, List, Optional
 
 
-__all__ = ["ApiModelWorker", "ApiChatParams", "ApiCompletionParams", "ApiEmbeddingsParams"]
+__all__ = ["ApiModelWorker", "ApiChatParams", "ApiCompletionParams", "ApiEmbeddingsParams", "ApiEmbeddingError"]
 
 
 class ApiConfigParams(BaseModel):
@@ -89,6 +92,10 @@ class ApiEmbeddingsParams(ApiConfigParams):
 
 class ApiModelWorker(BaseModelWorker):
     DEFAULT_EMBED_MODEL: str = None # None means not support embedding
+    # 向量化的默认参数，可在 ONLINE_LLM_MODEL 中通过 embed_batch_size, embed_concurrency, embed_rate_limit 覆盖
+    EMBED_BATCH_SIZE: int = 1 # 每次请求的文本数量，服务商支持批量接口时可以调大
+    EMBED_CONCURRENCY: int = 4 # 同时进行的请求数
+    EMBED_RATE_LIMIT: Optional[float] = None # 每秒最多请求数，None 表示不限速
 
     def __init__(
         self,
@@ -180,10 +187,48 @@ class ApiModelWorker(BaseModelWorker):
 
     def do_embeddings(self, params: ApiEmbeddingsParams) -> Dict:
         '''
-        执行Embeddings的方法，默认使用模块里面的embed_documents函数。
+        执行Embeddings的方法。默认将 params.texts 分批，并发调用 aembed_batch，限速、重试后按原顺序返回。
+        子类一般只需实现 embed_batch 或 aembed_batch。
         要求返回形式：{"code": int, "data": List[List[float]], "msg": str}
         '''
-        return {"code": 500, "msg": f"{self.model_names[0]}未实现embeddings功能"}
+        worker_name = self.model_names[0]
+        params.load_config(worker_name)
+        config = get_model_worker_config(worker_name)
+
+        async def embed_batch(texts: List[str]) -> List[List[float]]:
+            return await self.aembed_batch(params, texts)
+
+        try:
+            embeddings = run_coroutine_sync(embed_concurrently(
+                params.texts,
+                embed_batch,
+                batch_size=config.get("embed_batch_size", self.EMBED_BATCH_SIZE),
+                concurrency=config.get("embed_concurrency", self.EMBED_CONCURRENCY),
+                rate_limiter=get_rate_limiter(worker_name, config.get("embed_rate_limit", self.EMBED_RATE_LIMIT)),
+            ))
+            return {"code": 200, "data": embeddings}
+        except NotImplementedError:
+            return {"code": 500, "msg": f"{worker_name}未实现embeddings功能"}
+        except ApiEmbeddingError as e:
+            self.logger.error(f"请求 {worker_name} API 时发生错误：{e.data}")
+            return e.data
+        except Exception as e:
+            self.logger.error(f"请求 {worker_name} API 时发生错误：{e}")
+            return {"code": 500, "msg": f"对文本向量化时出错：{e}"}
+
+    def embed_batch(self, params: ApiEmbeddingsParams, texts: List[str]) -> List[List[float]]:
+        '''
+        对一批文本（不超过 EMBED_BATCH_SIZE 条）进行向量化，出错时抛出 ApiEmbeddingError
+        '''
+        raise NotImplementedError
+
+    async def aembed_batch(self, params: ApiEmbeddingsParams, texts: List[str]) -> List[List[float]]:
+        '''
+        embed_batch 的异步版本，默认在线程中执行 embed_batch。使用异步 HTTP 客户端的服务商可以重写
+        '''
+        # asyncio.to_thread 需要 Python 3.9
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(self.embed_batch, params, texts))
 
     def get_embeddings(self, params):
         # fastchat对LLM做Embeddings限制很大，似乎只能使用openai的。
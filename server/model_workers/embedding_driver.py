@@ -0,0 +1,147 @@
+'''
+在线Embeddings API的并发驱动：将文本按接口支持的批大小分批，在 asyncio 中并发请求（限制并发数），
+同一服务商共享令牌桶限速，可重试的错误按指数退避重试，最后按原顺序组装结果。
+不依赖 fastchat，可以单独对本地模拟的 HTTP 服务进行测试。
+'''
+import asyncio
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Coroutine, Dict, List, Optional
+
+
+__all__ = ["ApiEmbeddingError", "TokenBucket", "is_retryable", "get_rate_limiter", "embed_concurrently",
+           "run_coroutine_sync"]
+
+
+class ApiEmbeddingError(Exception):
+    '''
+    服务商返回的错误。data 为返回给调用者的错误信息，格式与 do_embeddings 的返回值一致
+    '''
+    def __init__(self, code: int, msg: str, data: Dict = None):
+        super().__init__(msg)
+        self.code = code
+        self.msg = msg
+        self.data = data or {"code": code, "msg": msg}
+
+    @property
+    def retryable(self) -> bool:
+        # 限流与服务端错误可以重试，参数、鉴权等错误重试无意义
+        try:
+            code = int(self.code)
+        except (TypeError, ValueError):
+            return False
+        return code == 429 or code >= 500
+
+
+class TokenBucket:
+    '''
+    线程安全的令牌桶，rate 为每秒产生的令牌数，capacity 为允许的突发数量。
+    不依赖事件循环，可在多个线程、多个事件循环之间共享
+    '''
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        '''
+        预定一个令牌，返回需要等待的秒数
+        '''
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+            return 0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    async def acquire(self):
+        if (wait := self.reserve()) > 0:
+            await asyncio.sleep(wait)
+
+
+def is_retryable(e: BaseException) -> bool:
+    '''
+    只有限流、服务端错误与网络错误（连接失败、超时等）值得重试。
+    NotImplementedError、鉴权失败、参数错误与程序错误重试也不会成功，直接抛出
+    '''
+    if isinstance(e, ApiEmbeddingError):
+        return e.retryable
+    if (status := getattr(getattr(e, "response", None), "status_code", None)) is not None:
+        # requests/httpx 的 HTTPError：按状态码判断
+        return ApiEmbeddingError(status, str(e)).retryable
+    if isinstance(e, (OSError, asyncio.TimeoutError, TimeoutError)):  # 包括 requests 的连接、超时错误
+        return True
+    try:
+        import httpx
+        return isinstance(e, httpx.TransportError)
+    except ImportError:
+        return False
+
+
+_rate_limiters: Dict[str, TokenBucket] = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(name: str, rate: Optional[float]) -> Optional[TokenBucket]:
+    '''
+    获取服务商共享的令牌桶，rate 为空或 <=0 时不限速
+    '''
+    if not rate or rate <= 0:
+        return None
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(name)
+        if limiter is None or limiter.rate != rate:
+            limiter = _rate_limiters[name] = TokenBucket(rate)
+        return limiter
+
+
+async def embed_concurrently(
+    texts: List[str],
+    embed_batch: Callable[[List[str]], Awaitable[List[List[float]]]],
+    batch_size: int = 1,
+    concurrency: int = 4,
+    rate_limiter: TokenBucket = None,
+    max_retries: int = 3,
+    backoff: float = 0.5,
+) -> List[List[float]]:
+    '''
+    将 texts 按 batch_size 分批，最多 concurrency 个请求同时进行，结果按 texts 的顺序返回。
+    embed_batch 出现可重试的错误（见 is_retryable）时，等待 backoff * 2^n 秒（带随机抖动）后重试，最多 max_retries 次
+    '''
+    batch_size = max(batch_size, 1)
+    batches = [texts[i: i + batch_size] for i in range(0, len(texts), batch_size)]
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+
+    async def run(batch: List[str]) -> List[List[float]]:
+        async with semaphore:
+            for attempt in range(max_retries + 1):
+                if rate_limiter is not None:
+                    await rate_limiter.acquire()
+                try:
+                    result = await embed_batch(batch)
+                    if len(result) != len(batch):
+                        raise ApiEmbeddingError(500, f"返回的向量数量({len(result)})与文本数量({len(batch)})不一致")
+                    return result
+                except Exception as e:
+                    if not is_retryable(e) or attempt >= max_retries:
+                        raise
+                await asyncio.sleep(backoff * (2 ** attempt) * (1 + random.random() * 0.1))
+
+    results = await asyncio.gather(*[run(batch) for batch in batches])
+    return [embedding for result in results for embedding in result]
+
+
+def run_coroutine_sync(coro: Coroutine):
+    '''
+    在同步代码中运行协程。当前线程已有运行中的事件循环时，在新线程中运行
+    '''
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with ThreadPoolExecutor(1) as pool:
+        return pool.submit(asyncio.run, coro).result()
@@ -11,6 +11,7 @@ from configs import logger, log_verbose
 
 class MiniMaxWorker(ApiModelWorker):
     DEFAULT_EMBED_MODEL = "embo-01"
+    EMBED_BATCH_SIZE = 10
 
     def __init__(
         self,
@@ -97,8 +98,7 @@ class MiniMaxWorker(ApiModelWorker):
                             text += chunk
                             yield {"error_code": 0, "text": text}
 
-    def do_embeddings(self, params: ApiEmbeddingsParams) -> Dict:
-        params.load_config(self.model_names[0])
+    async def aembed_batch(self, params: ApiEmbeddingsParams, texts: List[str]) -> List[List[float]]:
         url = f"https://api.minimax.chat/v1/embeddings?GroupId={params.group_id}"
 
         headers = {
@@ -108,7 +108,7 @@ class MiniMaxWorker(ApiModelWorker):
 
         data = {
             "model": params.embed_model or self.DEFAULT_EMBED_MODEL,
-            "texts": [],
+            "texts": texts,
             "type": "query" if params.to_query else "db",
         }
         if log_verbose:
@@ -116,31 +116,25 @@ class MiniMaxWorker(ApiModelWorker):
             logger.info(f'{self.__class__.__name__}:url: {url}')
             logger.info(f'{self.__class__.__name__}:headers: {headers}')
 
-        with get_httpx_client() as client:
-            result = []
-            i = 0
-            batch_size = 10
-            while i < len(params.texts):
-                texts = params.texts[i:i+batch_size]
-                data["texts"] = texts
-                r = client.post(url, headers=headers, json=data).json()
-                if embeddings := r.get("vectors"):
-                    result += embeddings
-                elif error := r.get("base_resp"):
-                    data = {
-                                "code": error["status_code"],
-                                "msg": error["status_msg"],
-                                "error": {
-                                    "message":  error["status_msg"],
-                                    "type": "invalid_request_error",
-                                    "param": None,
-                                    "code": None,
-                                }
-                            }
-                    self.logger.error(f"请求 MiniMax API 时发生错误：{data}")
-                    return data
-                i += batch_size
-            return {"code": 200, "data": embeddings}
+        async with get_httpx_client(use_async=True) as client:
+            r = await client.post(url, headers=headers, json=data)
+            if r.status_code == 429 or r.status_code >= 500:
+                raise ApiEmbeddingError(r.status_code, r.text)
+            r = r.json()
+        if embeddings := r.get("vectors"):
+            return embeddings
+        error = r.get("base_resp") or {}
+        data = {
+                    "code": error.get("status_code", 500),
+                    "msg": error.get("status_msg", str(r)),
+                    "error": {
+                        "message":  error.get("status_msg", str(r)),
+                        "type": "invalid_request_error",
+                        "param": None,
+                        "code": None,
+                    }
+                }
+        raise ApiEmbeddingError(data["code"], data["msg"], data)
 
     def get_embeddings(self, params):
         # TODO: 支持embeddings
@@ -1,3 +1,4 @@
+import asyncio
 import sys
 from fastchat.conversation import Conversation
 from server.model_workers.base import *
@@ -67,6 +68,7 @@ class QianFanWorker(ApiModelWorker):
     百度千帆
     """
     DEFAULT_EMBED_MODEL = "embedding-v1"
+    EMBED_BATCH_SIZE = 10
 
     def __init__(
             self,
@@ -167,8 +169,7 @@ class QianFanWorker(ApiModelWorker):
                         self.logger.error(f"请求千帆 API 时发生错误：{data}")
                         yield data
 
-    def do_embeddings(self, params: ApiEmbeddingsParams) -> Dict:
-        params.load_config(self.model_names[0])
+    async def aembed_batch(self, params: ApiEmbeddingsParams, texts: List[str]) -> List[List[float]]:
         # import qianfan
 
         # embed = qianfan.Embedding(ak=params.api_key, sk=params.secret_key)
@@ -180,36 +181,30 @@ class QianFanWorker(ApiModelWorker):
         #     return {"code": resp.code, "msg": str(resp.body)}
 
         embed_model = params.embed_model or self.DEFAULT_EMBED_MODEL
-        access_token = get_baidu_access_token(params.api_key, params.secret_key)
+        access_token = await asyncio.get_running_loop().run_in_executor(
+            None, get_baidu_access_token, params.api_key, params.secret_key)
         url = f"https://aip.baidubce.com/rpc/2.0/ai_custom/v1/wenxinworkshop/embeddings/{embed_model}?access_token={access_token}"
         if log_verbose:
             logger.info(f'{self.__class__.__name__}:url: {url}')
 
-        with get_httpx_client() as client:
-            result = []
-            i = 0
-            batch_size = 10
-            while i < len(params.texts):
-                texts = params.texts[i:i+batch_size]
-                resp = client.post(url, json={"input": texts}).json()
-                if "error_code" in resp:
-                    data = {
-                                "code": resp["error_code"],
-                                "msg": resp["error_msg"],
-                                "error": {
-                                    "message": resp["error_msg"],
-                                    "type": "invalid_request_error",
-                                    "param": None,
-                                    "code": None,
-                                }
-                            }
-                    self.logger.error(f"请求千帆 API 时发生错误：{data}")
-                    return data
-                else:
-                    embeddings = [x["embedding"] for x in resp.get("data", [])]
-                    result += embeddings
-                i += batch_size
-            return {"code": 200, "data": result}
+        async with get_httpx_client(use_async=True) as client:
+            r = await client.post(url, json={"input": texts})
+            if r.status_code == 429 or r.status_code >= 500:
+                raise ApiEmbeddingError(r.status_code, r.text)
+            resp = r.json()
+        if "error_code" in resp:
+            data = {
+                        "code": resp["error_code"],
+                        "msg": resp["error_msg"],
+                        "error": {
+                            "message": resp["error_msg"],
+                            "type": "invalid_request_error",
+                            "param": None,
+                            "code": None,
+                        }
+                    }
+            raise ApiEmbeddingError(data["code"], data["msg"], data)
+        return [x["embedding"] for x in resp.get("data", [])]
 
     # TODO: qianfan支持续写模型
     def get_embeddings(self, params):
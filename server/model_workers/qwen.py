@@ -14,6 +14,7 @@ from configs import logger, log_verbose
 
 class QwenWorker(ApiModelWorker):
     DEFAULT_EMBED_MODEL = "text-embedding-v1"
+    EMBED_BATCH_SIZE = 25
 
     def __init__(
         self,
@@ -66,38 +67,28 @@ class QwenWorker(ApiModelWorker):
                 self.logger.error(f"请求千问 API 时发生错误：{data}")
                 yield data
 
-    def do_embeddings(self, params: ApiEmbeddingsParams) -> Dict:
+    def embed_batch(self, params: ApiEmbeddingsParams, texts: List[str]) -> List[List[float]]:
         import dashscope
-        params.load_config(self.model_names[0])
         if log_verbose:
             logger.info(f'{self.__class__.__name__}:params: {params}')
-        result = []
-        i = 0
-        while i < len(params.texts):
-            texts = params.texts[i:i+25]
-            resp = dashscope.TextEmbedding.call(
-                model=params.embed_model or self.DEFAULT_EMBED_MODEL,
-                input=texts, # 最大25行
-                api_key=params.api_key,
-            )
-            if resp["status_code"] != 200:
-                data = {
-                            "code": resp["status_code"],
-                            "msg": resp.message,
-                            "error": {
-                                "message": resp["message"],
-                                "type": "invalid_request_error",
-                                "param": None,
-                                "code": None,
-                            }
+        resp = dashscope.TextEmbedding.call(
+            model=params.embed_model or self.DEFAULT_EMBED_MODEL,
+            input=texts, # 最大25行
+            api_key=params.api_key,
+        )
+        if resp["status_code"] != 200:
+            data = {
+                        "code": resp["status_code"],
+                        "msg": resp.message,
+                        "error": {
+                            "message": resp["message"],
+                            "type": "invalid_request_error",
+                            "param": None,
+                            "code": None,
                         }
-                self.logger.error(f"请求千问 API 时发生错误：{data}")
-                return data
-            else:
-                embeddings = [x["embedding"] for x in resp["output"]["embeddings"]]
-                result += embeddings
-            i += 25
-        return {"code": 200, "data": result}
+                    }
+            raise ApiEmbeddingError(data["code"], data["msg"], data)
+        return [x["embedding"] for x in resp["output"]["embeddings"]]
 
     def get_embeddings(self, params):
         # TODO: 支持embeddings
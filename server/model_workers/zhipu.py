@@ -57,27 +57,15 @@ class ChatGLMWorker(ApiModelWorker):
                 self.logger.error(f"请求智谱 API 时发生错误：{data}")
                 yield data
 
-    def do_embeddings(self, params: ApiEmbeddingsParams) -> Dict:
+    def embed_batch(self, params: ApiEmbeddingsParams, texts: List[str]) -> List[List[float]]:
         import zhipuai
 
-        params.load_config(self.model_names[0])
         zhipuai.api_key = params.api_key
-
-        embeddings = []
-        try:
-            for t in params.texts:
-                response = zhipuai.model_api.invoke(model=params.embed_model or self.DEFAULT_EMBED_MODEL, prompt=t)
-                if response["code"] == 200:
-                    embeddings.append(response["data"]["embedding"])
-                else:
-                    self.logger.error(f"请求智谱 API 时发生错误：{response}")
-                    return response  # dict with code & msg
-        except Exception as e:
-            self.logger.error(f"请求智谱 API 时发生错误：{data}")
-            data = {"code": 500, "msg": f"对文本向量化时出错：{e}"}
-            return data
-
-        return {"code": 200, "data": embeddings}
+        # 接口每次只能处理一条文本，由 do_embeddings 并发请求
+        response = zhipuai.model_api.invoke(model=params.embed_model or self.DEFAULT_EMBED_MODEL, prompt=texts[0])
+        if response["code"] != 200:
+            raise ApiEmbeddingError(response["code"], response.get("msg"), response)  # dict with code & msg
+        return [response["data"]["embedding"]]
 
     def get_embeddings(self, params):
         # TODO: 支持embeddings
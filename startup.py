@@ -718,11 +718,13 @@ async def start_main_server():
 
     api_started = manager.Event()
     if args.api:
+        # API服务中的文档解析、Embeddings与PDF OCR进程池需要创建子进程，守护进程不能创建子进程，
+        # 因此不以守护进程运行，退出时由下面的 finally 先发送 SIGTERM 使其关闭进程池，再强制结束
         process = Process(
             target=run_api_server,
             name=f"API Server",
             kwargs=dict(started_event=api_started, run_mode=run_mode),
-            daemon=True,
+            daemon=False,
         )
         processes["api"] = process
 
@@ -851,6 +853,12 @@ async def start_main_server():
             # .is_alive() also implicitly joins the process (good practice in linux)
             # while alive_procs := [p for p in processes.values() if p.is_alive()]:
 
+            # API服务先正常退出，由 atexit 关闭其中的进程池；直接 SIGKILL 会留下无人回收的子进程
+            if isinstance(p := processes.get("api"), Process) and p.is_alive():
+                logger.warning("Sending SIGTERM to %s", p)
+                p.terminate()
+                p.join(timeout=10)
+
             for p in processes.values():
                 logger.warning("Sending SIGKILL to %s", p)
                 # Queues and other inter-process communication primitives can break when
@@ -137,6 +137,33 @@ def test_search_docs(api="/knowledge_base/search_docs"):
     assert isinstance(data, list) and len(data) == VECTOR_SEARCH_TOP_K
 
 
+def test_search_docs_batch(api="/knowledge_base/search_docs_batch"):
+    url = api_base_url + api
+    queries = ["介绍一下langchain-chatchat项目", "本项目支持哪些文件格式?"]
+    print("\n批量检索知识库：")
+    print(queries)
+    r = requests.post(url, json={"knowledge_base_name": kb, "queries": queries})
+    data = r.json()
+    pprint(data)
+    assert isinstance(data, list) and len(data) == len(queries)
+    for docs in data:
+        assert isinstance(docs, list) and len(docs) == VECTOR_SEARCH_TOP_K
+
+
+def test_search_docs_federated(api="/knowledge_base/search_docs_federated"):
+    url = api_base_url + api
+    query = "介绍一下langchain-chatchat项目"
+    print("\n同时检索多个知识库：")
+    print(query)
+    r = requests.post(url, json={"knowledge_base_names": [kb, "samples"], "query": query})
+    data = r.json()
+    pprint(data)
+    assert isinstance(data, list) and len(data) == VECTOR_SEARCH_TOP_K
+    assert {x["knowledge_base_name"] for x in data} <= {kb, "samples"}
+    relevance = [x["relevance"] for x in data]
+    assert relevance == sorted(relevance, reverse=True)
+
+
 def test_update_info(api="/knowledge_base/update_info"):
     url = api_base_url + api
     print("\n更新知识库介绍")
@@ -0,0 +1,100 @@
+'''
+比较本地 Embedding 模型在 PyTorch 与 ONNX Runtime(fp32 / int8) 后端下的吞吐量与检索召回。
+召回以 PyTorch 的检索结果为基准：recall@k = 两个后端 top-k 结果的交集 / k。
+
+python tests/benchmark_embedding_backend.py --model bge-large-zh --file README.md --top-k 10
+'''
+import sys
+from pathlib import Path
+root_path = Path(__file__).parent.parent
+sys.path.append(str(root_path))
+
+import argparse
+import time
+from typing import Dict, List
+
+import numpy as np
+
+from configs import EMBEDDING_MODEL
+from server.utils import get_model_path
+from server.knowledge_base.kb_cache.base import bge_query_instruction
+from server.knowledge_base.kb_cache.onnx_embeddings import OnnxEmbeddings
+
+
+def load_torch_embeddings(model: str):
+    if 'bge-' in model:
+        from langchain.embeddings import HuggingFaceBgeEmbeddings
+        return HuggingFaceBgeEmbeddings(model_name=get_model_path(model),
+                                        model_kwargs={'device': "cpu"},
+                                        query_instruction=bge_query_instruction(model))
+    from langchain.embeddings.huggingface import HuggingFaceEmbeddings
+    return HuggingFaceEmbeddings(model_name=get_model_path(model), model_kwargs={'device': "cpu"})
+
+
+def load_texts(file: str, chunk_size: int, num: int) -> List[str]:
+    text = Path(file).read_text(encoding="utf-8")
+    chunks = [text[i: i + chunk_size] for i in range(0, len(text), chunk_size)]
+    chunks = [x for x in chunks if x.strip()]
+    while len(chunks) < num:
+        chunks += chunks
+    return chunks[:num]
+
+
+def top_k(queries: np.ndarray, docs: np.ndarray, k: int) -> np.ndarray:
+    queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    docs = docs / np.linalg.norm(docs, axis=1, keepdims=True)
+    return np.argsort(-queries @ docs.T, axis=1)[:, :k]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default=EMBEDDING_MODEL)
+    parser.add_argument("--file", default=str(root_path / "README.md"), help="用于生成文本块与查询的文件")
+    parser.add_argument("--num-docs", type=int, default=1000)
+    parser.add_argument("--num-queries", type=int, default=100)
+    parser.add_argument("--chunk-size", type=int, default=250)
+    parser.add_argument("--top-k", type=int, default=10)
+    args = parser.parse_args()
+
+    docs = load_texts(args.file, args.chunk_size, args.num_docs)
+    rng = np.random.default_rng(0)
+    queries = [docs[i][:50] for i in rng.choice(len(docs), args.num_queries)]
+
+    model_path = get_model_path(args.model)
+    backends = {
+        "torch": lambda: load_torch_embeddings(args.model),
+        "onnx": lambda: OnnxEmbeddings(args.model, model_path, normalize='bge-' in args.model,
+                                       query_instruction=bge_query_instruction(args.model)),
+        "onnx-int8": lambda: OnnxEmbeddings(args.model, model_path, quantize=True, normalize='bge-' in args.model,
+                                            query_instruction=bge_query_instruction(args.model)),
+    }
+
+    results: Dict[str, Dict] = {}
+    for name, load in backends.items():
+        embeddings = load()
+        embeddings.embed_documents(docs[:8])  # 预热
+        start = time.perf_counter()
+        doc_vectors = np.array(embeddings.embed_documents(docs), dtype=np.float32)
+        elapsed = time.perf_counter() - start
+        query_vectors = np.array([embeddings.embed_query(q) for q in queries], dtype=np.float32)
+        results[name] = {
+            "docs_per_second": len(docs) / elapsed,
+            "doc_vectors": doc_vectors,
+            "top_k": top_k(query_vectors, doc_vectors, args.top_k),
+        }
+        del embeddings
+
+    base = results["torch"]
+    print(f"model: {args.model}, docs: {len(docs)}, queries: {len(queries)}, top_k: {args.top_k}")
+    print(f"{'backend':<12}{'docs/s':>10}{'speedup':>10}{'recall@k':>10}{'cosine':>10}")
+    for name, r in results.items():
+        recall = np.mean([len(set(a) & set(b)) / args.top_k for a, b in zip(r["top_k"], base["top_k"])])
+        a = r["doc_vectors"] / np.linalg.norm(r["doc_vectors"], axis=1, keepdims=True)
+        b = base["doc_vectors"] / np.linalg.norm(base["doc_vectors"], axis=1, keepdims=True)
+        cosine = float(np.mean(np.sum(a * b, axis=1)))
+        print(f"{name:<12}{r['docs_per_second']:>10.1f}{r['docs_per_second'] / base['docs_per_second']:>10.2f}"
+              f"{recall:>10.3f}{cosine:>10.4f}")
+
+
+if __name__ == "__main__":
+    main()
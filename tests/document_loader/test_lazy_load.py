@@ -0,0 +1,35 @@
+import sys
+from pathlib import Path
+
+root_path = Path(__file__).parent.parent.parent
+sys.path.append(str(root_path))
+
+from server.knowledge_base.utils import KnowledgeFile, get_loader, lazy_load_docs
+
+
+kb_name = "samples"
+test_files = [
+    "test_files/langchain-ChatGLM_closed.csv",
+    "test_files/langchain-ChatGLM_closed.jsonl",
+    "test_files/test.txt",
+]
+
+
+def test_lazy_load_docs():
+    for filename in test_files[:2]:
+        kb_file = KnowledgeFile(filename, kb_name)
+        loader = get_loader(kb_file.document_loader_name, kb_file.filepath, kb_file.loader_kwargs)
+        docs = list(lazy_load_docs(loader))
+        assert [doc.page_content for doc in docs] == [doc.page_content for doc in loader.load()]
+
+
+def test_file2text_batches():
+    for filename in test_files:
+        kb_file = KnowledgeFile(filename, kb_name)
+        batches = list(kb_file.file2text_batches(batch_size=10))
+        assert all(len(docs) > 0 for _, docs in batches)
+
+        # 从中间继续时只返回之后的文档
+        loaded = batches[0][0]
+        rest = list(kb_file.file2text_batches(skip=loaded, batch_size=10))
+        assert sum(len(docs) for _, docs in rest) == sum(len(docs) for _, docs in batches[1:])
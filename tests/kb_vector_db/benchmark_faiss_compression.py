@@ -0,0 +1,107 @@
+'''
+比较 FAISS 向量库不同索引选项（降维、标量量化与近似检索索引）的内存占用、检索速度与召回。
+召回以未压缩的 IndexFlatL2 为基准：recall@k = 两者 top-k 结果的交集 / k。
+不指定 --random 时使用 Embedding 模型对文件分块后向量化，查询为随机文本块的前50个字符。
+
+python tests/kb_vector_db/benchmark_faiss_compression.py --model bge-large-zh --file README.md --num-docs 5000
+python tests/kb_vector_db/benchmark_faiss_compression.py --random --dim 1024 --num-docs 100000
+'''
+import sys
+from pathlib import Path
+root_path = Path(__file__).parent.parent.parent
+sys.path.append(str(root_path))
+
+import argparse
+import time
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from configs import EMBEDDING_MODEL
+from server.knowledge_base.kb_cache.faiss_index import build_index, index_code_size
+from langchain.vectorstores.faiss import dependable_faiss_import
+
+
+def load_texts(file: str, chunk_size: int, num: int) -> List[str]:
+    text = Path(file).read_text(encoding="utf-8")
+    chunks = [text[i: i + chunk_size] for i in range(0, len(text), chunk_size)]
+    chunks = [x for x in chunks if x.strip()]
+    while len(chunks) < num:
+        chunks += chunks
+    return chunks[:num]
+
+
+def load_vectors(args) -> Tuple[np.ndarray, np.ndarray]:
+    if args.random:
+        rng = np.random.default_rng(0)
+        # 低秩结构 + 噪声，近似真实 Embedding 的分布
+        basis = rng.standard_normal((args.dim // 8, args.dim))
+        docs = rng.standard_normal((args.num_docs, args.dim // 8)) @ basis
+        docs += rng.standard_normal(docs.shape) * 0.5
+        queries = docs[rng.choice(len(docs), args.num_queries)] + rng.standard_normal((args.num_queries, args.dim))
+        return docs.astype(np.float32), queries.astype(np.float32)
+
+    from server.utils import load_local_embeddings
+    embeddings = load_local_embeddings(args.model)
+    texts = load_texts(args.file, args.chunk_size, args.num_docs)
+    rng = np.random.default_rng(0)
+    queries = [texts[i][:50] for i in rng.choice(len(texts), args.num_queries)]
+    return (np.array(embeddings.embed_documents(texts), dtype=np.float32),
+            np.array([embeddings.embed_query(q) for q in queries], dtype=np.float32))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default=EMBEDDING_MODEL)
+    parser.add_argument("--file", default=str(root_path / "README.md"), help="用于生成文本块与查询的文件")
+    parser.add_argument("--random", action="store_true", help="使用随机向量代替 Embedding 模型")
+    parser.add_argument("--dim", type=int, default=1024, help="随机向量的维度")
+    parser.add_argument("--num-docs", type=int, default=5000)
+    parser.add_argument("--num-queries", type=int, default=200)
+    parser.add_argument("--chunk-size", type=int, default=250)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--reduced-dims", type=int, nargs="+", default=[512, 256, 128])
+    parser.add_argument("--index-factories", nargs="*", default=["IVF,Flat", "IVF,SQ8", "HNSW32"],
+                        help="近似检索索引，格式同 faiss.index_factory")
+    args = parser.parse_args()
+
+    faiss = dependable_faiss_import()
+    docs, queries = load_vectors(args)
+    faiss.normalize_L2(docs)
+    faiss.normalize_L2(queries)
+    d = docs.shape[1]
+
+    settings: Dict[str, Dict] = {"flat": {}, "fp16": {"quantization": "fp16"}, "int8": {"quantization": "int8"}}
+    for dim in args.reduced_dims:
+        if dim >= d:
+            continue
+        for method in ["pca", "truncate"]:
+            for quantization in [None, "fp16", "int8"]:
+                name = f"{method}{dim}" + (f"+{quantization}" if quantization else "")
+                settings[name] = {"dim_reduction": method, "reduced_dim": dim, "quantization": quantization}
+    for factory in args.index_factories:
+        settings[factory] = {"index_factory": factory}
+
+    print(f"vectors: {docs.shape}, queries: {len(queries)}, top_k: {args.top_k}")
+    print(f"{'options':<20}{'bytes/vec':>10}{'memory':>10}{'recall@k':>10}{'build(s)':>10}{'search(ms)':>12}")
+    base = None
+    for name, options in settings.items():
+        start = time.perf_counter()
+        index = build_index(d, options, ntotal=len(docs))
+        if not index.is_trained:
+            index.train(docs)
+        index.add(docs)
+        build_time = time.perf_counter() - start
+        start = time.perf_counter()
+        _, indices = index.search(queries, args.top_k)
+        search_time = (time.perf_counter() - start) / len(queries) * 1000
+        if base is None:
+            base = indices
+        recall = np.mean([len(set(a) & set(b)) / args.top_k for a, b in zip(indices, base)])
+        code_size = index_code_size(index)
+        print(f"{name:<20}{code_size:>10}{code_size / index_code_size(build_index(d, {})):>10.1%}"
+              f"{recall:>10.3f}{build_time:>10.2f}{search_time:>12.3f}")
+
+
+if __name__ == "__main__":
+    main()
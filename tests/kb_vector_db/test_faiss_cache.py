@@ -0,0 +1,34 @@
+import sys
+from pathlib import Path
+
+root_path = Path(__file__).parent.parent.parent
+sys.path.append(str(root_path))
+
+from server.knowledge_base.kb_cache.base import CachePool, ThreadSafeObject
+
+
+class _Closable:
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def _item(pool: CachePool, key: str) -> ThreadSafeObject:
+    item = ThreadSafeObject(key, obj=_Closable(), pool=pool)
+    item.finish_loading()
+    return item
+
+
+def test_evicted_item_closed_after_release():
+    # 从缓存中移除时仍被持有的对象，在持有者释放后才关闭；移除后继续 acquire 不报错
+    pool = CachePool(cache_num=1)
+    first = pool.set("a", _item(pool, "a"))
+    with first.acquire(shared=True) as obj:
+        pool.pop("a")
+        assert not obj.closed
+        with first.acquire(shared=True):
+            pass
+        assert not obj.closed
+    assert obj.closed
+
@@ -0,0 +1,135 @@
+import sys
+from pathlib import Path
+
+root_path = Path(__file__).parent.parent.parent
+sys.path.append(str(root_path))
+
+import numpy as np
+import pytest
+
+from server.knowledge_base.kb_cache.faiss_index import build_index, remove_positions
+
+
+def _vectors(n: int = 2000, d: int = 32) -> np.ndarray:
+    x = np.random.RandomState(0).rand(n, d).astype(np.float32)
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+
+@pytest.mark.parametrize("options", [
+    {},
+    {"quantization": "fp16"},
+    {"index_factory": "IVF,Flat"},
+    {"index_factory": "IVF,Flat", "dim_reduction": "truncate", "reduced_dim": 16},
+    {"index_factory": "HNSW32"},
+])
+def test_remove_positions(options):
+    # 删除后剩余的向量依次前移：检索第 i 个剩余向量应返回位置 i
+    vectors = _vectors()
+    index = build_index(vectors.shape[1], options, ntotal=len(vectors))
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+
+    positions = list(range(0, len(vectors), 3))
+    index = remove_positions(index, positions)
+    remaining = np.delete(vectors, positions, axis=0)
+    assert index.ntotal == len(remaining)
+
+    from langchain.vectorstores.faiss import dependable_faiss_import
+    faiss = dependable_faiss_import()
+    if (ivf := faiss.try_extract_index_ivf(index)) is not None:
+        ivf.nprobe = ivf.nlist
+    _, found = index.search(remaining[:200], 1)
+    assert (found[:, 0] == np.arange(200)).mean() > 0.95
+
+
+def test_remove_labels_keeps_ivf_ids():
+    # IVF 按编号删除，其它向量的编号不变
+    from server.knowledge_base.kb_cache.faiss_index import label_mode, remove_labels
+
+    vectors = _vectors()
+    index = build_index(vectors.shape[1], {"index_factory": "IVF,Flat"}, ntotal=len(vectors))
+    index.train(vectors)
+    index.add(vectors)
+    assert label_mode(index) == "id"
+
+    labels = list(range(0, len(vectors), 3))
+    remove_labels(index, labels)
+    assert index.ntotal == len(vectors) - len(labels)
+    index.nprobe = index.nlist
+    _, found = index.search(vectors[:300], 1)
+    removed = np.isin(np.arange(300), labels)
+    assert (found[~removed, 0] == np.arange(300)[~removed]).all()
+    assert not np.isin(found[:, 0], labels).any()
+
+
+def _store(options: dict, vectors: np.ndarray):
+    from langchain.docstore.in_memory import InMemoryDocstore
+    from langchain.embeddings.fake import FakeEmbeddings
+    from langchain.schema import Document
+    from langchain.vectorstores.faiss import FAISS
+    from server.knowledge_base.kb_cache.faiss_cache import ThreadSafeFaiss
+
+    index = build_index(vectors.shape[1], options, ntotal=len(vectors))
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+    ids = [f"doc{i}" for i in range(len(vectors))]
+    docstore = InMemoryDocstore({id: Document(page_content=id, metadata={"source": "a.txt"}) for id in ids})
+    vs = FAISS(FakeEmbeddings(size=vectors.shape[1]), index, docstore, dict(enumerate(ids)), normalize_L2=True)
+    item = ThreadSafeFaiss(("test", "fake"))
+    item.obj = vs
+    item.build_source_index()
+    item.finish_loading()
+    return item
+
+
+def _top1(item, vectors: np.ndarray) -> list:
+    return [docs[0][0].page_content if docs else None for docs in item.search_batch(vectors, k=1, ef_search=128)]
+
+
+@pytest.mark.parametrize("options", [
+    {"index_factory": "IVF,Flat"},
+    {"index_factory": "HNSW32"},
+])
+def test_delete_then_add(options):
+    # 删除后不需要重新编号，新加入的向量不能与已有的编号冲突
+    vectors = _vectors(500)
+    item = _store(options, vectors)
+    from langchain.vectorstores.faiss import dependable_faiss_import
+    if (ivf := dependable_faiss_import().try_extract_index_ivf(item.obj.index)) is not None:
+        ivf.nprobe = ivf.nlist
+    deleted = [f"doc{i}" for i in range(0, 50)]
+    assert item.delete_by_ids(deleted) == deleted
+
+    new_vectors = _vectors(520)[500:]
+    new_ids = item.add_embeddings([(f"new{i}", v.tolist()) for i, v in enumerate(new_vectors)],
+                                  metadatas=[{"source": "b.txt"}] * 20)
+    assert len(new_ids) == 20 and item.docs_count() == 470
+    assert _top1(item, new_vectors) == [f"new{i}" for i in range(20)]
+    found = _top1(item, vectors[:100])
+    assert not set(found) & set(deleted)
+    assert (np.array(found[50:]) == [f"doc{i}" for i in range(50, 100)]).mean() > 0.95
+
+
+def test_hnsw_tombstones_rebuilt(monkeypatch):
+    # HNSW 删除时只标记，检索时排除，超过比例后在后台用剩余的向量重建
+    import time
+    import server.knowledge_base.kb_cache.faiss_cache as faiss_cache
+
+    monkeypatch.setattr(faiss_cache, "FAISS_TOMBSTONE_RATIO", 0.3)
+    vectors = _vectors(500)
+    item = _store({"index_factory": "HNSW32"}, vectors)
+    index = item.obj.index
+    item.delete_by_ids([f"doc{i}" for i in range(100)])
+    assert item.obj.index is index and index.ntotal == 500  # 未超过比例，不重建
+    assert not {f"doc{i}" for i in range(100)} & set(_top1(item, vectors[:200]))
+
+    item.delete_by_ids([f"doc{i}" for i in range(100, 200)])
+    for _ in range(100):
+        if not item._rebuilding:
+            break
+        time.sleep(0.05)
+    assert item.obj.index is not index and item.obj.index.ntotal == 300
+    assert sorted(item.obj.index_to_docstore_id) == list(range(300))
+    assert (np.array(_top1(item, vectors[200:])) == [f"doc{i}" for i in range(200, 500)]).mean() > 0.95
@@ -1,4 +1,5 @@
 from server.knowledge_base.kb_service.faiss_kb_service import FaissKBService
+from server.knowledge_base.kb_cache.faiss_cache import kb_faiss_pool
 from server.knowledge_base.migrate import create_tables
 from server.knowledge_base.utils import KnowledgeFile
 
@@ -20,6 +21,25 @@ def test_create_db():
 
 def test_add_doc():
     assert kbService.add_doc(testKnowledgeFile)
+    assert len(kbService.load_vector_store(test_file_name).get_ids_by_source(test_file_name)) > 0
+
+
+def test_reload_vs():
+    # 释放后从磁盘重新加载（开启 wal 时为快照 + 重放日志），文档不变
+    ids = kbService.load_vector_store(test_file_name).get_ids_by_source(test_file_name)
+    kb_faiss_pool.unload_vector_store((test_kb_name, kbService.shard_of(test_file_name)))
+    assert sorted(kbService.load_vector_store(test_file_name).get_ids_by_source(test_file_name)) == sorted(ids)
+
+
+def test_update_doc_reload():
+    # 批量更新（开启 snapshot_publish 时在副本上修改后发布）后从磁盘重新加载，旧的文档不会因重放日志而恢复
+    old_ids = kbService.load_vector_store(test_file_name).get_ids_by_source(test_file_name)
+    with kbService.batch_update():
+        assert kbService.update_doc(testKnowledgeFile)
+    kb_faiss_pool.unload_vector_store((test_kb_name, kbService.shard_of(test_file_name)))
+    ids = kbService.load_vector_store(test_file_name).get_ids_by_source(test_file_name)
+    assert len(ids) > 0
+    assert not set(ids) & set(old_ids)
 
 
 def test_search_db():
@@ -29,6 +49,7 @@ def test_search_db():
 
 def test_delete_doc():
     assert kbService.delete_doc(testKnowledgeFile)
+    assert kbService.load_vector_store(test_file_name).get_ids_by_source(test_file_name) == []
 
 
 def test_delete_db():
@@ -0,0 +1,117 @@
+import sys
+from pathlib import Path
+
+root_path = Path(__file__).parent.parent.parent
+sys.path.append(str(root_path))
+
+import server.knowledge_base.kb_doc_api as kb_doc_api
+import server.knowledge_base.kb_service.faiss_kb_service as faiss_kb_service
+from server.knowledge_base.kb_cache.faiss_cache import ThreadSafeFaiss
+from server.knowledge_base.kb_service.faiss_kb_service import FaissKBService
+
+
+def _faiss_kb(kb_name: str = "test") -> FaissKBService:
+    # 不访问数据库的 FaissKBService
+    kb = FaissKBService.__new__(FaissKBService)
+    kb.kb_name = kb_name
+    kb.embed_model = "fake"
+    kb.vector_name = "fake"
+    kb.vs_options = {}
+    return kb
+
+
+def test_single_file_update_skips_fork(monkeypatch):
+    # 只更新一个文件时不复制整个向量库
+    forks = []
+    monkeypatch.setitem(faiss_kb_service.kbs_config, "faiss",
+                        {**faiss_kb_service.kbs_config.get("faiss", {}), "snapshot_publish": True})
+    monkeypatch.setattr(ThreadSafeFaiss, "fork", lambda self, obj=None: forks.append(self))
+    monkeypatch.setattr(FaissKBService, "_load_shard", lambda self, name: forks.append(name))
+    monkeypatch.setattr(kb_doc_api.KBServiceFactory, "get_service_by_name", staticmethod(lambda name: _faiss_kb(name)))
+    monkeypatch.setattr(kb_doc_api, "get_file_detail", lambda kb_name, filename: {})
+
+    result = kb_doc_api.update_docs(knowledge_base_name="test", file_names=["test.unsupported"],
+                                    chunk_size=250, chunk_overlap=50, zh_title_enhance=False,
+                                    override_custom_docs=False, docs={}, not_refresh_vs_cache=True)
+    assert "test.unsupported" in result.data["failed_files"]
+    assert forks == []
+
+
+def _new_store(path: str) -> ThreadSafeFaiss:
+    from langchain.embeddings.fake import FakeEmbeddings
+    from langchain.vectorstores.faiss import FAISS
+
+    vs = FAISS.from_texts(["init"], FakeEmbeddings(size=8), normalize_L2=True)
+    vs.delete(list(vs.docstore._dict))
+    item = ThreadSafeFaiss(("test", "fake"))
+    item.obj = vs
+    item.build_source_index()
+    item.finish_loading()
+    item.save(path)
+    return item
+
+
+def _load_store(path: str) -> ThreadSafeFaiss:
+    from langchain.embeddings.fake import FakeEmbeddings
+    from langchain.vectorstores.faiss import FAISS
+
+    item = ThreadSafeFaiss(("test", "fake"))
+    item.obj = FAISS.load_local(path, FakeEmbeddings(size=8), normalize_L2=True)
+    item.build_source_index(path)
+    item.finish_loading()
+    item.load_wal(path)
+    return item
+
+
+def _add(item: ThreadSafeFaiss, source: str, n: int = 3):
+    import numpy as np
+    return item.add_embeddings([(f"{source} {i}", np.random.rand(8).tolist()) for i in range(n)],
+                               metadatas=[{"source": source}] * n)
+
+
+def test_snapshot_appends_wal(monkeypatch, tmp_path):
+    # 批量更新的副本发布时只向 wal.log 追加修改，不重写 index.faiss；重新加载后旧的文档不会恢复
+    import os
+    import server.knowledge_base.kb_cache.faiss_cache as faiss_cache
+
+    monkeypatch.setattr(faiss_cache, "FAISS_WAL", True)
+    path = str(tmp_path)
+    item = _new_store(path)
+    old_ids = _add(item, "a.txt")
+    item.save(path)
+    index_stat = os.stat(os.path.join(path, "index.faiss"))
+    wal_size = faiss_cache.wal_size(path)
+
+    with item.snapshot() as staged:
+        staged.delete_by_source("a.txt")
+        new_ids = _add(staged, "a.txt") + _add(staged, "b.txt")
+        staged.save(path)
+        assert faiss_cache.wal_size(path) == wal_size  # 发布前不写入磁盘
+
+    assert faiss_cache.wal_size(path) > wal_size
+    stat = os.stat(os.path.join(path, "index.faiss"))
+    assert (stat.st_ino, stat.st_mtime_ns) == (index_stat.st_ino, index_stat.st_mtime_ns)
+    assert not os.path.exists(os.path.join(path, ".snapshot"))
+
+    loaded = _load_store(path)
+    ids = loaded.get_ids_by_source("a.txt") + loaded.get_ids_by_source("b.txt")
+    assert sorted(ids) == sorted(new_ids)
+    assert not set(ids) & set(old_ids)
+
+
+def test_discarded_snapshot_not_saved(monkeypatch, tmp_path):
+    import server.knowledge_base.kb_cache.faiss_cache as faiss_cache
+
+    monkeypatch.setattr(faiss_cache, "FAISS_WAL", True)
+    path = str(tmp_path)
+    item = _new_store(path)
+    ids = _add(item, "a.txt")
+    item.save(path)
+    try:
+        with item.snapshot() as staged:
+            staged.delete_by_source("a.txt")
+            staged.save(path)
+            raise RuntimeError("discard")
+    except RuntimeError:
+        pass
+    assert sorted(_load_store(path).get_ids_by_source("a.txt")) == sorted(ids)
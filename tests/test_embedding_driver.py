@@ -0,0 +1,140 @@
+import sys
+from pathlib import Path
+root_path = Path(__file__).parent.parent
+sys.path.append(str(root_path))
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pytest
+
+from server.model_workers.embedding_driver import (ApiEmbeddingError, TokenBucket, embed_concurrently,
+                                                   run_coroutine_sync)
+
+
+class MockEmbeddingServer(ThreadingHTTPServer):
+    '''
+    模拟在线Embeddings接口：返回 [文本长度, 文本序号]，前 fail_times 次请求返回 429，记录最大并发数
+    '''
+    def __init__(self, fail_times: int = 0, delay: float = 0.05):
+        super().__init__(("127.0.0.1", 0), MockEmbeddingHandler)
+        self.fail_times = fail_times
+        self.delay = delay
+        self.requests = 0
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/embeddings"
+
+
+class MockEmbeddingHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        server: MockEmbeddingServer = self.server
+        with server.lock:
+            server.requests += 1
+            fail = server.requests <= server.fail_times
+            server.running += 1
+            server.max_running = max(server.max_running, server.running)
+        time.sleep(server.delay)
+        texts = json.loads(self.rfile.read(int(self.headers["Content-Length"])))["input"]
+        with server.lock:
+            server.running -= 1
+        if fail:
+            body, status = {"error_code": 429, "error_msg": "rate limited"}, 429
+        else:
+            body, status = {"data": [{"embedding": [len(t), int(t.split("-")[1])]} for t in texts]}, 200
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+@pytest.fixture
+def mock_server(request):
+    server = MockEmbeddingServer(**getattr(request, "param", {}))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+
+
+def make_embed_batch(url: str):
+    async def embed_batch(texts):
+        async with httpx.AsyncClient() as client:
+            r = await client.post(url, json={"input": texts})
+        if r.status_code != 200:
+            raise ApiEmbeddingError(r.status_code, r.text)
+        return [x["embedding"] for x in r.json()["data"]]
+    return embed_batch
+
+
+def test_concurrent_ordered(mock_server):
+    texts = [f"text-{i}" for i in range(50)]
+    embeddings = run_coroutine_sync(embed_concurrently(texts, make_embed_batch(mock_server.url),
+                                                       batch_size=3, concurrency=4, backoff=0.01))
+    assert [x[1] for x in embeddings] == list(range(50))
+    assert mock_server.requests == 17
+    assert 1 < mock_server.max_running <= 4
+
+
+@pytest.mark.parametrize("mock_server", [{"fail_times": 2}], indirect=True)
+def test_retry_on_429(mock_server):
+    texts = [f"text-{i}" for i in range(5)]
+    embeddings = run_coroutine_sync(embed_concurrently(texts, make_embed_batch(mock_server.url),
+                                                       batch_size=5, concurrency=1, backoff=0.01))
+    assert [x[1] for x in embeddings] == list(range(5))
+    assert mock_server.requests == 3
+
+
+@pytest.mark.parametrize("mock_server", [{"fail_times": 100}], indirect=True)
+def test_retry_exhausted(mock_server):
+    with pytest.raises(ApiEmbeddingError) as e:
+        run_coroutine_sync(embed_concurrently(["text-0"], make_embed_batch(mock_server.url),
+                                              max_retries=2, backoff=0.01))
+    assert e.value.code == 429
+    assert mock_server.requests == 3
+
+
+def test_rate_limit(mock_server):
+    texts = [f"text-{i}" for i in range(6)]
+    start = time.time()
+    run_coroutine_sync(embed_concurrently(texts, make_embed_batch(mock_server.url),
+                                          batch_size=1, concurrency=6, rate_limiter=TokenBucket(10, 1)))
+    # 令牌桶容量为1，每秒10个：6个请求至少需要0.5秒
+    assert time.time() - start >= 0.45
+
+
+@pytest.mark.parametrize("error", [NotImplementedError(), ApiEmbeddingError(401, "unauthorized"), KeyError("data")])
+def test_no_retry_on_permanent_error(error):
+    calls = []
+
+    async def embed_batch(texts):
+        calls.append(texts)
+        raise error
+
+    with pytest.raises(type(error)):
+        run_coroutine_sync(embed_concurrently(["text-0"], embed_batch, max_retries=3, backoff=0.01))
+    assert len(calls) == 1
+
+
+def test_retry_on_network_error():
+    calls = []
+
+    async def embed_batch(texts):
+        calls.append(texts)
+        if len(calls) < 3:
+            raise httpx.ConnectError("connection refused")
+        return [[0.0] for _ in texts]
+
+    assert run_coroutine_sync(embed_concurrently(["text-0"], embed_batch, backoff=0.01)) == [[0.0]]
+    assert len(calls) == 3
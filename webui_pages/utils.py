@@ -521,6 +521,7 @@ class ApiRequest:
         knowledge_base_name: str,
         vector_store_type: str = DEFAULT_VS_TYPE,
         embed_model: str = EMBEDDING_MODEL,
+        vs_options: Dict = None,
     ):
         '''
         对应api.py/knowledge_base/create_knowledge_base接口
@@ -529,6 +530,7 @@ class ApiRequest:
             "knowledge_base_name": knowledge_base_name,
             "vector_store_type": vector_store_type,
             "embed_model": embed_model,
+            "vs_options": vs_options,
         }
 
         response = self.post(
@@ -571,6 +573,8 @@ class ApiRequest:
         knowledge_base_name: str,
         top_k: int = VECTOR_SEARCH_TOP_K,
         score_threshold: int = SCORE_THRESHOLD,
+        nprobe: int = None,
+        ef_search: int = None,
     ) -> List:
         '''
         对应api.py/knowledge_base/search_docs接口
@@ -580,6 +584,8 @@ class ApiRequest:
             "knowledge_base_name": knowledge_base_name,
             "top_k": top_k,
             "score_threshold": score_threshold,
+            "nprobe": nprobe,
+            "ef_search": ef_search,
         }
 
         response = self.post(
@@ -588,6 +594,56 @@ class ApiRequest:
         )
         return self._get_response_value(response, as_json=True)
 
+    def search_kb_docs_batch(
+        self,
+        queries: List[str],
+        knowledge_base_name: str,
+        top_k: int = VECTOR_SEARCH_TOP_K,
+        score_threshold: int = SCORE_THRESHOLD,
+        nprobe: int = None,
+        ef_search: int = None,
+    ) -> List:
+        '''
+        对应api.py/knowledge_base/search_docs_batch接口
+        '''
+        data = {
+            "queries": queries,
+            "knowledge_base_name": knowledge_base_name,
+            "top_k": top_k,
+            "score_threshold": score_threshold,
+            "nprobe": nprobe,
+            "ef_search": ef_search,
+        }
+
+        response = self.post(
+            "/knowledge_base/search_docs_batch",
+            json=data,
+        )
+        return self._get_response_value(response, as_json=True)
+
+    def search_kb_docs_federated(
+        self,
+        query: str,
+        knowledge_base_names: List[str],
+        top_k: int = VECTOR_SEARCH_TOP_K,
+        score_threshold: int = SCORE_THRESHOLD,
+    ) -> List:
+        '''
+        对应api.py/knowledge_base/search_docs_federated接口
+        '''
+        data = {
+            "query": query,
+            "knowledge_base_names": knowledge_base_names,
+            "top_k": top_k,
+            "score_threshold": score_threshold,
+        }
+
+        response = self.post(
+            "/knowledge_base/search_docs_federated",
+            json=data,
+        )
+        return self._get_response_value(response, as_json=True)
+
     def upload_kb_docs(
         self,
         files: List[Union[str, Path, bytes]],